@@ -1,18 +1,58 @@
 
 # Import necessary modules and functions
 from flask import Flask
-from app.models import initialize_database
+from app import login_events, library_index
+from app.models import initialize_database, login_writer, query_cache, catalog_cache, followed_artists, library_indexer
 from app.routes import setup_routes
+from app.commands import setup_commands
+from app.spotify_client import spotify_clients, spotify_calls
+from app.rate_limit import spotify_limiter
+from app.auth import token_manager
+from app.request_memo import setup_request_memo
 
-def create_app():
+def create_app(config_object='config.Config'):
     """
     Create a Flask application instance
+    :param config_object: The configuration to load, e.g. 'config.TestConfig' for the tests
     :return: Return the configured Flask application instance
     """
     app = Flask(__name__, template_folder='templates')  # Create a new Flask application instance
-    app.config.from_object('config.Config')  # Load configuration settings from the 'config.Config' object
+    app.config.from_object(config_object)  # Load configuration settings from the configuration object
 
-    initialize_database()  # Initialize the database (if not exists)
+    # Initialize the database (if not exists) with the storage backend selected in the configuration
+    initialize_database(app.config['DATABASE_PATH'] or None, backend=app.config['DATABASE_BACKEND'])
+    login_writer.configure(flush_interval=app.config['LOGIN_WRITER_FLUSH_INTERVAL'],
+                           batch_size=app.config['LOGIN_WRITER_BATCH_SIZE'],
+                           max_queue_size=app.config['LOGIN_WRITER_QUEUE_SIZE'])  # Settings of the background writer
+    login_events.configure_retention(
+        events=_days(app.config['LOGIN_EVENTS_RETENTION_DAYS']),
+        hourly=_days(app.config['LOGIN_ROLLUP_HOURLY_RETENTION_DAYS']),
+        daily=_days(app.config['LOGIN_ROLLUP_DAILY_RETENTION_DAYS']),
+        weekly=_days(app.config['LOGIN_ROLLUP_WEEKLY_RETENTION_DAYS']))  # Retention policy of the login event log
+    query_cache.ttl = app.config['QUERY_CACHE_TTL']  # Lifetime of the cached statistics and user logins pages
+    catalog_cache.max_bytes = app.config['CATALOG_CACHE_MAX_BYTES']  # Memory limit of the Spotify catalog cache
+    followed_artists.resync_interval = app.config['FOLLOWED_ARTISTS_RESYNC']  # Full download of the followed artists
+    library_indexer.enabled = app.config['LIBRARY_INDEX_BACKGROUND']  # Background indexing of the users' playlists
+    library_index.configure_retention(days=_days(app.config['LIBRARY_INDEX_RETENTION_DAYS']),
+                                      tracks=app.config['LIBRARY_INDEX_MAX_TRACKS'])  # What the index may keep
+    spotify_clients.configure(pool_size=app.config['SPOTIFY_POOL_SIZE'],
+                              timeout=app.config['SPOTIFY_TIMEOUT'])  # Connection pool of the Spotify API clients
+    spotify_calls.configure(max_workers=app.config['SPOTIFY_CALL_WORKERS'],
+                            timeout=app.config['SPOTIFY_CALL_TIMEOUT'],
+                            page_parallelism=app.config['SPOTIFY_PAGE_PARALLELISM'])  # Pool of the concurrent Spotify calls
+    spotify_limiter.configure(rate=app.config['SPOTIFY_RATE_LIMIT'],
+                              burst=app.config['SPOTIFY_RATE_BURST'])  # Rate limit of every Spotify call
+    token_manager.configure(redirect_uri=app.config['SPOTIPY_REDIRECT_URI'],
+                            background=app.config['SPOTIFY_TOKEN_REFRESHER'],
+                            background_margin=app.config['SPOTIFY_TOKEN_REFRESH_MARGIN'])  # Refreshing the tokens
     setup_routes(app)  # Set up application routes (e.g., define URL routes and associated view functions)
+    setup_commands(app)  # Set up the command line commands (e.g., rebuilding the statistics)
+    setup_request_memo(app)  # Report the calls saved by the request memo in debug mode
 
     return app  # Return the configured Flask application instance
+
+def _days(value):
+    """
+    Function to read a number of days from the configuration, where an empty value means "forever"
+    """
+    return int(value) if value not in (None, '') else None
@@ -0,0 +1,53 @@
+"""
+asyncio interface of the Spotify calls. A page which needs several independent calls awaits them together with
+asyncio.gather instead of making them one after the other:
+
+    async def load(spotify):
+        return await asyncio.gather(spotify.current_user_top_tracks(limit=10), spotify.current_user_top_artists(limit=10))
+
+    top_tracks, top_artists = run(load(AsyncSpotify(get_spotify_client())))
+
+The views of the application are synchronous (WSGI), they use run() as the synchronous facade of the coroutines.
+Only the Spotify calls of an AsyncSpotify are awaited: the functions of the application use the request (session, g),
+so they are called on the request thread and never on another thread.
+"""
+import asyncio
+
+from app.spotify_client import spotify_calls
+
+
+class AsyncSpotify:
+    """
+    Class which makes a spotipy client awaitable: every method of the client returns a coroutine. The call itself runs
+    on the SpotifyCallPool, so the event loop is never blocked, the number of parallel calls stays limited and the
+    calls go through the rate limiter with the priority of the caller.
+    """
+
+    def __init__(self, client, pool=None):
+        """
+        :param client: The spotipy client, e.g. from get_spotify_client()
+        :param pool: The SpotifyCallPool which runs the calls (default: the pool of the application)
+        """
+        self._client = client
+        self._pool = pool or spotify_calls
+
+    def __getattr__(self, name):
+        method = getattr(self._client, name)
+        if not callable(method):
+            return method
+
+        async def call(*args, **kwargs):
+            future = self._pool.submit(self._pool.call_with_backoff, method, *args, **kwargs)
+            return await asyncio.wrap_future(future)
+
+        call.__name__ = name
+        return call
+
+
+def run(coroutine):
+    """
+    Synchronous facade of the coroutines for the views and the other synchronous callers. The coroutine runs in a new
+    event loop of the calling thread, with the context of the caller (e.g. the request context).
+    :return: Returns the result of the coroutine
+    """
+    return asyncio.run(coroutine)
@@ -1,20 +1,54 @@
-
 # Import necessary modules and functions
+import logging
+import threading
 import time
+from concurrent.futures import Future
+from spotipy.cache_handler import CacheHandler
 from spotipy.oauth2 import SpotifyOAuth
-from flask import session, url_for, redirect
+from flask import has_request_context, session, url_for, redirect
+from app.spotify_client import spotify_clients
+from app.request_memo import memoize
+import atexit
 import os
 
+logger = logging.getLogger(__name__)
+
+
+class SessionTokenCache(CacheHandler):
+    """
+    Cache handler of the shared SpotifyOAuth object which does not store anything. The tokens are kept in the
+    session of each user, the shared object must never hand out the token of another user.
+    """
+
+    def get_cached_token(self):
+        return None
+
+    def save_token_to_cache(self, token_info):
+        return None
+
+
 def create_spotify_oauth():
     """
-    Function to create a SpotifyOAuth object. Used for user authentication.
+    Function to get the SpotifyOAuth object. Used for user authentication. It is created only once (see TokenManager),
+    not for every request.
     :return: Returns the SpotifyOAuth object. IN that there are multiple things set, such as my application's client ID,
     client secret, redirect uri and scope (allows me to access different information and perform actions on the users
     behalf)
     """
+    return token_manager.oauth()
+
 
-    # Generate the redirect URI dynamically
-    redirect_uri = url_for('redirect_page', _external=True)
+def build_spotify_oauth(redirect_uri=None):
+    """
+    Function to create a SpotifyOAuth object with the credentials of the application
+    :param redirect_uri: The redirect URI of the application (SPOTIPY_REDIRECT_URI). If it is not given, it is
+    generated from the host of the current request
+    :return: Returns the new SpotifyOAuth object
+    """
+    if redirect_uri is None:
+        if not has_request_context():
+            raise RuntimeError("SPOTIPY_REDIRECT_URI has to be set to use the Spotify OAuth outside of a request")
+        redirect_uri = url_for('redirect_page', _external=True)  # Generate the redirect URI dynamically
 
     # Create and return a SpotifyOAuth object with the necessary credentials and scopes
     return SpotifyOAuth(
@@ -22,15 +56,220 @@ def create_spotify_oauth():
         client_secret=os.getenv('SPOTIPY_CLIENT_SECRET'),  # Spotify client secret from environment variable
         redirect_uri=redirect_uri,  # Redirect URI for Spotify's OAuth flow
         scope='user-library-read playlist-read-collaborative playlist-read-private playlist-modify-public playlist-modify-private user-read-private user-read-email user-top-read user-follow-read user-follow-modify',   # Required scopes for accessing user's Spotify data
-        cache_path=None  # No cache file path specified --> needed for session clearing
+        cache_handler=SessionTokenCache()  # No cache file, the tokens are in the session --> needed for session clearing
     )
 
+
+class TokenManager:
+    """
+    Class which refreshes the access tokens of the users. If several requests of the same user (e.g. several tabs)
+    find the token expired at the same time, only one of them refreshes it and the others wait for its result
+    (single-flight). The new tokens are remembered by refresh token, so a request which still has the old token in its
+    session gets the new one without another refresh. An optional background thread refreshes the tokens of the
+    active users before they expire, so the requests do not have to wait for the refresh at all.
+    """
+
+    def __init__(self, expiry_margin=60, background_margin=300, check_interval=30, idle_after=3600):
+        """
+        :param expiry_margin: A token is refreshed by the request if it expires in less than this many seconds
+        :param background_margin: The background thread refreshes the tokens which expire in less than this many seconds
+        :param check_interval: The number of seconds between two checks of the background thread
+        :param idle_after: The tokens of the users who did not make a request for this many seconds are forgotten
+        """
+        self.expiry_margin = expiry_margin
+        self.background_margin = background_margin
+        self.check_interval = check_interval
+        self.idle_after = idle_after
+        self.background_enabled = False
+        self.redirect_uri = None  # SPOTIPY_REDIRECT_URI, None means the host of the request
+        self._oauth = None
+        self._lock = threading.Lock()
+        self._in_flight = {}  # refresh token -> Future of the running refresh
+        self._latest = {}  # refresh token -> (newest token info, last use), also for the rotated refresh tokens
+        self._last_prune = time.monotonic()
+        self._thread = None
+        self._stopping = threading.Event()
+        self.refreshes = 0
+        self.shared = 0
+        self.background_refreshes = 0
+
+    def configure(self, background=None, background_margin=None, check_interval=None, redirect_uri=None):
+        if redirect_uri is not None and redirect_uri != self.redirect_uri:
+            with self._lock:
+                self.redirect_uri = redirect_uri
+                self._oauth = None  # Created again with the new redirect URI
+        if background_margin is not None:
+            self.background_margin = background_margin
+        if check_interval is not None:
+            self.check_interval = check_interval
+        if background is not None:
+            self.background_enabled = background
+            if background and self.redirect_uri is None:
+                logger.warning("The background token refresher needs SPOTIPY_REDIRECT_URI, it can not refresh tokens")
+
+    def oauth(self):
+        """
+        Function to get the SpotifyOAuth object. If the redirect URI is configured, one shared object is created at
+        the first use, it also works outside of a request (e.g. in the background thread). Otherwise every request
+        gets an object with the redirect URI of its own host, and outside of a request there is none.
+        :return: Returns the SpotifyOAuth object
+        """
+        if self.redirect_uri is None and has_request_context():
+            return memoize('spotify_oauth', build_spotify_oauth)
+        with self._lock:
+            if self._oauth is None:
+                self._oauth = build_spotify_oauth(self.redirect_uri)
+            return self._oauth
+
+    def newest(self, token_info):
+        """
+        Function to get the newest known token of a user, e.g. after another request or the background thread
+        refreshed the token in the session
+        :return: Returns the newest token info and remembers that the user is active
+        """
+        with self._lock:
+            if time.monotonic() - self._last_prune >= self.check_interval:
+                self._forget_idle()  # Also without the background thread, so the idle tokens are not kept forever
+            entry = self._latest.get(token_info['refresh_token'])
+            if entry is not None and entry[0]['expires_at'] > token_info['expires_at']:
+                token_info = entry[0]
+            self._latest[token_info['refresh_token']] = (token_info, time.monotonic())
+        if self.background_enabled:
+            self.start()
+        return token_info
+
+    def refresh(self, token_info):
+        """
+        Function to refresh a token. Only one refresh runs for a refresh token at a time, the other callers wait for
+        its result.
+        :param token_info: The expiring token info
+        :return: Returns the new token info
+        """
+        refresh_token = token_info['refresh_token']
+        with self._lock:
+            entry = self._latest.get(refresh_token)
+            if entry is not None and entry[0]['expires_at'] > token_info['expires_at']:
+                self.shared += 1
+                return entry[0]  # Somebody else refreshed it already
+            flight = self._in_flight.get(refresh_token)
+            leader = flight is None
+            if leader:
+                flight = self._in_flight[refresh_token] = Future()
+            else:
+                self.shared += 1
+
+        if not leader:
+            return flight.result()
+
+        try:
+            new_token_info = create_spotify_oauth().refresh_access_token(refresh_token)  # Refresh the access token using the refresh token
+        except Exception as e:
+            flight.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._in_flight.pop(refresh_token, None)
+
+        with self._lock:
+            self.refreshes += 1
+            last_use = self._latest.get(refresh_token, (None, time.monotonic()))[1]
+            self._latest[refresh_token] = (new_token_info, last_use)
+            # Spotify may send a new refresh token, the requests with the old one still find the new token
+            self._latest[new_token_info['refresh_token']] = (new_token_info, last_use)
+        flight.set_result(new_token_info)
+        return new_token_info
+
+    def refresh_due(self):
+        """
+        Function to refresh the tokens of the active users which expire soon (one round of the background thread)
+        :return: Returns the number of refreshed tokens
+        """
+        with self._lock:
+            self._forget_idle()
+            due = {id(token_info): token_info for token_info, last_use in self._latest.values()
+                   if token_info['expires_at'] - int(time.time()) < self.background_margin}
+        refreshed = 0
+        for token_info in due.values():
+            try:
+                self.refresh(token_info)
+                refreshed += 1
+            except Exception as e:
+                logger.warning("Could not refresh a token in the background: %s", e)
+        self.background_refreshes += refreshed
+        return refreshed
+
+    def _forget_idle(self):
+        """
+        Function to forget the tokens of the users who did not make a request for idle_after seconds. The caller
+        holds the lock.
+        :return: Returns nothing
+        """
+        now = self._last_prune = time.monotonic()
+        for refresh_token, (token_info, last_use) in list(self._latest.items()):
+            if now - last_use > self.idle_after:
+                del self._latest[refresh_token]  # The user is not active, the token is not needed anymore
+
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        """
+        Function to start the background thread. Calling it again while the thread is running does nothing.
+        :return: Returns nothing
+        """
+        with self._lock:
+            if self.is_running():
+                return
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run, name='token-refresher', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._stopping.wait(self.check_interval):
+            try:
+                self.refresh_due()
+            except Exception:
+                logger.exception("The background refresh of the tokens failed")  # The thread keeps running
+
+    def stop(self):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+
+    def reset(self):
+        """
+        Function to forget the shared SpotifyOAuth object and the remembered tokens
+        :return: Returns nothing
+        """
+        with self._lock:
+            self._oauth = None
+            self._latest.clear()
+            self.refreshes = self.shared = self.background_refreshes = 0
+
+    def stats(self):
+        with self._lock:
+            return {"refreshes": self.refreshes, "shared_refreshes": self.shared,
+                    "background_refreshes": self.background_refreshes, "tracked_tokens": len(self._latest),
+                    "background": self.is_running()}
+
+
+# The token manager of the application, configured by create_app
+token_manager = TokenManager()
+atexit.register(token_manager.stop)
+
 def get_token():
     """
-    Function to get the current user's access token
+    Function to get the current user's access token. It is read (and refreshed if needed) only once per request.
     :return: Returns the token information. It includes the access token, the token type, the refresh token and the time
     in which the token expires.
     """
+    return memoize('token_info', _read_token)
+
+def _read_token():
+    """
+    Function to read the token of the current user from the session and refresh it if it is about to expire
+    :return: Returns the token information
+    """
     user_id = session.get('user_id')
     token_info = session.get('token_info', None)
 
@@ -38,16 +277,21 @@ def get_token():
     if not user_id or not token_info:
         redirect(url_for('login'))
 
+    old_access_token = token_info['access_token']
+    token_info = token_manager.newest(token_info)  # Another request or the background thread may have refreshed it
+
     # Get the current time in seconds since the epoch
     now = int(time.time())
 
     # Check if the token is about to expire (less than 60 seconds remaining)
-    is_expired = token_info['expires_at'] - now < 60
+    is_expired = token_info['expires_at'] - now < token_manager.expiry_margin
 
-    # If the token is expired, refresh it
+    # If the token is expired, refresh it (only once, even if other requests of the user need it at the same time)
     if is_expired:
-        spotify_oauth = create_spotify_oauth()  # Create a new SpotifyOAuth object
-        token_info = spotify_oauth.refresh_access_token(token_info['refresh_token'])  # Refresh the access token using the refresh token
+        token_info = token_manager.refresh(token_info)
+
+    if token_info['access_token'] != old_access_token:
         session['token_info'] = token_info  # Update session with new token info
+        spotify_clients.swap_token(old_access_token, token_info['access_token'])  # Keep the client and its connections
 
     return token_info
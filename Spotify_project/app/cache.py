@@ -0,0 +1,454 @@
+# Import necessary modules and functions
+import json
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+
+class TTLCache:
+    """
+    Class of a small in-process cache. Every entry expires after `ttl` seconds and the whole cache can be invalidated
+    explicitly (e.g. when the underlying data changes). If there are more than `max_entries` entries, the least
+    recently used one is dropped. The hits and misses are counted, so the efficiency of the cache can be checked.
+    """
+
+    def __init__(self, ttl=30.0, max_entries=256):
+        """
+        :param ttl: The number of seconds an entry is valid for. 0 turns the cache off
+        :param max_entries: The maximum number of entries kept in memory
+        """
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # key -> (expires_at, value), in the order of the last use
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._generation = 0  # Increased by invalidate(), so a value computed before a change is not stored after it
+
+    def get(self, key):
+        """
+        Function to read an entry
+        :param key: The key of the entry
+        :return: Returns a (found, value) pair
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return True, entry[1]
+            if entry is not None:
+                del self._entries[key]  # Expired
+            self.misses += 1
+            return False, None
+
+    def set(self, key, value, generation=None):
+        """
+        Function to store an entry
+        :param generation: The generation (see get_or_compute) in which the value was computed. If the cache was
+        invalidated since then, the value is not stored
+        :return: Returns nothing
+        """
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get_or_compute(self, key, compute):
+        """
+        Function to read an entry, computing and storing it if it is missing or expired
+        :param key: The key of the entry
+        :param compute: Function without parameters which computes the value
+        :return: Returns the cached or the newly computed value
+        """
+        generation = self._generation
+        found, value = self.get(key)
+        if found:
+            return value
+        value = compute()
+        self.set(key, value, generation)
+        return value
+
+    def invalidate(self):
+        """
+        Function to drop every entry, e.g. after the underlying data changed
+        :return: Returns nothing
+        """
+        with self._lock:
+            self._entries.clear()
+            self._generation += 1
+            self.invalidations += 1
+
+    def reset(self):
+        """
+        Function to drop every entry and to reset the counters
+        :return: Returns nothing
+        """
+        with self._lock:
+            self._entries.clear()
+            self._generation += 1
+            self.hits = self.misses = self.invalidations = 0
+
+    def stats(self):
+        """
+        Function to get the counters of the cache
+        :return: Returns the number of hits, misses, invalidations, entries and the hit rate
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+                "invalidations": self.invalidations,
+                "entries": len(self._entries),
+                "ttl": self.ttl,
+            }
+
+
+class CatalogCache:
+    """
+    Class of the cache in front of the Spotify catalog calls (artists, albums, searches, playlists). Every endpoint has
+    its own TTL and the size of the cache is limited in bytes, the least recently used entries are dropped first. The
+    responses are stored as JSON, so the size is exact and a caller can never change a cached response.
+
+    The keys have a scope: ('shared', endpoint, args) for catalog data which is the same for everybody and
+    ('user', user_id, endpoint, args) for data which belongs to one user, so a user never gets an entry of another user.
+    """
+
+    def __init__(self, ttls=None, default_ttl=300.0, max_bytes=32 * 1024 * 1024):
+        """
+        :param ttls: The number of seconds the entries of an endpoint are valid for, e.g. {'artist': 3600}
+        :param default_ttl: The TTL of the endpoints which are not in ttls. 0 turns the cache off
+        :param max_bytes: The maximum total size of the stored responses
+        """
+        self.ttls = dict(ttls or {})
+        self.default_ttl = default_ttl
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (expires_at, data), in the order of the last use
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._endpoint_hits = {}
+        self._generation = 0  # Increased by invalidate(), so a response fetched before a change is not stored after it
+
+    @property
+    def generation(self):
+        """
+        The current generation of the cache. It is read before a fetch and given to set(), see get_or_fetch
+        """
+        return self._generation
+
+    @staticmethod
+    def key(endpoint, args, user_id=None):
+        """
+        Function to build the key of an entry
+        :param endpoint: The name of the endpoint, e.g. 'artist'
+        :param args: The arguments of the call (a tuple)
+        :param user_id: The owner of the entry or None for shared catalog data
+        :return: Returns the key
+        """
+        if user_id is None:
+            return ('shared', endpoint, tuple(args))
+        return ('user', user_id, endpoint, tuple(args))
+
+    def ttl(self, endpoint):
+        return self.ttls.get(endpoint, self.default_ttl)
+
+    def get(self, key):
+        """
+        Function to read an entry
+        :return: Returns a (found, value) pair, the value is a new copy of the cached response
+        """
+        return self.get_first([key])
+
+    def get_first(self, keys):
+        """
+        Function to read the first existing entry of several keys, e.g. the user's own copy or the shared copy of a
+        playlist. It counts as one lookup.
+        :return: Returns a (found, value) pair, the value is a new copy of the cached response
+        """
+        with self._lock:
+            now = time.monotonic()
+            for key in keys:
+                entry = self._entries.get(key)
+                if entry is not None and entry[0] > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    self._endpoint_hits[key[-2]] = self._endpoint_hits.get(key[-2], 0) + 1
+                    data = entry[1]
+                    break
+                if entry is not None:
+                    self._remove(key)  # Expired
+            else:
+                self.misses += 1
+                return False, None
+        return True, json.loads(data)
+
+    def set(self, key, value, generation=None):
+        """
+        Function to store a response. Responses which can not be stored as JSON or are bigger than the whole cache
+        are not stored.
+        :param generation: The generation in which the response was fetched. If the cache was invalidated since then,
+        the response may be out of date and it is not stored
+        :return: Returns True if the response was stored
+        """
+        ttl = self.ttl(key[-2])
+        if ttl <= 0:
+            return False
+        try:
+            data = json.dumps(value, separators=(',', ':')).encode('utf-8')
+        except (TypeError, ValueError):
+            return False
+        if len(data) > self.max_bytes:
+            return False
+
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return False
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic() + ttl, data)
+            self.bytes += len(data)
+            while self.bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+        return True
+
+    def get_or_fetch(self, endpoint, args, fetch, user_id=None):
+        """
+        Function to read a response from the cache, calling Spotify only if it is missing or expired
+        :param endpoint: The name of the endpoint, e.g. 'artist'
+        :param args: The arguments of the call (a tuple), part of the key
+        :param fetch: Function without parameters which calls Spotify
+        :param user_id: The owner of the response or None for shared catalog data
+        :return: Returns the response
+        """
+        key = self.key(endpoint, args, user_id)
+        generation = self._generation
+        found, value = self.get(key)
+        if found:
+            return value
+        value = fetch()
+        self.set(key, value, generation)
+        return value
+
+    def invalidate(self, endpoint, args=None, user_id=None):
+        """
+        Function to drop the entries of an endpoint in every scope, e.g. the cached copies of a playlist after it was
+        edited
+        :param endpoint: The name of the endpoint
+        :param args: If it is given, only the entries with these arguments are dropped
+        :param user_id: If it is given, only the entries of this user are dropped
+        :return: Returns the number of dropped entries
+        """
+        with self._lock:
+            keys = [key for key in self._entries
+                    if key[-2] == endpoint and (args is None or key[-1] == tuple(args))
+                    and (user_id is None or key[:2] == ('user', user_id))]
+            for key in keys:
+                self._remove(key)
+            self._generation += 1  # The fetches which are running now must not store the old version
+        return len(keys)
+
+    def _remove(self, key):
+        self.bytes -= len(self._entries.pop(key)[1])
+
+    def clear(self):
+        """
+        Function to drop every entry and to reset the counters
+        :return: Returns nothing
+        """
+        with self._lock:
+            self._entries.clear()
+            self._generation += 1
+            self.bytes = 0
+            self.hits = self.misses = self.evictions = 0
+            self._endpoint_hits = {}
+
+    def stats(self):
+        """
+        Function to get the counters of the cache
+        :return: Returns the hit rate, the number of entries and bytes held and the hits by endpoint
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+                "entries": len(self._entries),
+                "shared_entries": sum(1 for key in self._entries if key[0] == 'shared'),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "evictions": self.evictions,
+                "hits_by_endpoint": dict(self._endpoint_hits),
+            }
+
+
+class FollowedArtistsCache:
+    """
+    Class of the artists followed by each user. The list of a user is downloaded once, then it is updated in place
+    when the user follows or unfollows an artist in the application, so checking if an artist is followed does not
+    need any Spotify call. After `resync_interval` seconds the list is downloaded again, so the changes made outside
+    the application (e.g. in the Spotify app) also show up.
+    """
+
+    def __init__(self, resync_interval=600.0, max_users=1024):
+        """
+        :param resync_interval: The number of seconds after which the list of a user is downloaded again
+        :param max_users: The maximum number of users kept in memory, the least recently used one is dropped
+        """
+        self.resync_interval = resync_interval
+        self.max_users = max_users
+        self._users = OrderedDict()  # user_id -> (synced_at, OrderedDict of artist_id -> artist)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.resyncs = 0
+
+    def _current(self, user_id):
+        entry = self._users.get(user_id)
+        if entry is None or time.monotonic() - entry[0] >= self.resync_interval:
+            return None
+        self._users.move_to_end(user_id)
+        return entry[1]
+
+    def get(self, user_id):
+        """
+        Function to read the followed artists of a user
+        :return: Returns the list of the artists or None if it has to be downloaded (again)
+        """
+        with self._lock:
+            artists = self._current(user_id)
+            if artists is None:
+                return None
+            self.hits += 1
+            return list(artists.values())
+
+    def contains(self, user_id, artist_id):
+        """
+        Function to check if a user follows an artist
+        :return: Returns True or False, or None if the list of the user has to be downloaded (again)
+        """
+        with self._lock:
+            artists = self._current(user_id)
+            if artists is None:
+                return None
+            self.hits += 1
+            return artist_id in artists
+
+    def replace(self, user_id, artists):
+        """
+        Function to store the downloaded list of a user
+        :return: Returns nothing
+        """
+        with self._lock:
+            self._users[user_id] = (time.monotonic(), OrderedDict((artist['id'], artist) for artist in artists))
+            self._users.move_to_end(user_id)
+            self.resyncs += 1
+            while len(self._users) > self.max_users:
+                self._users.popitem(last=False)
+
+    def is_loaded(self, user_id):
+        with self._lock:
+            return self._current(user_id) is not None
+
+    def add(self, user_id, artist):
+        """
+        Function to add a newly followed artist to the list of a user. Nothing happens if the list is not loaded,
+        the artist will be in it when it is downloaded.
+        :return: Returns True if the list was updated
+        """
+        with self._lock:
+            artists = self._current(user_id)
+            if artists is None:
+                return False
+            artists[artist['id']] = artist
+            return True
+
+    def discard(self, user_id, artist_id):
+        """
+        Function to remove an unfollowed artist from the list of a user
+        :return: Returns nothing
+        """
+        with self._lock:
+            entry = self._users.get(user_id)
+            if entry is not None:
+                entry[1].pop(artist_id, None)
+
+    def forget(self, user_id):
+        """
+        Function to drop the list of a user, so it is downloaded again when it is needed
+        :return: Returns nothing
+        """
+        with self._lock:
+            self._users.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._users.clear()
+            self.hits = self.resyncs = 0
+
+    def stats(self):
+        with self._lock:
+            return {"users": len(self._users), "hits": self.hits, "resyncs": self.resyncs,
+                    "resync_interval": self.resync_interval}
+
+
+class SingleFlight:
+    """
+    Class which lets only one call run for a key at a time. The callers which ask for the same key while the call is
+    running wait for it and get its result (or its error) instead of making the same call again.
+    """
+
+    def __init__(self):
+        self._calls = {}  # key -> Future of the running call
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.shared = 0
+
+    def do(self, key, function):
+        """
+        Function to make a call, or to wait for the same call if it is already running
+        :param key: The key of the call, e.g. the normalized query
+        :param function: Function without parameters which makes the call
+        :return: Returns the result of the call
+        """
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+                self.calls += 1
+            else:
+                self.shared += 1
+        if not leader:
+            return future.result()
+
+        try:
+            result = function()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+        future.set_result(result)
+        return result
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._calls)
+
+    def stats(self):
+        with self._lock:
+            return {"calls": self.calls, "shared": self.shared, "in_flight": len(self._calls)}
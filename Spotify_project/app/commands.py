@@ -0,0 +1,35 @@
+# Import necessary modules and functions
+import click
+from app.models import rebuild_user_stats, rollup_login_events, prune_library
+
+
+def setup_commands(app):
+    """
+    Function which registers the command line commands of the application (e.g. flask --app run rebuild-stats)
+    :param app: Received from the __init__.py file. This initializes my flask application.
+    :return: Returns nothing
+    """
+
+    @app.cli.command('rebuild-stats')
+    def rebuild_stats_command():
+        """
+        Recompute the materialized user statistics from the user_logins table.
+        """
+        total_users = rebuild_user_stats()
+        click.echo(f"Statistics rebuilt for {total_users} users.")
+
+    @app.cli.command('rollup-logins')
+    def rollup_logins_command():
+        """
+        Roll up the new login events and delete the ones older than the retention policy.
+        """
+        deleted = rollup_login_events()
+        click.echo(f"Login events rolled up, {deleted} old events deleted.")
+
+    @app.cli.command('prune-library')
+    def prune_library_command():
+        """
+        Delete the library index of the users who did not search their library for the retention period.
+        """
+        deleted = prune_library()
+        click.echo(f"Library index of {deleted} users deleted.")
@@ -0,0 +1,331 @@
+# Import necessary modules and functions
+import atexit
+import os
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+# Default location of the database: <project root>/instance/spotify.db. It is built with os.path.join, so it works on
+# every operating system (not only on Windows)
+DEFAULT_DB_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'instance', 'spotify.db')
+
+# Pragmas applied to every new connection. WAL lets the readers work while a writer is committing, NORMAL
+# synchronous is safe in WAL mode and saves an fsync on every commit, the cache size is in KiB (negative value) and
+# mmap lets SQLite read pages directly from the page cache of the OS
+CONNECTION_PRAGMAS = (
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA cache_size=-16000",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA temp_store=MEMORY",
+)
+
+POOL_SIZE = 8  # Maximum number of idle connections kept per pool
+CACHED_STATEMENTS = 256  # Number of prepared statements cached by each connection
+
+
+class ConnectionPool:
+    """
+    Class which keeps a pool of open SQLite connections to one database. The connections are created lazily, handed
+    out one thread at a time and put back after use, so the connect/teardown cost is paid only once per connection
+    and the prepared statement cache of the connection is reused by the next caller.
+    """
+
+    def __init__(self, connect, size=POOL_SIZE):
+        """
+        :param connect: Function without parameters which opens a new, configured connection (see the storages below)
+        :param size: The maximum number of idle connections that are kept open
+        """
+        self.connect = connect
+        self.size = size
+        self._idle = queue.LifoQueue(maxsize=size)  # LIFO, so the most recently used (warm) connection is reused
+        self._all = set()  # Every connection opened by the pool, needed for closing them at shutdown
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        """
+        Function to open a new connection and remember it
+        :return: Returns the new connection
+        """
+        conn = self.connect()
+        with self._lock:
+            self._all.add(conn)
+        return conn
+
+    def acquire(self):
+        """
+        Function to get a connection from the pool. A new connection is opened if there is no idle one.
+        :return: Returns an open connection
+        """
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return self._connect()
+
+    def release(self, conn):
+        """
+        Function to give back a connection to the pool. If the pool is already full, the connection is closed.
+        :param conn: The connection received from acquire()
+        :return: Returns nothing
+        """
+        if conn.in_transaction:
+            conn.rollback()  # Never give back a connection with a half-finished transaction
+        try:
+            self._idle.put_nowait(conn)
+        except queue.Full:
+            self._discard(conn)
+
+    def _discard(self, conn):
+        with self._lock:
+            self._all.discard(conn)
+        conn.close()
+
+    def close(self):
+        """
+        Function to close every connection opened by the pool
+        :return: Returns nothing
+        """
+        with self._lock:
+            connections = list(self._all)
+            self._all.clear()
+        while True:
+            try:
+                self._idle.get_nowait()
+            except queue.Empty:
+                break
+        for conn in connections:
+            conn.close()
+
+
+class SQLiteStorage:
+    """
+    Storage backend of a SQLite database file. It has a pool of read-write connections and a separate pool of
+    read-only connections, both in WAL mode, so the readers never wait for a writer.
+    """
+    backend = 'file'
+
+    def __init__(self, location=None):
+        """
+        :param location: The path of the database file. If it is not given, the default production path is used
+        """
+        self.location = self.resolve(location)
+        os.makedirs(os.path.dirname(self.location), exist_ok=True)
+        self._write_pool = ConnectionPool(self.connect)
+        self._read_pool = ConnectionPool(lambda: self.connect(read_only=True))
+
+    @staticmethod
+    def resolve(location):
+        """
+        Function to turn the configured location into the one used for connecting
+        :return: Returns the absolute path of the database file
+        """
+        return os.path.abspath(location) if location else DEFAULT_DB_PATH
+
+    def connect(self, read_only=False):
+        """
+        Function to open a new (not pooled) connection with the tuned pragmas
+        :param read_only: If True, the connection is opened in read-only mode (used by the statistics pages)
+        :return: Returns the new connection
+        """
+        if read_only:
+            conn = sqlite3.connect(f"file:{self.location}?mode=ro", uri=True, check_same_thread=False,
+                                   cached_statements=CACHED_STATEMENTS)
+            conn.execute("PRAGMA query_only=ON")  # Extra safety net, the stats pages must never write
+        else:
+            conn = sqlite3.connect(self.location, check_same_thread=False, cached_statements=CACHED_STATEMENTS)
+            conn.execute("PRAGMA journal_mode=WAL")  # Persistent, but setting it again is cheap
+        for pragma in CONNECTION_PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    @contextmanager
+    def connection(self):
+        """
+        Context manager which lends a pooled read-write connection. The transaction is committed if the block finishes
+        without an error and rolled back otherwise.
+        :return: Yields the connection
+        """
+        conn = self._write_pool.acquire()
+        try:
+            yield conn
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            self._write_pool.release(conn)
+
+    @contextmanager
+    def read_connection(self):
+        """
+        Context manager which lends a pooled read-only connection
+        :return: Yields the connection
+        """
+        conn = self._read_pool.acquire()
+        try:
+            yield conn
+        finally:
+            self._read_pool.release(conn)
+
+    def close(self):
+        """
+        Function to close every pooled connection
+        :return: Returns nothing
+        """
+        self._write_pool.close()
+        self._read_pool.close()
+
+
+class MemorySQLiteStorage(SQLiteStorage):
+    """
+    Storage backend of a shared-cache in-memory SQLite database, used by the tests and the load benchmarks, so they
+    do not touch the disk. Every connection of the process sees the same database (by its name) and the database
+    exists until close() is called, after that the next connection starts with an empty database. Two storages with
+    different names are independent, so the tests do not see each other's data. The readers only see committed data,
+    like in the file-backed database, but they take turns with the writers (see connect).
+    """
+    backend = 'memory'
+
+    def __init__(self, location=None):
+        """
+        :param location: The name of the database (e.g. 'spotify_test') or a complete 'file:...?mode=memory' URI
+        """
+        self.location = self.resolve(location)
+        self._write_pool = ConnectionPool(self.connect)
+        self._read_pool = ConnectionPool(lambda: self.connect(read_only=True))
+        # In shared-cache mode the locks are per table and a locked table is reported at once (busy_timeout does not
+        # apply), so the readers and the writers take turns here instead
+        self._lock = threading.RLock()
+        self._anchor = None
+        self._open()
+
+    @staticmethod
+    def resolve(location):
+        """
+        Function to turn the name of the database into a shared-cache in-memory URI
+        :return: Returns the URI
+        """
+        location = location or 'spotify'
+        if location.startswith('file:'):
+            return location
+        return f"file:{location}?mode=memory&cache=shared"
+
+    def _open(self):
+        # The in-memory database is deleted when its last connection is closed, this one keeps it alive
+        if self._anchor is None:
+            self._anchor = self.connect()
+
+    def connect(self, read_only=False):
+        conn = sqlite3.connect(self.location, uri=True, check_same_thread=False, cached_statements=CACHED_STATEMENTS)
+        if read_only:
+            # No read_uncommitted: it would let the readers see the half-written batches, which WAL never does
+            conn.execute("PRAGMA query_only=ON")
+        return conn
+
+    @contextmanager
+    def connection(self):
+        with self._lock:
+            self._open()
+            with super().connection() as conn:
+                yield conn
+
+    @contextmanager
+    def read_connection(self):
+        with self._lock:  # A reader and a writer of the same table would fail with "database table is locked"
+            self._open()
+            with super().read_connection() as conn:
+                yield conn
+
+    def close(self):
+        super().close()
+        if self._anchor is not None:
+            self._anchor.close()
+            self._anchor = None
+
+
+# The storage backends which can be selected with the DATABASE_BACKEND setting
+BACKENDS = {
+    SQLiteStorage.backend: SQLiteStorage,
+    MemorySQLiteStorage.backend: MemorySQLiteStorage,
+}
+
+_state_lock = threading.Lock()
+_storage = None  # Created by configure()
+
+
+def _detect_backend(location):
+    return MemorySQLiteStorage.backend if location and 'mode=memory' in location else SQLiteStorage.backend
+
+
+def configure(db_path=None, backend=None):
+    """
+    Function to set which database the connection manager uses. The location is resolved here once, every other
+    function uses the resolved value. Calling it again with a different database closes the old connections.
+    :param db_path: The path of the database file (or the name of the in-memory database). If it is not given, the
+    default of the backend is used.
+    :param backend: 'file' or 'memory' (see BACKENDS). If it is not given, it is detected from db_path
+    :return: Returns the resolved location of the database
+    """
+    global _storage
+    backend = backend or _detect_backend(db_path)
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown database backend: {backend}")
+    storage_class = BACKENDS[backend]
+    location = storage_class.resolve(db_path)
+    with _state_lock:
+        if _storage is not None and (_storage.backend, _storage.location) == (backend, location):
+            return location  # The same database is already configured, its warm connections are kept
+        old_storage, _storage = _storage, storage_class(location)
+    if old_storage is not None:
+        old_storage.close()
+    return location
+
+
+def get_storage():
+    """
+    Function to get the configured storage backend
+    :return: Returns the storage, configuring the default one if configure() was not called yet
+    """
+    if _storage is None:
+        configure()
+    return _storage
+
+
+def get_db_path():
+    """
+    Function to get the resolved location of the database (a file path or an in-memory URI)
+    :return: Returns the location, resolving the default one if configure() was not called yet
+    """
+    return get_storage().location
+
+
+def connection():
+    """
+    Context manager which lends a pooled read-write connection of the configured storage. The transaction is
+    committed if the block finishes without an error and rolled back otherwise.
+    :return: Yields the connection
+    """
+    return get_storage().connection()
+
+
+def read_connection():
+    """
+    Context manager which lends a pooled read-only connection. These are separate from the writer connections, so the
+    statistics pages never wait for a login being written.
+    :return: Yields the connection
+    """
+    return get_storage().read_connection()
+
+
+def close_all():
+    """
+    Function to close every pooled connection, e.g. when the application shuts down or between tests. An in-memory
+    database is deleted by this.
+    :return: Returns nothing
+    """
+    if _storage is not None:
+        _storage.close()
+
+
+atexit.register(close_all)  # Close the pooled connections when the application stops
@@ -0,0 +1,261 @@
+"""
+Command line tool for bulk export and import of the user_logins table, e.g. for seeding a staging database:
+
+    python -m app.dbtool export --output users.csv
+    python -m app.dbtool import --input users.jsonl --db instance/staging.db
+
+The rows are streamed, so the memory usage does not depend on the size of the table or of the file.
+"""
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+
+from app import database, models, stats
+
+COLUMNS = ('user_id', 'last_login_time', 'sub_level', 'display_name', 'followers', 'country')
+EXPORT_QUERY = "SELECT user_id, last_login_time, sub_level, display_name, followers, country FROM user_logins ORDER BY id"
+
+CHUNK_SIZE = 10000  # Rows written in one transaction
+BULK_LOAD_BYTES = 64 * 1024 * 1024  # Files bigger than this are loaded without the indexes (see --drop-indexes)
+
+
+class Progress:
+    """
+    Class which counts the processed rows and reports the speed (rows per second) on the standard error
+    """
+
+    def __init__(self, action, stream=None, every=100000):
+        self.action = action
+        self.stream = stream or sys.stderr
+        self.every = every
+        self.rows = 0
+        self.started = time.perf_counter()
+
+    def add(self, count):
+        before = self.rows
+        self.rows += count
+        if self.every and self.rows // self.every > before // self.every:
+            self.report()
+
+    def rate(self):
+        elapsed = time.perf_counter() - self.started
+        return self.rows / elapsed if elapsed > 0 else float(self.rows)
+
+    def report(self, final=False):
+        elapsed = time.perf_counter() - self.started
+        prefix = "Done:" if final else "..."
+        print(f"{prefix} {self.action} {self.rows} rows in {elapsed:.1f} s ({self.rate():,.0f} rows/s)",
+              file=self.stream)
+
+
+def detect_format(path, fmt):
+    """
+    Function to decide the file format from the --format option or from the extension of the file
+    :return: Returns 'csv' or 'jsonl'
+    """
+    if fmt:
+        return fmt
+    if path and path != '-' and os.path.splitext(path)[1].lower() in ('.jsonl', '.json', '.ndjson'):
+        return 'jsonl'
+    return 'csv'
+
+
+def open_output(path):
+    if path in (None, '-'):
+        return sys.stdout, False
+    return open(path, 'w', newline='', encoding='utf-8'), True
+
+
+def open_input(path):
+    if path in (None, '-'):
+        return sys.stdin, False
+    return open(path, 'r', newline='', encoding='utf-8'), True
+
+
+def export_rows(output, fmt, progress=None, chunk_size=CHUNK_SIZE):
+    """
+    Function to write every row of the user_logins table into a file object
+    :param output: The text file object
+    :param fmt: 'csv' or 'jsonl'
+    :param progress: Progress object for reporting the speed (optional)
+    :return: Returns the number of written rows
+    """
+    writer = None
+    if fmt == 'csv':
+        writer = csv.writer(output)
+        writer.writerow(COLUMNS)
+
+    count = 0
+    with database.read_connection() as conn:
+        c = conn.execute(EXPORT_QUERY)
+        while True:
+            rows = c.fetchmany(chunk_size)  # Only one chunk is in memory at a time
+            if not rows:
+                break
+            if writer is not None:
+                writer.writerows(rows)
+            else:
+                output.writelines(json.dumps(dict(zip(COLUMNS, row)), ensure_ascii=False) + '\n' for row in rows)
+            count += len(rows)
+            if progress:
+                progress.add(len(rows))
+    return count
+
+
+def read_rows(source, fmt):
+    """
+    Generator which reads the rows of a CSV or JSONL file one by one
+    :param source: The text file object
+    :param fmt: 'csv' or 'jsonl'
+    :return: Yields the rows as tuples in the order of COLUMNS
+    """
+    if fmt == 'csv':
+        records = csv.DictReader(source)
+    else:
+        records = (json.loads(line) for line in source if line.strip())
+    for record in records:
+        yield (record['user_id'], record['last_login_time'], record['sub_level'], record['display_name'],
+               int(record['followers']), record['country'])
+
+
+def chunked(rows, size):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def drop_secondary_structures(conn):
+    """
+    Function to drop the secondary indexes and the statistics triggers of user_logins before a bulk load. Updating
+    them row by row is much slower than building them once after the load.
+    :return: Returns nothing
+    """
+    objects = conn.execute("SELECT type, name FROM sqlite_master WHERE tbl_name='user_logins' "
+                           "AND type IN ('index', 'trigger') AND sql IS NOT NULL").fetchall()
+    for object_type, name in objects:
+        conn.execute(f'DROP {object_type.upper()} IF EXISTS "{name}"')
+
+
+def rebuild_secondary_structures(conn):
+    """
+    Function to create the indexes and triggers again after a bulk load and to recompute the statistics
+    :return: Returns nothing
+    """
+    for index in models.USER_LOGINS_INDEXES:
+        conn.execute(index)
+    stats.create_stats_store(conn)
+    stats.rebuild_stats(conn)
+
+
+def import_rows(rows, chunk_size=CHUNK_SIZE, drop_indexes=False, progress=None):
+    """
+    Function to load rows into the user_logins table. Existing users are updated (same upsert as the logins).
+    :param rows: Iterable of rows in the order of COLUMNS
+    :param chunk_size: The number of rows written in one transaction
+    :param drop_indexes: If True, the indexes and triggers are dropped during the load and rebuilt afterwards
+    :param progress: Progress object for reporting the speed (optional)
+    :return: Returns the number of imported rows
+    """
+    count = 0
+    with database.connection() as conn:
+        conn.commit()
+        if drop_indexes:
+            drop_secondary_structures(conn)
+            conn.commit()
+        try:
+            for chunk in chunked(rows, chunk_size):
+                conn.execute("BEGIN")  # One explicit transaction per chunk
+                conn.executemany(models.UPSERT_USER_LOGIN, chunk)
+                conn.commit()
+                count += len(chunk)
+                if progress:
+                    progress.add(len(chunk))
+        finally:
+            if drop_indexes:
+                # Also after a failed load, so the database is never left without its indexes
+                conn.rollback()
+                conn.execute("BEGIN")
+                rebuild_secondary_structures(conn)
+                conn.commit()
+    models.query_cache.invalidate()
+    return count
+
+
+def should_drop_indexes(option, path):
+    """
+    Function to decide if the indexes are dropped during the import. By default, they are dropped if the table is
+    empty or the file is big.
+    """
+    if option is not None:
+        return option
+    with database.read_connection() as conn:
+        if not conn.execute("SELECT EXISTS (SELECT 1 FROM user_logins)").fetchone()[0]:
+            return True
+    return path not in (None, '-') and os.path.getsize(path) >= BULK_LOAD_BYTES
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='python -m app.dbtool', description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--db', default=None, help="path of the database (default: instance/spotify.db)")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    export_parser = commands.add_parser('export', help="export the user_logins table")
+    export_parser.add_argument('--output', '-o', default='-', help="output file ('-' for the standard output)")
+    export_parser.add_argument('--format', '-f', choices=('csv', 'jsonl'), default=None)
+
+    import_parser = commands.add_parser('import', help="import rows into the user_logins table")
+    import_parser.add_argument('--input', '-i', default='-', help="input file ('-' for the standard input)")
+    import_parser.add_argument('--format', '-f', choices=('csv', 'jsonl'), default=None)
+    import_parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, help="rows per transaction")
+    indexes = import_parser.add_mutually_exclusive_group()
+    indexes.add_argument('--drop-indexes', dest='drop_indexes', action='store_true', default=None,
+                         help="drop the indexes during the load and rebuild them afterwards")
+    indexes.add_argument('--keep-indexes', dest='drop_indexes', action='store_false',
+                         help="keep the indexes during the load")
+    return parser
+
+
+def main(argv=None):
+    """
+    Entry point of the command line tool
+    :return: Returns the exit code
+    """
+    args = build_parser().parse_args(argv)
+    models.initialize_database(args.db)  # Creating the schema if needed and pointing the connection manager to it
+
+    if args.command == 'export':
+        fmt = detect_format(args.output, args.format)
+        output, should_close = open_output(args.output)
+        progress = Progress('exported')
+        try:
+            export_rows(output, fmt, progress)
+        finally:
+            if should_close:
+                output.close()
+        progress.report(final=True)
+    else:
+        fmt = detect_format(args.input, args.format)
+        drop_indexes = should_drop_indexes(args.drop_indexes, args.input)
+        source, should_close = open_input(args.input)
+        progress = Progress('imported')
+        try:
+            import_rows(read_rows(source, fmt), chunk_size=args.chunk_size, drop_indexes=drop_indexes,
+                        progress=progress)
+        finally:
+            if should_close:
+                source.close()
+        progress.report(final=True)
+    database.close_all()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,403 @@
+# Import necessary modules and functions
+import json
+import logging
+import re
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+from app.rate_limit import priority, BACKGROUND
+
+logger = logging.getLogger(__name__)
+
+# Local copy of the tracks of the playlists of the users who use the library search, so the library can be searched
+# without downloading the playlists from Spotify. Nothing is indexed for the other users. Every playlist is stored
+# with the snapshot_id it was indexed at: if Spotify reports another snapshot, the playlist changed and it is indexed
+# again.
+CREATE_PLAYLISTS_TABLE = '''
+    CREATE TABLE IF NOT EXISTS library_playlists (
+        user_id TEXT NOT NULL,
+        playlist_id TEXT NOT NULL,
+        snapshot_id TEXT NOT NULL,
+        name TEXT NOT NULL,
+        tracks INTEGER NOT NULL,
+        indexed_at TIMESTAMP NOT NULL,
+        PRIMARY KEY (user_id, playlist_id)
+    ) WITHOUT ROWID
+'''
+
+# The tracks of the indexed playlists in their order. The details are the track as returned by get_playlist_tracks,
+# so an indexed playlist can be displayed without Spotify.
+CREATE_TRACKS_TABLE = '''
+    CREATE TABLE IF NOT EXISTS library_tracks (
+        id INTEGER PRIMARY KEY,
+        user_id TEXT NOT NULL,
+        playlist_id TEXT NOT NULL,
+        position INTEGER NOT NULL,
+        track_id TEXT,
+        name TEXT NOT NULL,
+        artists TEXT NOT NULL,
+        album TEXT NOT NULL,
+        details TEXT NOT NULL
+    )
+'''
+CREATE_TRACKS_INDEX = '''
+    CREATE INDEX IF NOT EXISTS idx_library_tracks_playlist ON library_tracks (user_id, playlist_id, position)
+'''
+
+# The users who use the library search and when they used it last. Only their playlists are indexed and the index of
+# a user who did not search for RETENTION_DAYS is deleted (see apply_retention).
+CREATE_USERS_TABLE = '''
+    CREATE TABLE IF NOT EXISTS library_users (
+        user_id TEXT PRIMARY KEY,
+        used_at TIMESTAMP NOT NULL
+    ) WITHOUT ROWID
+'''
+
+# Full-text index of the name, the artists and the album of the tracks above (external content, so the text is not
+# stored twice). The accents are ignored, so 'beyonce' finds 'Beyoncé'. It is kept up to date by the triggers below.
+CREATE_SEARCH_TABLE = '''
+    CREATE VIRTUAL TABLE IF NOT EXISTS library_search USING fts5 (
+        name, artists, album,
+        content = 'library_tracks', content_rowid = 'id', tokenize = 'unicode61 remove_diacritics 2'
+    )
+'''
+CREATE_SEARCH_TRIGGERS = (
+    '''
+    CREATE TRIGGER IF NOT EXISTS library_tracks_insert AFTER INSERT ON library_tracks BEGIN
+        INSERT INTO library_search (rowid, name, artists, album) VALUES (new.id, new.name, new.artists, new.album);
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS library_tracks_delete AFTER DELETE ON library_tracks BEGIN
+        INSERT INTO library_search (library_search, rowid, name, artists, album)
+        VALUES ('delete', old.id, old.name, old.artists, old.album);
+    END
+    ''',
+)
+
+SELECT_SNAPSHOTS = "SELECT playlist_id, snapshot_id FROM library_playlists WHERE user_id = ?"
+SELECT_TRACK_COUNTS = "SELECT playlist_id, tracks FROM library_playlists WHERE user_id = ?"
+UPSERT_USER = '''
+    INSERT INTO library_users (user_id, used_at) VALUES (?, strftime('%Y-%m-%d %H:%M:%S', 'now', 'utc'))
+    ON CONFLICT (user_id) DO UPDATE SET used_at = excluded.used_at
+'''
+SELECT_EXPIRED_USERS = "SELECT user_id FROM library_users WHERE used_at < ?"
+DELETE_USER = "DELETE FROM library_users WHERE user_id = ?"
+DELETE_USER_PLAYLISTS = "DELETE FROM library_playlists WHERE user_id = ?"
+DELETE_USER_TRACKS = "DELETE FROM library_tracks WHERE user_id = ?"
+UPSERT_PLAYLIST = '''
+    INSERT INTO library_playlists (user_id, playlist_id, snapshot_id, name, tracks, indexed_at)
+    VALUES (?, ?, ?, ?, ?, strftime('%Y-%m-%d %H:%M:%S', 'now', 'utc'))
+    ON CONFLICT (user_id, playlist_id) DO UPDATE SET
+        snapshot_id = excluded.snapshot_id, name = excluded.name, tracks = excluded.tracks,
+        indexed_at = excluded.indexed_at
+'''
+UPDATE_SNAPSHOT = '''
+    UPDATE library_playlists
+    SET snapshot_id = ?, tracks = tracks - ?, indexed_at = strftime('%Y-%m-%d %H:%M:%S', 'now', 'utc')
+    WHERE user_id = ? AND playlist_id = ?
+'''
+DELETE_PLAYLIST = "DELETE FROM library_playlists WHERE user_id = ? AND playlist_id = ?"
+DELETE_PLAYLIST_TRACKS = "DELETE FROM library_tracks WHERE user_id = ? AND playlist_id = ?"
+DELETE_TRACK = "DELETE FROM library_tracks WHERE user_id = ? AND playlist_id = ? AND track_id = ?"
+INSERT_TRACK = '''
+    INSERT INTO library_tracks (user_id, playlist_id, position, track_id, name, artists, album, details)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+'''
+SELECT_PLAYLIST_TRACKS = "SELECT details FROM library_tracks WHERE user_id = ? AND playlist_id = ? ORDER BY position"
+SELECT_TRACK_NAMES = "SELECT track_id, name FROM library_tracks WHERE user_id = ? AND playlist_id = ? ORDER BY position"
+SEARCH_TRACKS = '''
+    SELECT t.details, t.playlist_id, p.name FROM library_search s
+    JOIN library_tracks t ON t.id = s.rowid
+    JOIN library_playlists p ON p.user_id = t.user_id AND p.playlist_id = t.playlist_id
+    WHERE library_search MATCH ? AND t.user_id = ? {playlist_filter}
+    ORDER BY s.rank, t.playlist_id, t.position LIMIT ?
+'''
+PLAYLISTS_CONTAINING = '''
+    SELECT t.playlist_id, p.name, COUNT(*) AS matches FROM library_search s
+    JOIN library_tracks t ON t.id = s.rowid
+    JOIN library_playlists p ON p.user_id = t.user_id AND p.playlist_id = t.playlist_id
+    WHERE library_search MATCH ? AND t.user_id = ?
+    GROUP BY t.playlist_id ORDER BY matches DESC, p.name
+'''
+
+SEARCH_LIMIT = 50  # The number of tracks a library search returns
+
+# How long the index of a user is kept after their last library search (None means forever) and the most tracks which
+# are indexed for one user. Can be changed with configure_retention
+retention_days = 30
+max_tracks = 20000
+
+RETENTION_INTERVAL = 3600  # Seconds between two automatic runs of the retention policy
+_last_retention = time.monotonic()  # The first automatic run is one interval after the start
+
+available = False  # Set by create_library_index. False if the SQLite of the system was built without FTS5, the
+# playlists are then still stored (see playlist_tracks), only the search is not possible
+
+
+def configure_retention(days=30, tracks=20000):
+    """
+    Function to change the retention policy of the library index
+    :param days: The number of days the index of a user is kept after their last library search, None means forever
+    :param tracks: The most tracks which are indexed for one user
+    :return: Returns nothing
+    """
+    global retention_days, max_tracks
+    retention_days = days
+    max_tracks = tracks
+
+
+def create_library_index(conn):
+    """
+    Function to create the tables of the library index and the triggers which keep the full-text index up to date
+    :param conn: An open read-write connection
+    :return: Returns True if the index can be searched and False if SQLite does not support FTS5
+    """
+    global available
+    conn.execute(CREATE_USERS_TABLE)
+    conn.execute(CREATE_PLAYLISTS_TABLE)
+    conn.execute(CREATE_TRACKS_TABLE)
+    conn.execute(CREATE_TRACKS_INDEX)
+    try:
+        conn.execute(CREATE_SEARCH_TABLE)
+        for trigger in CREATE_SEARCH_TRIGGERS:
+            conn.execute(trigger)
+        available = True
+    except sqlite3.OperationalError as e:
+        logger.warning("The library index is turned off, SQLite does not support FTS5: %s", e)
+        available = False
+    return available
+
+
+def match_expression(query, column=None):
+    """
+    Function to turn the text typed by the user into an FTS5 query. Every word has to appear (in any order) and the
+    last one can be the beginning of a word, so 'love so' finds 'Love Song'.
+    :param query: The text typed by the user
+    :param column: The only column to search in (e.g. 'name'), every searchable column if it is not given
+    :return: Returns the FTS5 query or None if the text does not contain any word
+    """
+    words = re.findall(r'\w+', query.casefold())
+    if not words:
+        return None
+    expression = ' '.join(f'"{word}"*' for word in words)
+    return f'{{{column}}} : ({expression})' if column else expression
+
+
+def indexed_snapshots(conn, user_id):
+    """
+    Function to get the snapshot of every indexed playlist of the user
+    :return: Returns a dictionary of playlist ID -> snapshot ID
+    """
+    return dict(conn.execute(SELECT_SNAPSHOTS, (user_id,)).fetchall())
+
+
+def indexed_track_counts(conn, user_id):
+    """
+    Function to get the number of indexed tracks in every indexed playlist of the user
+    :return: Returns a dictionary of playlist ID -> number of tracks
+    """
+    return dict(conn.execute(SELECT_TRACK_COUNTS, (user_id,)).fetchall())
+
+
+def mark_used(conn, user_id):
+    """
+    Function to record that the user used the library search, so their index is kept for another retention period
+    :param conn: An open read-write connection, the caller commits the transaction
+    :return: Returns nothing
+    """
+    conn.execute(UPSERT_USER, (user_id,))
+
+
+def forget_user(conn, user_id):
+    """
+    Function to delete everything the index stores about the user (e.g. the user logged out)
+    :param conn: An open read-write connection, the caller commits the transaction
+    :return: Returns the number of deleted playlists
+    """
+    conn.execute(DELETE_USER_TRACKS, (user_id,))
+    conn.execute(DELETE_USER, (user_id,))
+    return conn.execute(DELETE_USER_PLAYLISTS, (user_id,)).rowcount
+
+
+def apply_retention(conn):
+    """
+    Function to delete the index of the users who did not use the library search in the last retention_days days
+    :param conn: An open read-write connection, the caller commits the transaction
+    :return: Returns the number of users whose index was deleted
+    """
+    if retention_days is None:
+        return 0
+    cutoff = (datetime.utcnow() - timedelta(days=retention_days)).strftime('%Y-%m-%d %H:%M:%S')
+    expired = [row[0] for row in conn.execute(SELECT_EXPIRED_USERS, (cutoff,)).fetchall()]
+    for user_id in expired:
+        forget_user(conn, user_id)
+    return len(expired)
+
+
+def maybe_apply_retention(conn):
+    """
+    Function to apply the retention policy if it was not applied in the last RETENTION_INTERVAL seconds. It is called
+    by the library searches, so the policy is applied regularly without a separate scheduler.
+    :param conn: An open read-write connection, the caller commits the transaction
+    :return: Returns the number of users whose index was deleted (0 if the policy was not applied now)
+    """
+    global _last_retention
+    if time.monotonic() - _last_retention < RETENTION_INTERVAL:
+        return 0
+    _last_retention = time.monotonic()
+    return apply_retention(conn)
+
+
+def index_playlist(conn, user_id, playlist, tracks):
+    """
+    Function to (re)index a playlist of the user. The old tracks of the playlist are replaced.
+    :param conn: An open read-write connection, the caller commits the transaction
+    :param user_id: The ID of the user
+    :param playlist: The playlist as received from current_user_playlists (ID, name and snapshot ID are used)
+    :param tracks: The tracks of the playlist in their order, as returned by get_playlist_tracks
+    :return: Returns nothing
+    """
+    conn.execute(DELETE_PLAYLIST_TRACKS, (user_id, playlist['id']))
+    conn.executemany(INSERT_TRACK, (
+        (user_id, playlist['id'], position, track['id'], track['name'] or '', ', '.join(track['artist']),
+         track['album'] or '', json.dumps(track))
+        for position, track in enumerate(tracks)))
+    conn.execute(UPSERT_PLAYLIST, (user_id, playlist['id'], playlist['snapshot_id'], playlist.get('name') or '',
+                                   len(tracks)))
+
+
+def forget_playlist(conn, user_id, playlist_id):
+    """
+    Function to remove a playlist of the user from the index (e.g. the user unfollowed it)
+    :return: Returns nothing
+    """
+    conn.execute(DELETE_PLAYLIST_TRACKS, (user_id, playlist_id))
+    conn.execute(DELETE_PLAYLIST, (user_id, playlist_id))
+
+
+def remove_tracks(conn, user_id, playlist_id, track_ids, snapshot_id):
+    """
+    Function to apply a removal made on Spotify to the index, so the playlist does not need to be indexed again
+    :param track_ids: The IDs of the removed tracks (every occurrence was removed)
+    :param snapshot_id: The snapshot of the playlist after the removal
+    :return: Returns nothing
+    """
+    removed = 0
+    for track_id in track_ids:
+        removed += conn.execute(DELETE_TRACK, (user_id, playlist_id, track_id)).rowcount
+    conn.execute(UPDATE_SNAPSHOT, (snapshot_id, removed, user_id, playlist_id))
+
+
+def playlist_tracks(conn, user_id, playlist_id):
+    """
+    Function to read the tracks of an indexed playlist
+    :return: Returns the tracks in their order, like get_playlist_tracks
+    """
+    return [json.loads(row[0]) for row in conn.execute(SELECT_PLAYLIST_TRACKS, (user_id, playlist_id))]
+
+
+def playlist_track_names(conn, user_id, playlist_id):
+    """
+    Function to read the ID and the name of the tracks of an indexed playlist, without the rest of the details
+    :return: Returns the (track ID, name) pairs in the order of the playlist
+    """
+    return conn.execute(SELECT_TRACK_NAMES, (user_id, playlist_id)).fetchall()
+
+
+def search_tracks(conn, user_id, expression, playlist_id=None, limit=SEARCH_LIMIT):
+    """
+    Function to search the indexed tracks of the user
+    :param expression: The FTS5 query, see match_expression
+    :param playlist_id: Only this playlist is searched if it is given
+    :param limit: The maximum number of results
+    :return: Returns the list of matches, the best ones first. Every match has the track (like get_playlist_tracks)
+    and the ID and name of the playlist which contains it
+    """
+    sql = SEARCH_TRACKS.format(playlist_filter='AND t.playlist_id = ?' if playlist_id else '')
+    params = (expression, user_id, playlist_id, limit) if playlist_id else (expression, user_id, limit)
+    return [{'track': json.loads(details), 'playlist_id': pid, 'playlist_name': playlist_name}
+            for details, pid, playlist_name in conn.execute(sql, params)]
+
+
+def playlists_containing(conn, user_id, expression):
+    """
+    Function to find which playlists of the user contain a matching track
+    :param expression: The FTS5 query, see match_expression
+    :return: Returns the ID and name of the playlists and the number of matching tracks in them, the most first
+    """
+    return [{'id': playlist_id, 'name': name, 'matches': matches}
+            for playlist_id, name, matches in conn.execute(PLAYLISTS_CONTAINING, (expression, user_id))]
+
+
+class LibraryIndexer:
+    """
+    Class which indexes the playlists in the background. Only one job runs at a time and a user has at most one
+    waiting job, so searching the library many times does not queue the same work again. The Spotify calls of
+    the jobs have the background priority, the pages the users are waiting for are served first.
+    """
+
+    def __init__(self, enabled=True):
+        """
+        :param enabled: False runs nothing in the background (the index is then not filled)
+        """
+        self.enabled = enabled
+        self._executor = None
+        self._pending = set()  # The users who have a waiting or running job
+        self._lock = threading.Lock()
+        self.jobs = 0
+        self.failures = 0
+        self.seconds = 0.0
+
+    def schedule(self, user_id, job):
+        """
+        Function to run a job of a user in the background, unless the user already has one waiting
+        :param job: Function without parameters
+        :return: Returns the future of the job or None if it was not scheduled
+        """
+        with self._lock:
+            if not self.enabled or user_id in self._pending:
+                return None
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='library-indexer')
+            self._pending.add(user_id)
+            return self._executor.submit(self._run, user_id, job)
+
+    def _run(self, user_id, job):
+        started = time.monotonic()
+        try:
+            with priority(BACKGROUND):
+                return job()
+        except Exception as e:
+            self.failures += 1
+            logger.warning("Could not index the library of user %s: %s", user_id, e)
+        finally:
+            self.jobs += 1
+            self.seconds += time.monotonic() - started
+            with self._lock:
+                self._pending.discard(user_id)
+
+    def shutdown(self):
+        """
+        Function to stop the background thread after the running job
+        :return: Returns nothing
+        """
+        with self._lock:
+            executor, self._executor = self._executor, None
+            self._pending.clear()
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "available": available,
+                "enabled": self.enabled,
+                "pending_users": len(self._pending),
+                "jobs": self.jobs,
+                "failures": self.failures,
+                "seconds": round(self.seconds, 3),
+            }
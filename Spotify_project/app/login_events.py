@@ -0,0 +1,174 @@
+# Import necessary modules and functions
+import time
+from datetime import datetime, timedelta
+
+# Append-only log of every login. The user_logins table only keeps the last login of a user, this table keeps all of
+# them, so the number of logins in a week or month can be counted properly.
+CREATE_EVENTS_TABLE = '''
+    CREATE TABLE IF NOT EXISTS login_events (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,  -- IDs are never reused, the rollup job relies on it
+        user_id TEXT NOT NULL,
+        login_time TIMESTAMP NOT NULL,
+        sub_level TEXT NOT NULL,
+        country TEXT NOT NULL
+    )
+'''
+CREATE_EVENTS_INDEX = "CREATE INDEX IF NOT EXISTS idx_login_events_login_time ON login_events (login_time)"
+
+INSERT_EVENT = "INSERT INTO login_events (user_id, login_time, sub_level, country) VALUES (?, ?, ?, ?)"
+
+# The rollup tables and the format of their buckets (in local time, the same way as the statistics page)
+ROLLUPS = {
+    'hourly': '%Y-%m-%d %H',
+    'daily': '%Y-%m-%d',
+    'weekly': '%Y-%W',
+}
+
+CREATE_ROLLUP_TABLE = '''
+    CREATE TABLE IF NOT EXISTS login_rollups_{name} (
+        bucket TEXT PRIMARY KEY,
+        logins INTEGER NOT NULL DEFAULT 0
+    ) WITHOUT ROWID
+'''
+
+# Remembers the ID of the last event which is already counted in the rollups
+CREATE_STATE_TABLE = '''
+    CREATE TABLE IF NOT EXISTS login_rollup_state (
+        name TEXT PRIMARY KEY,
+        value INTEGER NOT NULL
+    )
+'''
+
+ROLLUP_EVENTS = '''
+    INSERT INTO login_rollups_{name} (bucket, logins)
+    SELECT strftime('{fmt}', login_time, 'localtime') AS bucket, COUNT(*) FROM login_events
+    WHERE id > ? AND id <= ? GROUP BY bucket
+    ON CONFLICT (bucket) DO UPDATE SET logins = logins + excluded.logins
+'''
+
+SELECT_LATEST_ROLLUP = "SELECT bucket, logins FROM login_rollups_{name} ORDER BY bucket DESC LIMIT 1"
+SUM_ROLLUP_PREFIX = "SELECT COALESCE(SUM(logins), 0) FROM login_rollups_{name} WHERE bucket >= ? AND bucket < ?"
+
+# How many days the raw events and the rollups are kept. None means forever. Can be changed with configure_retention
+retention_days = {
+    'events': 30,
+    'hourly': 14,
+    'daily': 400,
+    'weekly': None,
+}
+
+RETENTION_INTERVAL = 3600  # Seconds between two automatic runs of the retention policy
+_last_retention = time.monotonic()  # The first automatic run is one interval after the start
+
+
+def configure_retention(**days):
+    """
+    Function to change the retention policy, e.g. configure_retention(events=7, hourly=2)
+    :return: Returns nothing
+    """
+    for name, value in days.items():
+        if name not in retention_days:
+            raise ValueError(f"Unknown retention setting: {name}")
+        retention_days[name] = value
+
+
+def create_event_store(conn):
+    """
+    Function to create the event log, the rollup tables and the state of the rollup job
+    :param conn: An open read-write connection
+    :return: Returns nothing
+    """
+    conn.execute(CREATE_EVENTS_TABLE)
+    conn.execute(CREATE_EVENTS_INDEX)
+    for name in ROLLUPS:
+        conn.execute(CREATE_ROLLUP_TABLE.format(name=name))
+    conn.execute(CREATE_STATE_TABLE)
+
+
+def append_events(conn, records):
+    """
+    Function to append a batch of logins to the event log
+    :param conn: An open read-write connection, the caller commits the transaction
+    :param records: List of (user_id, login_time, sub_level, display_name, followers, country) login records
+    :return: Returns nothing
+    """
+    conn.executemany(INSERT_EVENT, ((r[0], r[1], r[2], r[5]) for r in records))
+
+
+def rollup_events(conn):
+    """
+    Function to compact the new raw events into the hourly, daily and weekly rollups. Only the events which arrived
+    since the last run are read (the ID range is a primary key range), so it is cheap to run after every batch.
+    :param conn: An open read-write connection, the caller commits the transaction
+    :return: Returns the number of events which were rolled up
+    """
+    row = conn.execute("SELECT value FROM login_rollup_state WHERE name='last_event_id'").fetchone()
+    last_id = row[0] if row else 0
+    max_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM login_events").fetchone()[0]
+    if max_id <= last_id:
+        return 0
+
+    for name, fmt in ROLLUPS.items():
+        conn.execute(ROLLUP_EVENTS.format(name=name, fmt=fmt), (last_id, max_id))
+    conn.execute("INSERT INTO login_rollup_state (name, value) VALUES ('last_event_id', ?) "
+                 "ON CONFLICT (name) DO UPDATE SET value=excluded.value", (max_id,))
+    return conn.execute("SELECT COUNT(*) FROM login_events WHERE id > ? AND id <= ?", (last_id, max_id)).fetchone()[0]
+
+
+def apply_retention(conn, now=None):
+    """
+    Function to delete the raw events and the rollup rows which are older than the retention policy allows. Raw
+    events are only deleted after they were rolled up.
+    :param conn: An open read-write connection, the caller commits the transaction
+    :param now: The current local time (for the tests)
+    :return: Returns the number of deleted raw events
+    """
+    rollup_events(conn)  # Making sure that nothing is deleted before it is counted
+    now = now or datetime.now()
+
+    deleted = 0
+    if retention_days['events'] is not None:
+        cutoff = datetime.utcnow() - timedelta(days=retention_days['events'])
+        deleted = conn.execute("DELETE FROM login_events WHERE login_time < ?",
+                               (cutoff.strftime('%Y-%m-%d %H:%M:%S'),)).rowcount
+
+    for name, fmt in ROLLUPS.items():
+        if retention_days[name] is not None:
+            cutoff = (now - timedelta(days=retention_days[name])).strftime(fmt)
+            conn.execute(f"DELETE FROM login_rollups_{name} WHERE bucket < ?", (cutoff,))
+    return deleted
+
+
+def maybe_apply_retention(conn):
+    """
+    Function to apply the retention policy if it was not applied in the last RETENTION_INTERVAL seconds. It is called
+    after the login batches are written, so the policy is applied regularly without a separate scheduler.
+    :param conn: An open read-write connection, the caller commits the transaction
+    :return: Returns the number of deleted raw events (0 if the policy was not applied now)
+    """
+    global _last_retention
+    if time.monotonic() - _last_retention < RETENTION_INTERVAL:
+        return 0
+    _last_retention = time.monotonic()
+    return apply_retention(conn)
+
+
+def read_latest_week(conn):
+    """
+    Function to read the number of logins in the latest week which has logins
+    :return: Returns the number of logins, 0 if there are none
+    """
+    row = conn.execute(SELECT_LATEST_ROLLUP.format(name='weekly')).fetchone()
+    return row[1] if row else 0
+
+
+def read_latest_month(conn):
+    """
+    Function to read the number of logins in the latest month which has logins, summed from the daily rollups
+    :return: Returns the number of logins, 0 if there are none
+    """
+    row = conn.execute(SELECT_LATEST_ROLLUP.format(name='daily')).fetchone()
+    if not row:
+        return 0
+    month = row[0][:7]  # 'YYYY-MM' of the latest day
+    return conn.execute(SUM_ROLLUP_PREFIX.format(name='daily'), (month, month + '~')).fetchone()[0]
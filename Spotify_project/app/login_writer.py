@@ -0,0 +1,163 @@
+# Import necessary modules and functions
+import logging
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+_WAKE_UP = object()  # Put into the queue by stop(), so the worker does not wait for the end of the flush interval
+
+
+class LoginWriter:
+    """
+    Class which writes the login records in the background (write-behind). The request thread only puts the record
+    into a bounded queue, a worker thread collects the records, keeps only the latest one for every user and writes
+    them to the database in one batch, either when the batch is big enough or when the flush interval is over. Every
+    record is also kept in arrival order, so the login event log receives all logins, not only the latest ones.
+    """
+
+    def __init__(self, write_batch, flush_interval=0.5, batch_size=100, max_queue_size=10000):
+        """
+        :param write_batch: The function which writes the batch to the database in one transaction. It receives the
+        coalesced records (one per user) and every record in arrival order
+        :param flush_interval: The maximum number of seconds a record waits in memory before it is written
+        :param batch_size: The number of distinct users after which the batch is written immediately
+        :param max_queue_size: The size of the queue. If it is full, submit() refuses the record (backpressure)
+        """
+        self.write_batch = write_batch
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+
+    def configure(self, flush_interval=None, batch_size=None, max_queue_size=None):
+        """
+        Function to change the settings of the writer. The queue size can only be changed before the writer started.
+        :return: Returns nothing
+        """
+        if flush_interval is not None:
+            self.flush_interval = flush_interval
+        if batch_size is not None:
+            self.batch_size = batch_size
+        if max_queue_size is not None and not self.is_running():
+            self._queue = queue.Queue(maxsize=max_queue_size)
+
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        """
+        Function to start the worker thread. Calling it again while the thread is running does nothing.
+        :return: Returns nothing
+        """
+        with self._lock:
+            if self.is_running():
+                return
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run, name='login-writer', daemon=True)
+            self._thread.start()
+
+    def submit(self, record):
+        """
+        Function to hand over a login record to the writer
+        :param record: The login record, its first element is the user's ID
+        :return: Returns True if the record was queued and False if the queue is full or the writer is stopping. In
+        that case the caller has to write the record itself.
+        """
+        if self._stopping.is_set():
+            return False
+        self.start()
+        try:
+            self._queue.put_nowait(record)
+            return True
+        except queue.Full:
+            return False
+
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def stop(self, timeout=5.0):
+        """
+        Function to stop the worker thread gracefully. Every record that is still in the queue is written first.
+        :param timeout: The maximum number of seconds to wait for the final flush
+        :return: Returns nothing
+        """
+        self._stopping.set()
+        thread = self._thread
+        if thread is not None and thread.is_alive():
+            try:
+                self._queue.put_nowait(_WAKE_UP)
+            except queue.Full:
+                pass  # The worker is busy with a full queue, it notices the stop flag after the current batch
+            thread.join(timeout)
+            if thread.is_alive():
+                # The worker is still writing, it flushes the rest itself. Flushing here as well would write the same
+                # records from two threads at the same time
+                logger.warning("The login writer did not stop in %s seconds, the worker writes the remaining records",
+                               timeout)
+                return
+
+        # Records which were queued while the thread was finishing are written here
+        self._flush_remaining({}, [])
+
+    def _add(self, pending, events, record):
+        pending[record[0]] = record
+        events.append(record)
+        if len(events) > self._queue.maxsize > 0:
+            # The database is failing for a long time, the oldest events are dropped instead of using up the memory
+            logger.warning("Dropping %d login events", len(events) - self._queue.maxsize)
+            del events[:len(events) - self._queue.maxsize]
+
+    def _drain(self, pending, events, timeout):
+        """
+        Function to move the records from the queue into the pending dictionary. Repeated logins of the same user are
+        coalesced, only the latest record is kept.
+        """
+        try:
+            record = self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return
+        while record is not _WAKE_UP:
+            self._add(pending, events, record)
+            if len(pending) >= self.batch_size:
+                break
+            try:
+                record = self._queue.get_nowait()
+            except queue.Empty:
+                break
+
+    def _flush(self, pending, events):
+        if not pending:
+            return
+        try:
+            self.write_batch(list(pending.values()), list(events))
+            pending.clear()
+            events.clear()
+        except Exception:
+            # The records stay in memory, so they are written with the next batch
+            logger.exception("Failed to write %d login records, retrying with the next batch", len(pending))
+
+    def _run(self):
+        pending, events = {}, []
+        deadline = time.monotonic() + self.flush_interval
+        while not self._stopping.is_set():
+            self._drain(pending, events, timeout=max(0.0, min(deadline - time.monotonic(), self.flush_interval)))
+            if len(pending) >= self.batch_size or time.monotonic() >= deadline:
+                self._flush(pending, events)
+                deadline = time.monotonic() + self.flush_interval
+
+        # Graceful shutdown: writing everything that arrived before stop() was called
+        self._flush_remaining(pending, events)
+
+    def _flush_remaining(self, pending, events):
+        while True:
+            try:
+                record = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if record is not _WAKE_UP:
+                self._add(pending, events, record)
+        self._flush(pending, events)
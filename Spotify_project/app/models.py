@@ -1,131 +1,327 @@
 
 # Import necessary modules and functions
-import sqlite3
+import asyncio
+import logging
+import unicodedata
+from collections import deque
+from concurrent.futures import wait
 from datetime import datetime, timezone, timedelta
-import spotipy
+from flask import current_app, has_app_context, has_request_context, session
 from app.auth import get_token
-import os
-
-def initialize_database(db_path=None):
+from app import database, stats, login_events, library_index
+from app.login_writer import LoginWriter
+from app.library_index import LibraryIndexer
+from app.cache import TTLCache, CatalogCache, FollowedArtistsCache, SingleFlight
+from app.spotify_client import spotify_clients, spotify_calls
+from app.request_memo import memoize
+from app.async_spotify import AsyncSpotify, run
+from app.rate_limit import priority, BACKGROUND
+import atexit
+
+logger = logging.getLogger(__name__)
+
+# Secondary indexes of the user_logins table. The id is part of the login time index, so rows with the same login time
+# are still in a well-defined order. The followers are part of the subscription level index, so both the grouping and
+# the followers statistics can be answered from the index alone
+USER_LOGINS_INDEXES = (
+    "CREATE INDEX IF NOT EXISTS idx_user_logins_last_login ON user_logins (last_login_time, id)",
+    "DROP INDEX IF EXISTS idx_user_logins_country",  # Replaced by the index below, which also serves the pagination
+    "CREATE INDEX IF NOT EXISTS idx_user_logins_country_login ON user_logins (country, last_login_time, id)",
+    "CREATE INDEX IF NOT EXISTS idx_user_logins_sub_level ON user_logins (sub_level, followers)",
+)
+
+# Queries of the user_logins table, kept in one place so the query plan tests can check every one of them
+SELECT_USER_LOGINS = "SELECT id, last_login_time, user_id, strftime('%Y-%m-%d %H:%M:%S', last_login_time, 'localtime') AS local_time, sub_level, display_name, followers, country FROM user_logins"
+COUNT_INACTIVE_USERS = "SELECT COUNT(*) FROM user_logins WHERE last_login_time < ?"
+
+def initialize_database(db_path=None, backend=None):
     """
     Function to initialize the SQLite database if not exists. This is the database part of the assignment.
+    :param db_path: The path of the database file (or the name of the in-memory database). If it is not given, the
+    default production path is used. The connection manager is pointed to this database, so every other function uses
+    the same one.
+    :param backend: The storage backend, 'file' or 'memory' (see database.BACKENDS). Detected from db_path if missing
     :return: Returns True
     """
-    if db_path is None:
-        # Default path for production --> had to use full path to work without errors, should work on every computer
-        db_path = '\\'.join(os.path.dirname(__file__).split('\\')[0:-1]) + "\\instance\\spotify.db"
-
-    # Ensure directory exists
-    os.makedirs(os.path.dirname(db_path), exist_ok=True)
-
-    conn = sqlite3.connect(db_path)  # Connecting to SQLite database
-    c = conn.cursor()
-
-    # Creating user_logins table if it doesn't exist
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS user_logins (
-            id INTEGER PRIMARY KEY,
-            user_id TEXT UNIQUE NOT NULL,
-            last_login_time TIMESTAMP DEFAULT (strftime('%Y-%m-%d %H:%M:%S', 'now', 'utc')),
-            sub_level TEXT NOT NULL,
-            display_name TEXT NOT NULL,
-            followers INTEGER NOT NULL,
-            country TEXT NOT NULL
-        )
-    ''')
-    conn.commit()  # Committing the transaction
-    conn.close()  # Closing the database connection
+    database.configure(db_path, backend)  # Resolving the location once, the connection manager reuses it
+
+    with database.connection() as conn:  # Borrowing a pooled connection, the transaction is committed at the end
+        c = conn.cursor()
+
+        # Creating user_logins table if it doesn't exist
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS user_logins (
+                id INTEGER PRIMARY KEY,
+                user_id TEXT UNIQUE NOT NULL,
+                last_login_time TIMESTAMP DEFAULT (strftime('%Y-%m-%d %H:%M:%S', 'now', 'utc')),
+                sub_level TEXT NOT NULL,
+                display_name TEXT NOT NULL,
+                followers INTEGER NOT NULL,
+                country TEXT NOT NULL
+            )
+        ''')
+
+        # Creating the indexes for the access paths of the queries below (sorting and range filtering on the login
+        # time, grouping by country and subscription level)
+        for index in USER_LOGINS_INDEXES:
+            c.execute(index)
+
+        # Creating the materialized statistics, which are kept up to date by triggers on every write
+        stats.create_stats_store(conn)
+
+        # Creating the log of every login and its hourly, daily and weekly rollups
+        login_events.create_event_store(conn)
+
+        # Creating the local index of the tracks in the users' playlists (full-text search if SQLite supports it)
+        library_index.create_library_index(conn)
+
+    query_cache.invalidate()  # The cached results may belong to another database
     return True
 
+def rebuild_user_stats():
+    """
+    Function to recompute the materialized statistics from the user_logins table
+    :return: Returns the number of users counted
+    """
+    with database.connection() as conn:
+        total_users = stats.rebuild_stats(conn)
+    query_cache.invalidate()
+    return total_users
+
+# Cache of the results of get_user_stats and get_user_logins. The data only changes when somebody logs in, so the
+# cache is invalidated by every write and the TTL only matters for changes made outside this process
+query_cache = TTLCache(ttl=30.0)
+
+def get_query_cache_stats():
+    """
+    Function to get the hit/miss counters of the query cache
+    :return: Returns the counters
+    """
+    return query_cache.stats()
+
+# Upsert used for writing the login records, one statement for both new and returning users
+UPSERT_USER_LOGIN = """
+    INSERT INTO user_logins (user_id, last_login_time, sub_level, display_name, followers, country)
+    VALUES (?, ?, ?, ?, ?, ?)
+    ON CONFLICT(user_id) DO UPDATE SET
+        last_login_time=excluded.last_login_time, sub_level=excluded.sub_level,
+        display_name=excluded.display_name, followers=excluded.followers, country=excluded.country
+"""
+
+def write_user_logins(records, events=None):
+    """
+    Function to write a batch of login records into the database in one transaction. The last login of every user is
+    updated, every login is appended to the event log and the new events are rolled up.
+    :param records: List of (user_id, last_login_time, sub_level, display_name, followers, country) tuples, at most
+    one for every user
+    :param events: Every login in arrival order (same tuples). If it is not given, the records are the events
+    :return: Returns the number of written records
+    """
+    with database.connection() as conn:  # Pooled writer connection, committed when the block ends
+        conn.executemany(UPSERT_USER_LOGIN, records)
+        login_events.append_events(conn, records if events is None else events)
+        login_events.rollup_events(conn)  # Only the events of this batch are read
+        login_events.maybe_apply_retention(conn)
+    query_cache.invalidate()  # The cached pages are out of date after the commit
+    return len(records)
+
+def rollup_login_events():
+    """
+    Function to roll up the new login events and apply the retention policy
+    :return: Returns the number of deleted raw events
+    """
+    with database.connection() as conn:
+        deleted = login_events.apply_retention(conn)
+    query_cache.invalidate()
+    return deleted
+
+# Background writer of the login records, the request thread only puts the record into its queue
+login_writer = LoginWriter(write_user_logins)
+atexit.register(login_writer.stop)  # Writing the queued records when the application stops
+
 def log_user_login(spotify):
     """
-    Function to log user login details into the SQLite database
+    Function to log user login details into the SQLite database. Inside the Flask application (if the
+    LOGIN_WRITER_ENABLED setting is on) the record is handed over to the background writer, so the login does not wait
+    for the disk. Otherwise, or if the writer's queue is full, the record is written immediately.
     :param spotify: the spotify instance
     :return: True
     """
 
-    # Fetching current user data from Spotify API
-    conn = sqlite3.connect('instance/spotify.db')
-    c = conn.cursor()
-    user_data = spotify.current_user()
+    # Fetching current user data from Spotify API (only once per request)
+    user_data = get_current_user_profile(spotify)
     user_id = user_data['id']
     sub_level = user_data['product']
     display_name = user_data['display_name']
     followers = int(user_data['followers']['total'])
     country = user_data['country']
 
-    # Checking if the user already exists in the database
-    c.execute("SELECT COUNT(*) FROM user_logins WHERE user_id=?", (user_id,))
-    existing_user = c.fetchone()[0]
-
     # Getting current UTC time as last login time
     last_login_time_utc = datetime.utcnow().replace(tzinfo=timezone.utc).replace(microsecond=0)
 
-    # Inserting or updating user login details based on existences
-    if existing_user == 0:
-        c.execute(
-            "INSERT INTO user_logins (user_id, last_login_time, sub_level, display_name, followers, country) VALUES (?, ?, ?, ?, ?, ?)",
-            (user_id, last_login_time_utc, sub_level, display_name, followers, country))
-    else:
-        c.execute(
-            "UPDATE user_logins SET last_login_time=?, sub_level=?, display_name=?, followers=?, country=? WHERE user_id=?",
-            (last_login_time_utc, sub_level, display_name, followers, country, user_id))
-    conn.commit()
-    conn.close()
+    record = (user_id, last_login_time_utc, sub_level, display_name, followers, country)
+
+    # Handing over the record to the background writer, if it is enabled for the running application
+    if has_app_context() and current_app.config.get('LOGIN_WRITER_ENABLED'):
+        if login_writer.submit(record):
+            return True
+
+    write_user_logins([record])  # Writing the record on the current thread
     return True
 
-def get_user_logins():
+def user_logins_query(cursor=None, limit=None, country=None, sub_level=None):
     """
-    Function to fetch user login details from the SQLite database
-    :return: Returns the login details that was collected from the database
+    Function to build the query of the user logins page. The pagination is keyset based: the cursor is the
+    (last_login_time, id) pair of the last row of the previous page, so every page is read directly from the index,
+    no matter how deep the user paged.
+    :param cursor: The cursor received from the previous page or None for the first page
+    :param limit: The maximum number of rows or None for every row
+    :param country: Only users from this country are listed if it is given
+    :param sub_level: Only users with this subscription level are listed if it is given
+    :return: Returns the SQL query and its parameters
     """
-    conn = sqlite3.connect('instance/spotify.db')
-    c = conn.cursor()
-
-    # Fetching user login details sorted by last login time descending
-    c.execute("SELECT user_id, strftime('%Y-%m-%d %H:%M:%S', last_login_time, 'localtime') AS local_time, sub_level, display_name, followers, country FROM user_logins ORDER BY last_login_time DESC")
-    user_logins = c.fetchall()
-    conn.close()
-    return user_logins
-
-def get_user_stats():
+    conditions, params = [], []
+    if country:
+        conditions.append("country=?")
+        params.append(country)
+    if sub_level:
+        conditions.append("sub_level=?")
+        params.append(sub_level)
+    if cursor:
+        last_id, last_login_time = decode_cursor(cursor)
+        conditions.append("(last_login_time, id) < (?, ?)")
+        params.extend([last_login_time, last_id])
+
+    sql = SELECT_USER_LOGINS
+    if conditions:
+        sql += " WHERE " + " AND ".join(conditions)
+    sql += " ORDER BY last_login_time DESC, id DESC"
+    if limit is not None:
+        sql += " LIMIT ?"
+        params.append(limit)
+    return sql, tuple(params)
+
+def encode_cursor(row_id, last_login_time):
     """
-    Function to retrieve various statistics from the user_logins table
-    :return: Returns the calculated statistics
+    Function to create the cursor of the next page from the last row of the current page
+    :return: Returns the cursor as a string, which can be put into the URL
     """
-    conn = sqlite3.connect('instance/spotify.db')
-    c = conn.cursor()
-
-    # Fetching count of users per subscription level
-    c.execute("SELECT sub_level, COUNT(*) FROM user_logins GROUP BY sub_level")
-    sub_level_counts = c.fetchall()
-    total_users = sum(count for _, count in sub_level_counts)
-    premium_users = sum(count for sub_level, count in sub_level_counts if sub_level == "premium")
-    premium_percentage = (premium_users / total_users)*100 if total_users > 0 else 0
+    return f"{row_id}:{last_login_time}"
 
-    # Calculating average number of followers
-    c.execute("SELECT AVG(followers) FROM user_logins")
-    avg_followers = c.fetchone()[0]
+def decode_cursor(cursor):
+    """
+    Function to read the cursor received from the URL
+    :return: Returns the (id, last_login_time) pair. Raises ValueError if the cursor is invalid
+    """
+    row_id, _, last_login_time = cursor.partition(':')
+    if not last_login_time:
+        raise ValueError(f"Invalid cursor: {cursor}")
+    return int(row_id), last_login_time
 
-    # Finding the most common country among users
-    c.execute("SELECT country, COUNT(*) FROM user_logins GROUP BY country ORDER BY COUNT(*) DESC LIMIT 1")
-    most_common_country = c.fetchone()[0]
+class UserLoginsPage:
+    """
+    Class which streams one page of the user logins. The rows are read from the database in small chunks while the
+    page is iterated, so the memory usage does not depend on the size of the page or of the table. After the
+    iteration, next_cursor holds the cursor of the next page (None if this was the last page).
+    """
+    FETCH_CHUNK = 200  # Number of rows read from the database at once
+
+    def __init__(self, cursor=None, limit=None, country=None, sub_level=None):
+        self.cursor = cursor
+        self.limit = limit
+        self.country = country
+        self.sub_level = sub_level
+        self.next_cursor = None
+
+    def __iter__(self):
+        # Asking for one more row than the limit to know if there is a next page
+        limit = self.limit + 1 if self.limit is not None else None
+        sql, params = user_logins_query(self.cursor, limit, self.country, self.sub_level)
+        with database.read_connection() as conn:  # Pooled read-only connection, released when the stream ends
+            c = conn.execute(sql, params)
+            count = 0
+            last_key = None
+            while True:
+                rows = c.fetchmany(self.FETCH_CHUNK)
+                if not rows:
+                    break
+                for row in rows:
+                    if self.limit is not None and count == self.limit:
+                        self.next_cursor = encode_cursor(*last_key)  # There is at least one more row
+                        return
+                    count += 1
+                    last_key = (row[0], row[1])
+                    yield row[2:]  # The id and the raw login time are only needed for the cursor
+
+class ReadUserLoginsPage(list):
+    """
+    Class of a page of the user logins which was read into a list, so it can be cached. It has the next_cursor of the
+    page like UserLoginsPage.
+    """
 
-    # Fetching weekly logins
-    c.execute("SELECT strftime('%Y-%W', last_login_time, 'localtime') AS login_week, COUNT(*) FROM user_logins GROUP BY login_week ORDER BY login_week DESC")
-    weekly_logins = c.fetchall()
+    def __init__(self, page):
+        super().__init__(page)  # Reading every row of the page sets its next_cursor
+        self.next_cursor = page.next_cursor
 
-    # Fetching monthly logins
-    c.execute("SELECT strftime('%Y-%m', last_login_time, 'localtime') AS login_month, COUNT(*) FROM user_logins GROUP BY login_month ORDER BY login_month DESC")
-    monthly_logins = c.fetchall()
+def get_user_logins(cursor=None, limit=None, country=None, sub_level=None, stream=False):
+    """
+    Function to fetch user login details from the SQLite database, sorted by the last login time descending. A page
+    with a limit is cached (see query_cache), so loading the same page again does not read the database.
+    :param cursor: The cursor of the page (see UserLoginsPage), None for the first page
+    :param limit: The size of the page, None for every row
+    :param country: Filter for the country of the users (optional)
+    :param sub_level: Filter for the subscription level of the users (optional)
+    :param stream: If True and there is no limit, the rows are not collected into a list, but a UserLoginsPage is
+    returned which reads them while it is iterated. A page with a limit is small, it is always read into a list
+    :return: Returns the login details that was collected from the database
+    """
+    page = UserLoginsPage(cursor=cursor, limit=limit, country=country, sub_level=sub_level)
+    if stream and limit is None:
+        return page  # Every row is read while it is iterated, it is too large to be cached
+    return query_cache.get_or_compute(('user_logins', cursor, limit, country, sub_level),
+                                      lambda: ReadUserLoginsPage(page))
 
-    # Calculating count of inactive users (not logged in within the last 10 days)
-    days_threshold = 10
-    threshold_date = datetime.utcnow().date() - timedelta(days=days_threshold)
-    c.execute("SELECT COUNT(*) FROM user_logins WHERE last_login_time < ?", (threshold_date,))
-    inactive_users_count = c.fetchone()[0]
+def get_user_stats():
+    """
+    Function to retrieve various statistics about the users. Apart from the inactive users, everything is read from
+    the materialized counters, which are updated on every write, so the cost does not depend on the number of users.
+    The result is cached until the next login (or for the TTL of the query cache).
+    :return: Returns the calculated statistics
+    """
+    return query_cache.get_or_compute('user_stats', _compute_user_stats)
 
-    conn.close()
+def _compute_user_stats():
+    """
+    Function to compute the statistics for get_user_stats (without the cache)
+    :return: Returns the calculated statistics
+    """
+    with database.read_connection() as conn:  # Pooled read-only connection, separate from the writers
+        # Count of users and count of premium users
+        total_users = stats.read_counter(conn, 'users', 'total')
+        premium_users = stats.read_counter(conn, 'sub_level', 'premium')
+        premium_percentage = (premium_users / total_users)*100 if total_users > 0 else 0
+
+        # Calculating average number of followers
+        followers_sum = stats.read_counter(conn, 'followers', 'sum')
+        avg_followers = followers_sum / total_users if total_users > 0 else 0
+
+        # Finding the most common country among users
+        most_common_country = stats.read_top_bucket(conn, 'country')
+
+        # Users who logged in in the latest week and month
+        weekly_logins = stats.read_latest_bucket(conn, 'week')
+        monthly_logins = stats.read_latest_bucket(conn, 'month')
+
+        # Every login (also the repeated ones) in the latest week and month, read from the rollups of the event log
+        weekly_login_events = login_events.read_latest_week(conn)
+        monthly_login_events = login_events.read_latest_month(conn)
+
+        # Calculating count of inactive users (not logged in within the last 10 days)
+        days_threshold = 10
+        threshold_date = datetime.utcnow().date() - timedelta(days=days_threshold)
+        c = conn.cursor()
+        c.execute(COUNT_INACTIVE_USERS, (threshold_date,))
+        inactive_users_count = c.fetchone()[0]
 
     # Returning the calculated statistics and formatting them
     return {
@@ -134,11 +330,78 @@ def get_user_stats():
         "premium_percentage": f"{premium_percentage:.3f}",
         "avg_followers": f"{avg_followers:.3f}",
         "most_common_country": most_common_country,
-        "weekly_logins": weekly_logins[0][1],
-        "monthly_logins": monthly_logins[0][1],
+        "weekly_logins": weekly_logins,
+        "monthly_logins": monthly_logins,
+        "weekly_login_events": weekly_login_events,
+        "monthly_login_events": monthly_login_events,
         "inactive_users_count": inactive_users_count
     }
 
+# Number of seconds the catalog responses of Spotify are cached, by endpoint. Artists and albums rarely change, the
+# playlists are edited by their owners, so they are only kept for a short time
+CATALOG_CACHE_TTLS = {
+    'search': 300,
+    'artist': 3600,
+    'artist_albums': 3600,
+    'artist_top_tracks': 1800,
+    'artist_related_artists': 21600,
+    'playlist': 120,
+    'current_user_playlists': 300,
+    'track_resolution': 3600,
+    'typeahead': 600,
+}
+catalog_cache = CatalogCache(ttls=CATALOG_CACHE_TTLS)
+followed_artists = FollowedArtistsCache()  # The artists followed by each user, updated by follow and unfollow
+search_flights = SingleFlight()  # Identical searches running at the same time share one Spotify call
+library_indexer = LibraryIndexer()  # Indexes the playlists of the users in the background
+atexit.register(library_indexer.shutdown)
+
+def current_user_id():
+    """
+    Function to get the ID of the logged in user, which is the scope of the user's own cache entries
+    :return: Returns the ID or None outside of a request
+    """
+    return session.get('user_id') if has_request_context() else None
+
+def get_spotify_client():
+    """
+    Function to get the Spotify client of the current user. The clients share one pool of keep-alive connections
+    (see SpotifyClientFactory), so the calls of a page reuse the same warm connections.
+    :return: Returns the Spotify client
+    """
+    return memoize('spotify_client', lambda: spotify_clients.get(get_token()["access_token"]))
+
+def get_current_user_profile(spotify=None):
+    """
+    Function to get the profile of the current user (/v1/me). A page often needs it more than once (e.g. the display
+    name and the ID), it is fetched only once per request.
+    :param spotify: The Spotify client to use. If it is not given, the client of the current user is used
+    :return: Returns the profile as received from Spotify
+    """
+    return memoize('current_user', lambda: (spotify or get_spotify_client()).current_user())
+
+def current_market():
+    """
+    Function to get the market (country) of the current user. Spotify decides the availability of the tracks and
+    albums by the market, so the catalog calls pass it explicitly and it is part of the key of their shared cache
+    entries, a user never gets the results of another market. It is read from the profile once and kept in the session.
+    :return: Returns the country code or None outside of a request (or if the profile does not have it)
+    """
+    if not has_request_context():
+        return None
+    if 'market' not in session:
+        country = get_current_user_profile().get('country')
+        session['market'] = country if isinstance(country, str) else None
+    return session['market']
+
+def market_params(name='market'):
+    """
+    Function to get the market parameter of a catalog call (artist_top_tracks and artist_albums call it 'country')
+    :return: Returns a dictionary with the market of the current user, empty if it is not known
+    """
+    market = current_market()
+    return {name: market} if market else {}
+
 def search_spotify(query, search_type):
     """
     Function to perform different search queries in spotify. This allows the user to search for artists, tracks, albums,
@@ -148,72 +411,123 @@ def search_spotify(query, search_type):
     :param search_type: The chosen search type, which has to be set for relevant search results.
     :return: Returns the results of the search.
     """
-    token_info = get_token()
-    spotify = spotipy.Spotify(auth=token_info["access_token"])
+    spotify = get_spotify_client()
+    market = market_params()
+
+    # The search results are catalog data, the same for every user of a market, so they are cached and shared (the
+    # market is one of the parameters, so it is part of the key)
+    def search(**params):
+        params.update(market)
+        return catalog_cache.get_or_fetch('search', tuple(sorted(params.items())), lambda: spotify.search(**params))
 
     # Performing search based on search type (artist, track, album, playlist, show, episode)
     if search_type == 'artist':
-        results = spotify.search(q=query, type='artist', limit=10)
+        results = search(q=query, type='artist', limit=10)
         items = results['artists']['items']
     elif search_type == 'track':
-        results = spotify.search(q=query, type='track', limit=50)
-        items = results['tracks']['items']
-
-        # Filtering tracks based on query and sorting them by popularity
-        filtered_items = [item for item in items if query.lower() in item['name'].lower() or
-                          item['name'].lower().startswith(query.lower())]
-        filtered_items.sort(key=lambda x: x["popularity"], reverse=True)
-
-        # Removing possible duplicates
-        seen_names = set()
-        unique_items = []
-        for item in filtered_items:
-            if item['name'] not in seen_names:
-                unique_items.append(item)
-                seen_names.add(item['name'])
-                if len(unique_items) == 10:
-                    break
-        items = unique_items[:11]
+        # Filtering tracks based on query, sorting them by popularity and removing possible duplicates
+        items = fill_search(search, query, 'track', sort_key=lambda item: item.get('popularity', 0))
     elif search_type == 'album':
-        results = spotify.search(q=query, type='album')
-        items = results['albums']['items']
-
-        # Filtering albums based on query
-        filtered = [item for item in items if query.lower() in item['name'].lower() or
-                    item['name'].lower().startswith(query.lower())]
-
-        # Removing possible duplicates until there are 10 items
-        seen_albums = set()
-        unique_albums = []
-        for item in filtered:
-            if item['name'] not in seen_albums:
-                unique_albums.append(item)
-                seen_albums.add(item['name'])
-                if len(unique_albums) == 10:
-                    break
-        items = unique_albums[:11]
+        # Filtering albums based on query and removing possible duplicates until there are 10 items
+        items = fill_search(search, query, 'album')
     elif search_type == 'playlist':
-        results = spotify.search(q=query, type='playlist')
+        results = search(q=query, type='playlist')
         items = results['playlists']['items']
     elif search_type == 'show':
-        results = spotify.search(q=query, type='show')
+        results = search(q=query, type='show')
         items = results['shows']['items']
     elif search_type == 'episode':
-        results = spotify.search(q=query, type='episode')
+        results = search(q=query, type='episode')
         items = results['episodes']['items']
     else:
         items = []  # Default case where no valid search type is provided
     return items  # Returning the search results
 
+SEARCH_RESULTS = 10  # The number of results a filtered search tries to fill
+SEARCH_PAGE_SIZE = 50  # The largest page of the search endpoint
+SEARCH_MAX_OFFSET = 1000  # Spotify does not return search results after this offset
+SEARCH_MAX_CALLS = 4  # The most Spotify calls a filtered search makes
+
+def fold_text(text):
+    """
+    Function to compare texts regardless of case and accents, e.g. 'Beyoncé' and 'BEYONCE' both become 'beyonce'
+    :return: Returns the folded text with single spaces
+    """
+    decomposed = unicodedata.normalize('NFKD', (text or '').casefold())
+    return ' '.join(''.join(char for char in decomposed if not unicodedata.combining(char)).split())
+
+def result_key(item):
+    """
+    Function to get the key of a search result for removing the duplicates, e.g. the same song on a single and on an
+    album: the folded name and the folded names of the artists
+    """
+    return fold_text(item['name']), tuple(sorted(fold_text(artist['name']) for artist in item.get('artists') or []))
+
+def fill_search(search, query, search_type, sort_key=None, target=SEARCH_RESULTS, max_calls=SEARCH_MAX_CALLS):
+    """
+    Function to search for items whose name contains the query, until there are `target` different ones. Spotify also
+    returns loosely related items, so one page is often not enough after the filtering. The next pages are fetched
+    concurrently (at most page_parallelism at a time) only while results are missing and never more than max_calls
+    calls in total.
+    :param search: Function which calls (or reads from the cache) the search endpoint with the given parameters
+    :param query: The search query
+    :param search_type: 'track' or 'album'
+    :param sort_key: Function to sort the results by, in decreasing order (e.g. the popularity). None keeps the order of
+    Spotify
+    :param target: The number of results to fill
+    :param max_calls: The maximum number of search calls
+    :return: Returns the list of at most `target` different matching items
+    """
+    needle = fold_text(query)  # The query is normalized only once
+    key = search_type + 's'
+    matching = []
+    seen = set()
+
+    def collect(page):
+        for item in page['items']:
+            if item and needle in fold_text(item['name']):
+                matching.append(item)
+                seen.add(result_key(item))
+
+    page = search(q=query, type=search_type, limit=SEARCH_PAGE_SIZE)[key]
+    collect(page)
+    calls = 1
+    total = page.get('total')
+    available = min(total, SEARCH_MAX_OFFSET) if isinstance(total, int) else 0
+    offset = len(page['items'])
+
+    while len(seen) < target and offset < available and calls < max_calls:
+        offsets = list(range(offset, available, SEARCH_PAGE_SIZE))[:min(max_calls - calls, spotify_calls.page_parallelism)]
+        futures = [spotify_calls.submit(spotify_calls.call_with_backoff, search, q=query, type=search_type,
+                                        limit=SEARCH_PAGE_SIZE, offset=page_offset) for page_offset in offsets]
+        for future in futures:  # In the order of the pages
+            collect(future.result()[key])
+        calls += len(offsets)
+        offset = offsets[-1] + SEARCH_PAGE_SIZE
+
+    if sort_key is not None:
+        matching.sort(key=sort_key, reverse=True)  # Stable, so the most relevant one of equal items is kept first
+
+    # Removing possible duplicates
+    results = []
+    kept = set()
+    for item in matching:
+        item_key = result_key(item)
+        if item_key not in kept:
+            results.append(item)
+            kept.add(item_key)
+            if len(results) == target:
+                break
+    return results
+
 def display_current_user():
     """
     Function to get the current user's data and display it
     :return: Returns the extracted information about the user
     """
-    token_info = get_token()
-    spotify = spotipy.Spotify(auth=token_info["access_token"])
+    spotify = get_spotify_client()
 
-    user_info = spotify.current_user()  # Fetching current user information from Spotify
+    user_info = get_current_user_profile(spotify)  # Fetching current user information from Spotify
 
     user_data = {
         "display_name": user_info["display_name"],
@@ -229,14 +543,21 @@ def display_current_user():
 
 def get_top_items():
     """
-    Function to get the current user's top items, which are the top tracks and top artists
+    Function to get the current user's top items, which are the top tracks and top artists (synchronous facade of
+    get_top_items_async)
     :return: Returns information about the top tracks and artists
     """
-    token_info = get_token()
-    spotify = spotipy.Spotify(auth=token_info["access_token"])
+    return run(get_top_items_async(AsyncSpotify(get_spotify_client())))
 
-    top_tracks = spotify.current_user_top_tracks(limit=10)  # Fetching the top 10 tracks for current user
-    top_artists = spotify.current_user_top_artists(limit=10)  # Fetching the top 10 artists for current user
+async def get_top_items_async(spotify):
+    """
+    Coroutine to get the current user's top items. The top tracks and the top artists are fetched at the same time.
+    :param spotify: The AsyncSpotify client of the user
+    :return: Returns information about the top tracks and artists
+    """
+    # Fetching the top 10 tracks and the top 10 artists for current user
+    top_tracks, top_artists = await asyncio.gather(spotify.current_user_top_tracks(limit=10),
+                                                   spotify.current_user_top_artists(limit=10))
 
     # Extracting relevant information from top tracks and top artists
     tracks_info = [
@@ -272,29 +593,67 @@ def get_specific_artist(artist_name):
     artist = search_spotify(artist_name, 'artist')  # Searching for the artist
 
     if artist:
-        token_info = get_token()
-        spotify = spotipy.Spotify(auth=token_info["access_token"])
+        spotify = get_spotify_client()
 
         first_result = artist[0]  # Assuming first search result is the desired artist
         artist_id = first_result['id']
 
-        # Fetching detailed information about the artist, their albums, top tracks, and related artists
-        artist_details = spotify.artist(artist_id)
-        artist_albums = spotify.artist_albums(artist_id)
-        artist_top_tracks = spotify.artist_top_tracks(artist_id)
-        artist_related_artists = spotify.artist_related_artists(artist_id)
-        return artist_details, artist_albums, artist_top_tracks, artist_related_artists
+        # Fetching detailed information about the artist, their albums, top tracks, and related artists. The four
+        # calls are independent, so they run at the same time on the call pool (and they are cached, these are shared
+        # catalog data). A call which fails or is too slow is left out of the page instead of failing it. The albums
+        # and the top tracks depend on the market of the user, they are cached per market.
+        country = market_params('country')
+
+        def fetch(endpoint, call, **params):
+            args = (artist_id,) + tuple(params.values())
+            return lambda: catalog_cache.get_or_fetch(endpoint, args, lambda: call(artist_id, **params))
+
+        results = spotify_calls.fan_out({
+            'artist': fetch('artist', spotify.artist),
+            'artist_albums': fetch('artist_albums', spotify.artist_albums, **country),
+            'artist_top_tracks': fetch('artist_top_tracks', spotify.artist_top_tracks, **country),
+            'artist_related_artists': fetch('artist_related_artists', spotify.artist_related_artists),
+        })
+
+        # The search result is a complete artist object, it is used if the details could not be fetched
+        artist_details = results['artist'] or first_result
+        return artist_details, results['artist_albums'], results['artist_top_tracks'], results['artist_related_artists']
     else:
         return None, None, None, None
 
 def get_who_curr_user_follows():
     """
-    Function to get the artists that the current user is following
+    Function to get the artists that the current user is following. The list is downloaded once and then kept up to
+    date by follow_artist and unfollow_artist (see FollowedArtistsCache).
     :return: Returns the list of artists that the user is following
     """
-    token_info = get_token()
-    spotify = spotipy.Spotify(auth=token_info["access_token"])
+    user_id = current_user_id()
+    if user_id is None:
+        return fetch_followed_artists(get_spotify_client())  # Outside of a request there is nobody to cache it for
+
+    artists = followed_artists.get(user_id)
+    if artists is None:
+        artists = fetch_followed_artists(get_spotify_client())
+        followed_artists.replace(user_id, artists)
+    return artists
+
+def is_following_artist(artist_id):
+    """
+    Function to check if the current user follows an artist, usually without any Spotify call
+    :param artist_id: The ID of the artist
+    :return: Returns True if the user follows the artist and False otherwise
+    """
+    following = followed_artists.contains(current_user_id(), artist_id)
+    if following is None:
+        following = any(artist['id'] == artist_id for artist in get_who_curr_user_follows())
+    return following
 
+def fetch_followed_artists(spotify):
+    """
+    Function to download the artists that the current user is following, 50 at a time
+    :param spotify: The Spotify client
+    :return: Returns the list of artists that the user is following
+    """
     followed_artists = []
     limit = 50
     after = None
@@ -321,11 +680,11 @@ def unfollow_artist(artist_id):
     :param artist_id: The function gets the artist's ID from the HTML form, which is needed for unfollowing
     :return: Returns the artist's ID for confirmation
     """
-    token_info = get_token()
-    spotify = spotipy.Spotify(auth=token_info["access_token"])
+    spotify = get_spotify_client()
 
     artist_id_list = [artist_id]  # Converting the id to a list, so it is passed properly to the function
     spotify.user_unfollow_artists(artist_id_list)  # Unfollowing the specified artist
+    followed_artists.discard(current_user_id(), artist_id)
 
     return artist_id  # Returning the unfollowed artist's ID
 
@@ -335,24 +694,139 @@ def follow_artist(artist_id):
     :param artist_id: The function gets the artist's ID from the HTML form, which is needed for following
     :return: Returns the artist's ID for confirmation
     """
-    token_info = get_token()
-    spotify = spotipy.Spotify(auth=token_info["access_token"])
+    spotify = get_spotify_client()
 
     artist_id_list = [artist_id]
     spotify.user_follow_artists(artist_id_list)  # Following the specified artist
+
+    # The list of followed artists shows the details of the artist, which are usually cached since the search
+    user_id = current_user_id()
+    if followed_artists.is_loaded(user_id):
+        try:
+            artist = catalog_cache.get_or_fetch('artist', (artist_id,), lambda: spotify.artist(artist_id))
+            followed_artists.add(user_id, artist)
+        except Exception as e:
+            logger.warning("Could not get the details of artist %s: %s", artist_id, e)
+            followed_artists.forget(user_id)  # The list is downloaded again instead
     return artist_id  # Returning the followed artist's ID
 
 def get_playlists():
     """
-    Function to get the current user's playlists
-    :return: Returns the list of the user's playlists
+    Function to get every playlist of the current user, not only the first page of 50. The pages are fetched
+    concurrently and the result is cached for the user until it expires or the user creates, edits, follows or
+    changes a playlist.
+    :return: Returns the playlists like current_user_playlists does, with every item in 'items' and an index of the
+    positions by playlist ID in 'by_id' (see find_playlist)
+    """
+    user_id = current_user_id()
+    if user_id is None:
+        return fetch_playlist_index(get_spotify_client())  # Outside of a request there is nobody to cache it for
+    return catalog_cache.get_or_fetch('current_user_playlists', (), lambda: fetch_playlist_index(get_spotify_client()),
+                                      user_id=user_id)
+
+def fetch_playlist_index(spotify):
+    """
+    Function to fetch every page of the current user's playlists and to index them by ID
+    :param spotify: The Spotify client
+    :return: Returns the playlists with the 'items', 'total' and 'by_id' keys
+    """
+    items = spotify_calls.fetch_all_pages(
+        lambda offset, limit: spotify.current_user_playlists(limit=limit, offset=offset), limit=50)
+    items = [playlist for playlist in items if playlist]  # Spotify sometimes sends null items
+    return {
+        'items': items,
+        'total': len(items),
+        'by_id': {playlist['id']: position for position, playlist in enumerate(items)},
+    }
+
+def find_playlist(playlists, playlist_id):
+    """
+    Function to look up one of the user's playlists by its ID
+    :param playlists: The playlists returned by get_playlists
+    :param playlist_id: The ID of the playlist
+    :return: Returns the playlist or None if the user does not have it
     """
-    token_info = get_token()
-    spotify = spotipy.Spotify(auth=token_info["access_token"])
+    if 'by_id' not in playlists:  # A plain page of current_user_playlists without the index
+        return next((playlist for playlist in playlists['items'] if playlist['id'] == playlist_id), None)
+    position = playlists['by_id'].get(playlist_id)
+    return playlists['items'][position] if position is not None else None
 
-    playlists = spotify.current_user_playlists()  # Fetching current user's playlists
+def invalidate_playlists():
+    """
+    Function to drop the cached playlists of the current user after one of them changed
+    :return: Returns nothing
+    """
+    catalog_cache.invalidate('current_user_playlists', user_id=current_user_id())
 
-    return playlists  # Returning the list of playlists
+TYPEAHEAD_TYPES = ('artist', 'track', 'album', 'playlist')
+TYPEAHEAD_LIMIT = 8  # The number of suggestions
+TYPEAHEAD_FETCH_LIMIT = 20  # Fetched from Spotify, so a longer query can often be answered from its prefix
+
+def normalize_query(query):
+    """
+    Function to bring a query to the form used in the cache keys, e.g. '  The  Beatles' -> 'the beatles'
+    :return: Returns the normalized query
+    """
+    return fold_text(query)
+
+def typeahead_item(search_type, item):
+    """
+    Function to keep only what a suggestion shows from a search result
+    :return: Returns the ID, the name, the subtitle (artists or owner) and the smallest image of the item
+    """
+    if search_type in ('track', 'album'):
+        subtitle = ', '.join(artist['name'] for artist in item.get('artists', []))
+    elif search_type == 'playlist':
+        subtitle = (item.get('owner') or {}).get('display_name') or ''
+    else:
+        subtitle = ''
+    images = item.get('images') or (item.get('album') or {}).get('images') or []
+    return {'id': item['id'], 'name': item['name'], 'subtitle': subtitle,
+            'image': images[-1]['url'] if images else None}
+
+def matches_query(item, terms):
+    """
+    Function to check if a suggestion matches every term of a query (the last term may be typed only partly)
+    """
+    words = normalize_query(f"{item['name']} {item['subtitle']}").split()
+    return all(any(word.startswith(term) for word in words) for term in terms)
+
+def typeahead(query, search_type='track', limit=TYPEAHEAD_LIMIT):
+    """
+    Function to get the suggestions for a search field while the user is typing. The answers are cached by the
+    normalized query. A longer query is answered from the cached results of its prefix if they contain every result
+    of the prefix or enough matching ones, e.g. 'beatl' from 'beat'. The identical queries which arrive at the same
+    time (e.g. from several users) share one Spotify call.
+    :param query: The text typed by the user
+    :param search_type: 'artist', 'track', 'album' or 'playlist'
+    :param limit: The maximum number of suggestions
+    :return: Returns the normalized query, the suggestions and where they came from ('cache', 'prefix' or 'spotify')
+    """
+    normalized = normalize_query(query)
+    if not normalized or search_type not in TYPEAHEAD_TYPES:
+        return {'query': normalized, 'items': [], 'source': None}
+    market = market_params()
+    scope = (search_type,) + tuple(market.values())  # The suggestions of one market are shared by its users
+
+    # The cached results of the query itself or of its longest cached prefix
+    prefixes = [normalized[:end] for end in range(len(normalized), 0, -1)]
+    found, entry = catalog_cache.get_first([catalog_cache.key('typeahead', scope + (prefix,)) for prefix in prefixes])
+    if found:
+        items = [item for item in entry['items'] if matches_query(item, normalized.split())]
+        if entry['query'] == normalized:
+            return {'query': normalized, 'items': entry['items'][:limit], 'source': 'cache'}
+        if entry['complete'] or len(items) >= limit:
+            return {'query': normalized, 'items': items[:limit], 'source': 'prefix'}
+
+    def fetch():
+        results = get_spotify_client().search(q=normalized, type=search_type, limit=TYPEAHEAD_FETCH_LIMIT, **market)
+        page = results[search_type + 's']
+        items = [typeahead_item(search_type, item) for item in page['items'] if item]
+        return {'query': normalized, 'items': items, 'complete': page.get('total', len(items)) <= len(items)}
+
+    entry = search_flights.do(scope + (normalized,),
+                              lambda: catalog_cache.get_or_fetch('typeahead', scope + (normalized,), fetch))
+    return {'query': normalized, 'items': entry['items'][:limit], 'source': 'spotify'}
 
 def get_playlist(playlist_id):
     """
@@ -362,11 +836,53 @@ def get_playlist(playlist_id):
     function knows which playlist the user wants to follow
     :return: Return the playlist
     """
-    token_info = get_token()
-    spotify = spotipy.Spotify(auth=token_info["access_token"])
+    # A public playlist is cached for everybody, a private or collaborative one only for the user who fetched it
+    user_id = current_user_id()
+    shared_key = catalog_cache.key('playlist', (playlist_id,))
+    user_key = catalog_cache.key('playlist', (playlist_id,), user_id) if user_id else None
+    generation = catalog_cache.generation
+    found, playlist = catalog_cache.get_first([key for key in (user_key, shared_key) if key])
+    if found:
+        return playlist
+
+    spotify = get_spotify_client()
     playlist = spotify.playlist(playlist_id=playlist_id)   # Fetching details of a specific playlist
+    if isinstance(playlist, dict) and playlist.get('public') is True and not playlist.get('collaborative'):
+        catalog_cache.set(shared_key, playlist, generation)
+    elif user_key:
+        catalog_cache.set(user_key, playlist, generation)
     return playlist
 
+def resolve_track(spotify, song_name, market=None):
+    """
+    Function to find the track the user means by a song name. The first search result is used, as it is the most
+    likely to be the song the user was looking for. The result is cached, so the same name is searched only once.
+    :param spotify: The Spotify client
+    :param song_name: The name of the song
+    :param market: The market parameters (see market_params), needed when it runs outside of the request thread
+    :return: Returns the ID, name and artists of the track or None if nothing was found
+    """
+    market = market_params() if market is None else market
+
+    def search():
+        results = spotify.search(q=song_name, type='track', limit=1, **market)
+        if not results['tracks']['items']:
+            return None
+        track = results['tracks']['items'][0]
+        return {'id': track['id'], 'name': track.get('name'),
+                'artists': [artist['name'] for artist in track.get('artists', [])]}
+
+    return catalog_cache.get_or_fetch('track_resolution',
+                                      (' '.join(song_name.lower().split()),) + tuple(market.values()), search)
+
+def parse_song_names(text):
+    """
+    Function to split the pasted list of songs into song names, one song per line
+    :param text: The text from the HTML form
+    :return: Returns the list of the non-empty lines
+    """
+    return [line.strip() for line in (text or '').splitlines() if line.strip()]
+
 def add_to_playlist(playlist_id, song_name):
     """
     Functon to add a track to a playlist in the user's library.
@@ -375,79 +891,92 @@ def add_to_playlist(playlist_id, song_name):
     search result is added to the playlist, as it is the most likely to be the song the user was looking for.
     :return: Returns True if the song was added to the playlist and False otherwise
     """
-    token_info = get_token()
-    spotify = spotipy.Spotify(auth=token_info["access_token"])
+    spotify = get_spotify_client()
 
     # Search for the song to get its ID
-    results = spotify.search(q=song_name, type='track', limit=1)
-    if results['tracks']['items']:
-        song_id = results['tracks']['items'][0]['id']
-        spotify.playlist_add_items(playlist_id, [song_id])  # Adding the song to the specified playlist
+    track = resolve_track(spotify, song_name)
+    if track:
+        spotify.playlist_add_items(playlist_id, [track['id']])  # Adding the song to the specified playlist
+        catalog_cache.invalidate('playlist', (playlist_id,))  # The cached copies of the playlist are out of date
+        invalidate_playlists()  # The number of tracks changed
         return True
     return False  # Returning False if song not found or cannot be added
 
-def remove_from_all_playlists(playlist_id, song_name):
+ADD_CHUNK_SIZE = 100  # The maximum number of tracks Spotify adds in one call
+BULK_MAX_SONGS = 200  # The most songs which can be added at once
+BULK_SEARCH_PARALLELISM = 2  # Searches of one bulk addition running at the same time on the shared call pool
+
+def add_many_to_playlist(playlist_id, song_names):
     """
-    Function to remove all instances of a song from the specified playlist
-    :param playlist_id: The function gets the ID of the playlist from the HTML form
-    :param song_name: The function receives the song's name from the HTML form. The user enters this value.
-    :return: Returns True if the song was deleted from the playlist and False otherwise
-    """
-    token_info = get_token()
-    spotify = spotipy.Spotify(auth=token_info["access_token"])
-
-    # Function to fetch all tracks from the playlist, handling pagination
-    def fetch_all_tracks(playlist_id):
-        tracks = []
-        results = spotify.playlist_items(playlist_id)
-        while results:
-            tracks.extend(results['items'])
-            if results['next']:
-                results = spotify.next(results)
-            else:
-                results = None
-        return tracks
-
-    all_tracks = fetch_all_tracks(playlist_id)  # Fetching all tracks from the playlist, calling the function defined above
-
-    # Removing all occurrences of the specified song from the playlist
-    for item in all_tracks:
-        if 'track' in item and item['track']:
-            track = item['track']
-            if song_name.lower() in track['name'].lower():
-                song_id = track['id']
-                spotify.playlist_remove_all_occurrences_of_items(playlist_id, [song_id])
-                return True
-    return False  # Returning False if song not found in the playlist
+    Function to add a list of songs to a playlist at once. The names are searched concurrently (every different name
+    only once, see resolve_track) and the found tracks are added in the order of the list with as few calls as
+    possible (100 tracks per call) instead of one search and one add call per song. Only BULK_SEARCH_PARALLELISM
+    searches are on the shared call pool at a time and they have the background priority, so a long list does not
+    hold back the pages of the other users.
+    :param playlist_id: The ID of the playlist
+    :param song_names: The list of song names, e.g. from parse_song_names, at most BULK_MAX_SONGS of them
+    :return: Returns a report with one line per song name: the name, the matched track (or None) and if it was added
+    """
+    if len(song_names) > BULK_MAX_SONGS:
+        raise ValueError(f"At most {BULK_MAX_SONGS} songs can be added at once, got {len(song_names)}")
+
+    spotify = get_spotify_client()
+    market = market_params()  # Read here, the searches run on the pool without the request
+
+    searches = {}
+    running = deque()  # The searches on the pool, at most BULK_SEARCH_PARALLELISM
+    with priority(BACKGROUND):
+        for name in dict.fromkeys(song_names):  # Every different name once, in the order of the list
+            if len(running) >= BULK_SEARCH_PARALLELISM:
+                wait([running.popleft()])
+            searches[name] = spotify_calls.submit(spotify_calls.call_with_backoff, resolve_track, spotify, name,
+                                                  market)
+            running.append(searches[name])
+
+    report = []
+    for name in song_names:
+        try:
+            track = searches[name].result()
+        except Exception as e:
+            logger.warning("Could not search for %r: %s", name, e)
+            track = None
+        report.append({'name': name, 'track': track, 'added': False})
+
+    matched = [line for line in report if line['track']]
+    for start in range(0, len(matched), ADD_CHUNK_SIZE):
+        chunk = matched[start:start + ADD_CHUNK_SIZE]
+        try:
+            spotify.playlist_add_items(playlist_id, [line['track']['id'] for line in chunk])
+        except Exception as e:
+            logger.warning("Could not add %s track(s) to playlist %s: %s", len(chunk), playlist_id, e)
+            continue  # The lines of this chunk stay not added, the next chunks are still tried
+        for line in chunk:
+            line['added'] = True
+
+    if matched:
+        catalog_cache.invalidate('playlist', (playlist_id,))
+        invalidate_playlists()
+    return report
+
+def get_all_playlist_items(spotify, playlist_id):
+    """
+    Function to fetch every item of a playlist. The pages after the first one are fetched concurrently (see
+    SpotifyCallPool.fetch_all_pages), so a long playlist does not need one round trip after the other.
+    :param spotify: The Spotify client
+    :param playlist_id: The ID of the playlist
+    :return: Returns the list of the playlist items in their order
+    """
+    return spotify_calls.fetch_all_pages(
+        lambda offset, limit: spotify.playlist_items(playlist_id, offset=offset, limit=limit), limit=100)
 
-def get_playlist_tracks(playlist_id):
+def playlist_track_info(items):
     """
-    Function to retrieve every track in a particular playlist.
-    :param playlist_id: The function gets the playlist's ID from the HTML form, so it gets the tracks of the correct
-    playlist
-    :return: Returns the tracks information.
+    Function to extract the relevant information of the tracks from the items of a playlist
+    :param items: The playlist items as received from Spotify
+    :return: Returns the tracks information (the items without a track, e.g. removed episodes, are skipped)
     """
-    token_info = get_token()
-    spotify = spotipy.Spotify(auth=token_info["access_token"])
-
-    # Function to fetch all tracks from the playlist, handling pagination
-    def fetch_all_tracks(playlist_id):
-        tracks = []
-        results = spotify.playlist_items(playlist_id)
-        while results:
-            tracks.extend(results['items'])
-            if results['next']:
-                results = spotify.next(results)
-            else:
-                results = None
-        return tracks
-
-    all_tracks = fetch_all_tracks(playlist_id)  # Fetching all tracks from the playlist, calling the function defined above
-
-    print(all_tracks)
-    # Extract relevant track information
     tracks_info = []
-    for item in all_tracks:
+    for item in items:
         if 'track' in item and item['track']:
             track = item['track']
             tracks_info.append({
@@ -458,6 +987,249 @@ def get_playlist_tracks(playlist_id):
                 'duration_ms': track['duration_ms'],
                 'preview_url': track['preview_url'] if 'preview_url' in track else None,
             })
+    return tracks_info
+
+def refresh_library(spotify, user_id, playlists):
+    """
+    Function to bring the library index of a user up to date. A playlist is downloaded only if Spotify reports another
+    snapshot than the one it was indexed at, the playlists which the user no longer has are removed from the index.
+    At most library_index.max_tracks tracks are indexed for a user, the playlists which do not fit are skipped.
+    It runs in the background (see LibraryIndexer), so the Spotify calls have the background priority.
+    :param spotify: The Spotify client of the user
+    :param user_id: The ID of the user
+    :param playlists: Every playlist of the user, as in the 'items' of get_playlists
+    :return: Returns the number of indexed, removed and skipped playlists and the number of indexed tracks
+    """
+    with database.read_connection() as conn:
+        indexed = library_index.indexed_snapshots(conn, user_id)
+        counts = library_index.indexed_track_counts(conn, user_id)
+
+    report = {'indexed': 0, 'removed': 0, 'skipped': 0, 'tracks': 0}
+    current = {playlist['id'] for playlist in playlists}
+    removed = [playlist_id for playlist_id in indexed if playlist_id not in current]
+    if removed:  # Removed first, so their tracks do not count in the limit
+        with database.connection() as conn:
+            for playlist_id in removed:
+                library_index.forget_playlist(conn, user_id, playlist_id)
+                counts.pop(playlist_id, None)
+    report['removed'] = len(removed)
+
+    for playlist in playlists:
+        if not playlist.get('snapshot_id') or indexed.get(playlist['id']) == playlist['snapshot_id']:
+            continue  # Not changed since it was indexed
+        total = (playlist.get('tracks') or {}).get('total') or 0  # Known before the download
+        if sum(counts.values()) - counts.get(playlist['id'], 0) + total > library_index.max_tracks:
+            report['skipped'] += 1
+            continue
+        tracks = playlist_track_info(get_all_playlist_items(spotify, playlist['id']))
+        with database.connection() as conn:  # One transaction per playlist, so the searches do not wait long
+            library_index.index_playlist(conn, user_id, playlist, tracks)
+        counts[playlist['id']] = len(tracks)
+        report['indexed'] += 1
+        report['tracks'] += len(tracks)
+
+    if report['indexed'] or report['removed'] or report['skipped']:
+        logger.info("Library index of user %s: %s playlist(s) with %s track(s) indexed, %s removed, %s skipped",
+                    user_id, report['indexed'], report['tracks'], report['removed'], report['skipped'])
+    return report
+
+def is_indexed(user_id, playlist):
+    """
+    Function to check if the library index has the current version of a playlist, i.e. it was indexed at the snapshot
+    which Spotify reports for it now
+    :param user_id: The ID of the current user
+    :param playlist: The playlist from get_playlists
+    :return: Returns True if the playlist can be answered from the index
+    """
+    if not playlist.get('snapshot_id'):
+        return False
+    with database.read_connection() as conn:
+        return library_index.indexed_snapshots(conn, user_id).get(playlist['id']) == playlist['snapshot_id']
+
+def search_library(query, limit=library_index.SEARCH_LIMIT):
+    """
+    Function to search the tracks of the current user's playlists by name, artist and album. It is answered from the
+    library index, without calling Spotify. Every word of the query has to appear, the words are matched from their
+    beginning ('love so' finds 'Love Song'). The playlists are only indexed for the users who search their library:
+    the search brings the index of the user up to date in the background and keeps it for another retention period.
+    :param query: The text typed by the user
+    :param limit: The maximum number of tracks
+    :return: Returns the matching tracks (with the playlist which contains them), the playlists which contain any
+    match (with the number of matches) and the number of indexed playlists, which is 0 while the index is being built
+    """
+    user_id = current_user_id()
+    expression = library_index.match_expression(query or '')
+    result = {'query': query, 'tracks': [], 'playlists': [], 'indexed_playlists': 0}
+    if user_id is None or not library_index.available:
+        return result
+
+    with database.connection() as conn:
+        library_index.mark_used(conn, user_id)
+        library_index.maybe_apply_retention(conn)
+    if library_indexer.enabled:  # The playlists are read on this thread, the job has no request context
+        spotify, playlists = get_spotify_client(), get_playlists()['items']
+        library_indexer.schedule(user_id, lambda: refresh_library(spotify, user_id, playlists))
+
+    with database.read_connection() as conn:
+        result['indexed_playlists'] = len(library_index.indexed_snapshots(conn, user_id))
+        if expression is not None:
+            result['tracks'] = library_index.search_tracks(conn, user_id, expression, limit=limit)
+            result['playlists'] = library_index.playlists_containing(conn, user_id, expression)
+    return result
+
+def forget_library(user_id):
+    """
+    Function to delete the library index of a user (e.g. when the user logs out)
+    :param user_id: The ID of the user
+    :return: Returns the number of deleted playlists
+    """
+    with database.connection() as conn:
+        return library_index.forget_user(conn, user_id)
+
+def prune_library():
+    """
+    Function to delete the library index of the users who did not search their library for the retention period
+    :return: Returns the number of users whose index was deleted
+    """
+    with database.connection() as conn:
+        return library_index.apply_retention(conn)
+
+def song_matcher(song_name):
+    """
+    Function to make the test which decides if a track matches the song name of a removal: its name has to contain the
+    song name, regardless of case and accents. The index and the scan use the same test, so they remove the same tracks.
+    :param song_name: The song name entered by the user
+    :return: Returns a function which gets the name of a track and returns True if it matches
+    """
+    needle = fold_text(song_name)
+    return lambda name: needle in fold_text(name)
+
+def find_in_library(user_id, playlist_id, song_name):
+    """
+    Function to find the tracks of an indexed playlist whose name contains the song name. Every track of the playlist
+    is tested, the full-text index is not used: it matches the words from their beginning, so it would miss the names
+    which contain the song name in the middle of a word (e.g. 'ove' in 'Lovely Day').
+    :return: Returns a dictionary of track ID -> name, in the order of the playlist
+    """
+    matches = song_matcher(song_name)
+    with database.read_connection() as conn:
+        rows = library_index.playlist_track_names(conn, user_id, playlist_id)
+
+    matched = {}
+    for track_id, name in rows:
+        if track_id and matches(name):
+            matched.setdefault(track_id, name)
+    return matched
+
+REMOVE_CHUNK_SIZE = 100  # The maximum number of tracks Spotify removes in one call
+PLAYLIST_SCAN_FIELDS = 'items(track(id,name)),total,limit'  # Only what the matching needs
+
+def remove_from_all_playlists(playlist_id, song_name):
+    """
+    Function to remove all instances of every matching song from the specified playlist. If the library index has the
+    current version of the playlist, the matching tracks are found there without downloading the playlist. Otherwise
+    the pages of the playlist are matched while the next ones are downloaded (see scan_playlist). The tracks are
+    removed with as few calls as possible (100 tracks per call). The removal is pinned to the snapshot of the playlist
+    which was matched, so the tracks added in the meantime are not touched.
+    :param playlist_id: The function gets the ID of the playlist from the HTML form
+    :param song_name: The function receives the song's name from the HTML form. The user enters this value.
+    :return: Returns a report of the removal (the number of scanned items, the names and the number of the matched
+    tracks, the calls made and whether the index or Spotify was searched) if anything was deleted from the playlist
+    and False otherwise
+    """
+    if not fold_text(song_name):
+        return False  # An empty name would match every track
+
+    spotify = get_spotify_client()
+    user_id = current_user_id()
+    playlist = find_playlist(get_playlists(), playlist_id) if user_id is not None else None
+    local = playlist is not None and library_index.available and is_indexed(user_id, playlist)
+
+    if local:
+        matched = find_in_library(user_id, playlist_id, song_name)
+        report = {'scanned_items': 0, 'matched_tracks': 0, 'read_calls': 0, 'remove_calls': 0, 'source': 'index'}
+        snapshot_id = playlist['snapshot_id']  # The version which was indexed
+    else:
+        matched, report, snapshot_id = scan_playlist(spotify, playlist_id, song_name)
+
+    if not matched:
+        return False  # Returning False if song not found in the playlist
+
+    track_ids = list(matched)
+    for start in range(0, len(track_ids), REMOVE_CHUNK_SIZE):
+        result = spotify.playlist_remove_all_occurrences_of_items(
+            playlist_id, track_ids[start:start + REMOVE_CHUNK_SIZE], snapshot_id=snapshot_id)
+        report['remove_calls'] += 1
+        if result:
+            snapshot_id = result.get('snapshot_id', snapshot_id)  # The next chunk goes on top of this change
+
+    if local:
+        with database.connection() as conn:  # The index follows the change, it does not need to be built again
+            library_index.remove_tracks(conn, user_id, playlist_id, track_ids, snapshot_id)
+    catalog_cache.invalidate('playlist', (playlist_id,))
+    invalidate_playlists()
+
+    report['matched_tracks'] = len(track_ids)
+    report['removed_tracks'] = list(matched.values())
+    report['snapshot_id'] = snapshot_id
+    logger.info("Removed %s track(s) matching %r from playlist %s with %s read and %s remove call(s)",
+                report['matched_tracks'], song_name, playlist_id, report['read_calls'], report['remove_calls'])
+    return report
+
+def scan_playlist(spotify, playlist_id, song_name):
+    """
+    Function to find the tracks of a playlist whose name contains the song name by downloading the playlist. The pages
+    are matched while the next ones are downloaded and every matching track is collected in this one pass.
+    :return: Returns the matching tracks (track ID -> name, in the order of the playlist), the report of the scan and
+    the snapshot of the playlist which was scanned (None if it is not known)
+    """
+    matches = song_matcher(song_name)
+
+    # The snapshot is fetched while the first pages are downloaded
+    snapshot = spotify_calls.submit(spotify.playlist, playlist_id, fields='snapshot_id')
+    pages = spotify_calls.iter_pages(
+        lambda offset, limit: spotify.playlist_items(playlist_id, fields=PLAYLIST_SCAN_FIELDS, offset=offset,
+                                                     limit=limit), limit=100)
+
+    matched = {}  # Track ID -> name, in the order of the playlist, every track only once
+    report = {'scanned_items': 0, 'matched_tracks': 0, 'read_calls': 1, 'remove_calls': 0, 'source': 'spotify'}
+    for page in pages:
+        report['read_calls'] += 1
+        for item in page['items']:
+            report['scanned_items'] += 1
+            track = item.get('track') if item else None
+            if track and track.get('id') and matches(track.get('name')):
+                matched.setdefault(track['id'], track['name'])
+
+    if not matched:
+        return matched, report, None
+
+    try:
+        snapshot_id = snapshot.result()['snapshot_id']
+    except Exception as e:
+        logger.warning("Could not get the snapshot of playlist %s: %s", playlist_id, e)
+        snapshot_id = None  # The removal is done on the latest version instead
+    return matched, report, snapshot_id
+
+def get_playlist_tracks(playlist_id):
+    """
+    Function to retrieve every track in a particular playlist. A playlist of the current user is read from the library
+    index if it has the current version of the playlist, otherwise it is downloaded. The playlist is not indexed here,
+    only the library search indexes the playlists (see search_library).
+    :param playlist_id: The function gets the playlist's ID from the HTML form, so it gets the tracks of the correct
+    playlist
+    :return: Returns the tracks information.
+    """
+    user_id = current_user_id()
+    playlist = find_playlist(get_playlists(), playlist_id) if user_id is not None else None
+    if playlist is not None and is_indexed(user_id, playlist):
+        with database.read_connection() as conn:
+            return library_index.playlist_tracks(conn, user_id, playlist_id)
+
+    spotify = get_spotify_client()
+
+    all_tracks = get_all_playlist_items(spotify, playlist_id)  # Fetching all tracks from the playlist
+    tracks_info = playlist_track_info(all_tracks)  # Extract relevant track information
 
     return tracks_info
 
@@ -469,16 +1241,16 @@ def create_spot_playlist(playlist_name, playlist_description, is_public):
     :param is_public: The parameter which sets if the playlist should be public or private
     :return: Returns the newly created playlist
     """
-    token_info = get_token()
-    spotify = spotipy.Spotify(auth=token_info["access_token"])
+    spotify = get_spotify_client()
 
-    user_id = spotify.current_user()["id"]  # Getting the ID of the current user
+    user_id = get_current_user_profile(spotify)["id"]  # Getting the ID of the current user
     playlist = spotify.user_playlist_create(
         user=user_id,
         name=playlist_name,
         public=is_public,
         description=playlist_description
     )
+    invalidate_playlists()  # The new playlist is not in the cached list yet
 
     return playlist  # Return the newly created playlist
 
@@ -491,11 +1263,12 @@ def edit_playlist_details(playlist_id, new_name=None, new_description=None, new_
     :param new_public: The edited public/private status of the playlist, given by the user in the HTML form
     :return: Returns the updated playlist
     """
-    token_info = get_token()
-    spotify = spotipy.Spotify(auth=token_info["access_token"])
+    spotify = get_spotify_client()
 
     # Updating playlist details with provided name, description, and public status
     new_playlist = spotify.playlist_change_details(playlist_id, name=new_name, description=new_description, public=new_public)
+    catalog_cache.invalidate('playlist', (playlist_id,))  # Also the shared copy, the playlist may have become private
+    invalidate_playlists()
 
     return new_playlist  # Return the edited playlist
 
@@ -506,8 +1279,8 @@ def follow_playlist(playlist_id):
     :param playlist_id: The function receives the ID of the playlist from the HTML
     :return: Returns True
     """
-    token_info = get_token()
-    spotify = spotipy.Spotify(auth=token_info["access_token"])
+    spotify = get_spotify_client()
 
     spotify.current_user_follow_playlist(playlist_id)  # Follow the artist with the received ID
+    invalidate_playlists()  # The followed playlist is part of the user's playlists from now on
     return True
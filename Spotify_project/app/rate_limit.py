@@ -0,0 +1,172 @@
+# Import necessary modules and functions
+import contextvars
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+INTERACTIVE = 0  # Calls made for a page the user is waiting for
+BACKGROUND = 1  # Calls which can wait, e.g. warming a cache
+
+_priority = contextvars.ContextVar('spotify_call_priority', default=INTERACTIVE)
+
+
+def current_priority():
+    return _priority.get()
+
+
+@contextmanager
+def priority(level):
+    """
+    Context manager to set the priority of the Spotify calls made inside it, e.g. `with priority(BACKGROUND):` for
+    work which no user is waiting for. The priority is also passed on to the calls started on the SpotifyCallPool.
+    """
+    token = _priority.set(level)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+class RateLimiter:
+    """
+    Class of the token bucket in front of every Spotify call of the application. A call takes a token, the tokens
+    come back at `rate` per second and at most `burst` of them can be saved up. If Spotify answers 429 (too many
+    requests), every call waits until the Retry-After time is over (plus a random jitter, so the waiting calls do not
+    all come back at the same moment). The interactive calls are always served before the background ones.
+    """
+
+    def __init__(self, rate=20.0, burst=40, jitter=0.1, backoff=1.0, max_wait=30.0):
+        """
+        :param rate: The number of calls per second in the long run. 0 turns the limiter off
+        :param burst: The number of calls which can be made at once after a quiet period
+        :param jitter: The random part of the wait after a 429, as a fraction of the wait (0.1 means at most +10%)
+        :param backoff: The first wait (seconds) after a 429 without a Retry-After header, doubled at every retry
+        :param max_wait: The longest wait (seconds) after a 429
+        """
+        self.rate = rate
+        self.burst = burst
+        self.jitter = jitter
+        self.backoff = backoff
+        self.max_wait = max_wait
+        self._condition = threading.Condition()
+        self._tokens = float(burst)
+        self._refilled_at = time.monotonic()
+        self._paused_until = 0.0
+        self._waiting = {INTERACTIVE: 0, BACKGROUND: 0}
+        self.acquired = 0
+        self.delayed = 0
+        self.wait_seconds = 0.0
+        self.throttled = 0
+
+    def configure(self, rate=None, burst=None):
+        """
+        Function to change the settings
+        :return: Returns nothing
+        """
+        with self._condition:
+            if rate is not None:
+                self.rate = rate
+            if burst is not None:
+                self.burst = burst
+                self._tokens = min(self._tokens, float(burst))
+            self._condition.notify_all()
+
+    def _refill(self, now):
+        self._tokens = min(float(self.burst), self._tokens + (now - self._refilled_at) * self.rate)
+        self._refilled_at = now
+
+    def acquire(self, level=None):
+        """
+        Function to wait until a call can be made
+        :param level: INTERACTIVE or BACKGROUND, the priority of the current context if it is not given
+        :return: Returns the number of seconds waited
+        """
+        level = current_priority() if level is None else level
+        started = time.monotonic()
+        with self._condition:
+            self._waiting[level] += 1
+            try:
+                while True:
+                    now = time.monotonic()
+                    wait = self._paused_until - now
+                    if wait <= 0:
+                        if self.rate <= 0:
+                            break
+                        self._refill(now)
+                        ahead = level == BACKGROUND and self._waiting[INTERACTIVE] > 0
+                        if self._tokens >= 1 and not ahead:
+                            self._tokens -= 1
+                            break
+                        # Waiting for the next token (a background call also waits for the interactive ones)
+                        wait = max((1 - self._tokens) / self.rate, 0.005)
+                    self._condition.wait(wait)
+            finally:
+                self._waiting[level] -= 1
+                self._condition.notify_all()
+            waited = time.monotonic() - started
+            self.acquired += 1
+            if waited > 0.001:
+                self.delayed += 1
+                self.wait_seconds += waited
+            return waited
+
+    def throttle(self, retry_after=None, attempt=0):
+        """
+        Function to pause every call after a 429 response
+        :param retry_after: The value of the Retry-After header (seconds) or None if there was no header
+        :param attempt: The number of retries of the call so far, used for the backoff without Retry-After
+        :return: Returns the number of seconds the calls wait
+        """
+        try:
+            seconds = min(max(int(retry_after), 1), self.max_wait)
+        except (TypeError, ValueError):
+            seconds = min(self.backoff * 2 ** attempt, self.max_wait)  # Exponential backoff
+        delay = seconds + random.uniform(0, seconds * self.jitter)
+        with self._condition:
+            self._paused_until = max(self._paused_until, time.monotonic() + delay)
+            self.throttled += 1
+            self._condition.notify_all()
+        return delay
+
+    def pause_remaining(self):
+        """
+        Function to get how long the calls still wait because of a 429 response
+        :return: Returns the number of seconds, 0 if the calls are not paused
+        """
+        with self._condition:
+            return max(self._paused_until - time.monotonic(), 0.0)
+
+    def reset(self):
+        """
+        Function to refill the bucket, end the pause and reset the counters
+        :return: Returns nothing
+        """
+        with self._condition:
+            self._tokens = float(self.burst)
+            self._refilled_at = time.monotonic()
+            self._paused_until = 0.0
+            self.acquired = self.delayed = self.throttled = 0
+            self.wait_seconds = 0.0
+            self._condition.notify_all()
+
+    def stats(self):
+        """
+        Function to get the counters of the limiter
+        :return: Returns the number of waiting calls by priority, the throttles and the time spent waiting
+        """
+        with self._condition:
+            return {
+                "rate": self.rate,
+                "burst": self.burst,
+                "queue_depth": {"interactive": self._waiting[INTERACTIVE], "background": self._waiting[BACKGROUND]},
+                "acquired": self.acquired,
+                "delayed": self.delayed,
+                "wait_seconds": round(self.wait_seconds, 3),
+                "throttled": self.throttled,
+                "paused_for": round(max(self._paused_until - time.monotonic(), 0.0), 3),
+            }
+
+
+# The limiter of every Spotify call of the application, configured by create_app
+spotify_limiter = RateLimiter()
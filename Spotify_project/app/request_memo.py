@@ -0,0 +1,79 @@
+# Import necessary modules and functions
+import logging
+import threading
+from collections import Counter
+
+from flask import g, has_request_context
+
+logger = logging.getLogger(__name__)
+
+# Number of calls saved by the memo since the start of the application, by key (e.g. 'current_user')
+_saved_calls = Counter()
+_lock = threading.Lock()
+
+
+def memoize(key, compute):
+    """
+    Function to compute a value only once per request. The value is stored on flask.g, so it is dropped at the end of
+    the request. Outside of a request (e.g. in the command line tools) the value is computed every time.
+    :param key: The name of the value, e.g. 'current_user'
+    :param compute: Function without parameters which computes the value
+    :return: Returns the stored or the newly computed value
+    """
+    if not has_request_context():
+        return compute()
+
+    memo = g.setdefault('request_memo', {})
+    if key in memo:
+        g.setdefault('request_memo_saved', Counter())[key] += 1
+        with _lock:
+            _saved_calls[key] += 1
+        return memo[key]
+
+    value = compute()
+    memo[key] = value
+    return value
+
+
+def forget(key):
+    """
+    Function to drop a stored value of the current request, e.g. after the value changed
+    :return: Returns nothing
+    """
+    if has_request_context():
+        g.setdefault('request_memo', {}).pop(key, None)
+
+
+def saved_in_request():
+    """
+    Function to get the calls saved in the current request
+    :return: Returns the number of saved calls by key
+    """
+    return dict(g.get('request_memo_saved', {})) if has_request_context() else {}
+
+
+def stats():
+    """
+    Function to get the calls saved since the start of the application
+    :return: Returns the number of saved calls by key and their sum
+    """
+    with _lock:
+        return {"saved_calls": dict(_saved_calls), "total": sum(_saved_calls.values())}
+
+
+def setup_request_memo(app):
+    """
+    Function to report the saved calls of every request in debug mode, in the X-Saved-Calls response header and in
+    the log
+    :param app: The Flask application
+    :return: Returns nothing
+    """
+
+    @app.after_request
+    def report_saved_calls(response):
+        if app.debug:
+            saved = saved_in_request()
+            response.headers['X-Saved-Calls'] = str(sum(saved.values()))
+            if saved:
+                logger.debug("Request memo saved %s call(s): %s", sum(saved.values()), saved)
+        return response
@@ -1,10 +1,15 @@
 
 # Import necessary modules and functions
-from flask import redirect, url_for, session, render_template, request, flash, get_flashed_messages
-from app.auth import create_spotify_oauth
+from flask import redirect, url_for, session, render_template, request, flash, get_flashed_messages, stream_template, \
+    abort, jsonify
+from app.auth import create_spotify_oauth, token_manager
 from app.models import *
-import spotipy
-from config import Config
+from app.spotify_client import spotify_clients, spotify_calls
+from app.rate_limit import spotify_limiter
+from app import request_memo
+
+USER_LOGINS_PAGE_SIZE = 100  # Default number of rows on one page of the user logins
+USER_LOGINS_MAX_PAGE_SIZE = 1000
 
 
 def setup_routes(app):
@@ -13,15 +18,15 @@ def setup_routes(app):
     :param app: Received from the __init__.py file. This initializes my flask application.
     :return: Returns nothing
     """
-    app.config.from_object(Config)  # Load configuration settings from the Config object
-
     @app.route('/')
     def login():
         """
         Route handling functon for the login page. It clears the session so there is no information stored about the
-        previous user.
+        previous user. The library index of the previous user is deleted as well.
         :return: Redirects the user to the Spotify authorization page
         """
+        if session.get('user_id'):
+            forget_library(session['user_id'])
         session.clear()
         auth_url = create_spotify_oauth().get_authorize_url()  # Get the Spotify authorization URL
         return redirect(auth_url)
@@ -42,7 +47,7 @@ def setup_routes(app):
         user_info = display_current_user()  # Get current user info
         session['user_id'] = user_info['id']  # Store user ID in the session
 
-        spotify = spotipy.Spotify(auth=token_info["access_token"])  # Create a Spotify client
+        spotify = spotify_clients.get(token_info["access_token"])  # Get the (pooled) Spotify client
         log_user_login(spotify)  # Log the user login --> needed for the database part and the statistics
 
         return redirect(url_for('home'))
@@ -54,8 +59,7 @@ def setup_routes(app):
         :return: Renders the homepage template if the user is logged in. Otherwise, it redirects to Spotify's login page
         """
         try:
-            token_info = get_token()  # Get the current token info
-            spotify = spotipy.Spotify(auth=token_info["access_token"])
+            spotify = get_spotify_client()  # Get the Spotify client with the current token
         except Exception as e:
             flash(f"There was an error: {e}", category="error")  # Show the error to the user if any occurs.
             return redirect("/")  # Redirect to the login page if the user is not logged in
@@ -64,11 +68,26 @@ def setup_routes(app):
     @app.route('/user_logins')
     def user_logins():
         """
-        Route handling function for displaying user logins.
+        Route handling function for displaying user logins. The logins are paginated (keyset pagination with the
+        cursor in the URL) and can be filtered by country and subscription level. The page is read from the query
+        cache (or from the database on a miss) and the template is streamed.
         :return: Renders the HTML template which present the data in a table.
         """
-        user_logins_ = get_user_logins()  # Get user login data
-        return render_template("user_logins.html", user_logins=user_logins_)  # Render the user logins template
+        cursor = request.args.get('cursor') or None  # Cursor of the page, received from the "Next page" link
+        country = request.args.get('country') or None  # Optional filters from the HTML form
+        sub_level = request.args.get('sub_level') or None
+        page_size = min(max(request.args.get('limit', USER_LOGINS_PAGE_SIZE, type=int), 1), USER_LOGINS_MAX_PAGE_SIZE)
+
+        if cursor:
+            try:
+                decode_cursor(cursor)
+            except ValueError:
+                abort(400)  # The cursor was modified by hand
+
+        user_logins_ = get_user_logins(cursor=cursor, limit=page_size, country=country, sub_level=sub_level,
+                                       stream=True)  # Get user login data, cached until the next login
+        return stream_template("user_logins.html", user_logins=user_logins_, country=country, sub_level=sub_level,
+                               page_size=page_size)  # Stream the user logins template
 
     @app.route('/user_stats')
     def user_stats():
@@ -79,6 +98,27 @@ def setup_routes(app):
         stats = get_user_stats()  # Get user statistics
         return render_template("user_stats.html", **stats)  # Render the user statistics template
 
+    @app.route('/metrics')
+    def metrics():
+        """
+        Route handling function for checking the internal counters of the application (e.g. how efficient the caches
+        are). It is meant for the developers, not for the users.
+        :return: Returns the counters as JSON
+        """
+        return jsonify({
+            "query_cache": get_query_cache_stats(),
+            "login_writer": {"queue_depth": login_writer.queue_depth(), "running": login_writer.is_running()},
+            "spotify_clients": spotify_clients.stats(),
+            "request_memo": request_memo.stats(),
+            "catalog_cache": catalog_cache.stats(),
+            "followed_artists": followed_artists.stats(),
+            "spotify_calls": spotify_calls.stats(),
+            "rate_limiter": spotify_limiter.stats(),
+            "tokens": token_manager.stats(),
+            "search_flights": search_flights.stats(),
+            "library_index": library_indexer.stats(),
+        })
+
     @app.route('/search', methods=['GET', 'POST'])
     def search():
         """
@@ -93,6 +133,27 @@ def setup_routes(app):
                                    search_type=search_type)  # Render search results template
         return render_template('search.html')  # Render search form template if the method is GET
 
+    @app.route('/typeahead', methods=['GET'])
+    def typeahead_suggestions():
+        """
+        Function which returns the suggestions for the search fields while the user is typing (see typeahead.js).
+        :return: Returns the suggestions as JSON
+        """
+        query = request.args.get('q', '')  # Get the typed text from the URL
+        search_type = request.args.get('type', 'track')  # Get the search type from the URL
+        return jsonify(typeahead(query, search_type))
+
+    @app.route('/library_search', methods=['GET'])
+    def library_search():
+        """
+        Function which searches the tracks of the user's own playlists (by name, artist and album) and tells which
+        playlists contain them. It is answered from the local library index, which is built for the user in the
+        background after their first search.
+        :return: Returns the matching tracks and playlists as JSON
+        """
+        query = request.args.get('q', '')  # Get the searched text from the URL
+        return jsonify(search_library(query))
+
     @app.route('/current_user', methods=['GET'])
     def get_current_user():
         """
@@ -165,11 +226,8 @@ def setup_routes(app):
             query = request.form.get('name')  # Get search query from form
             search_type = 'artist'  # Set the search type to 'artist'
             results = search_spotify(query, search_type)  # Search Spotify for the artist based on the query
-            following_already = get_who_curr_user_follows()  # Get the list of artists the current user is already following
-            following_already = [item['id'] for item in following_already]   # Extract the IDs of the followed artists
-
             # Check if the first result is already being followed
-            if results[0]['id'] in following_already:
+            if is_following_artist(results[0]['id']):
                 # Display a message indicating the artist is already followed and suggest similar artists
                 flash(f"You are already following the artists '{results[0]['name']}'. Here are some possibly "
                       f"similar artists.", "error")
@@ -201,11 +259,10 @@ def setup_routes(app):
         :return: If there are any playlists, the function renders the HTML template to present the playlists and the
         options regarding these playlists.
         """
-        playlists = get_playlists()  # Get user's playlists
-        playlists = playlists['items']
-
-        curr_user = display_current_user()['display_name']  # Get current user's display name
-        # This is needed to distinguish if the user is the owner of the playlist or not.
+        # Get user's playlists and the current user's display name. The name is needed to distinguish if the user is
+        # the owner of the playlist or not. Both use the session, so they are called on this thread.
+        playlists = get_playlists()['items']
+        curr_user = display_current_user()['display_name']
 
         if playlists:
             return render_template('display_playlists.html', playlists=playlists, curr_user=curr_user)  # Render playlists template
@@ -221,19 +278,32 @@ def setup_routes(app):
         :return: If the user did not specify the name of the song, an error message will inform the user about this.
         Otherwise, it shows a confirmation message that the track was added, and it also updates the values of the
         playlist. This way the user can see that the song was in fact added and can also check the tracks in the playlist.
+        If the user pasted a list of songs (one per line), they are added at once and a report shows which track was
+        matched for each line.
         """
         playlist_id = request.form.get('playlist_id')  # Get playlist ID from the HTML form as a hidden value
         song_name = request.form.get('song_name')  # Get song's name from the HTML form which the user gave
+        song_names = parse_song_names(request.form.get('song_names'))  # Get the pasted list of songs (bulk mode)
 
         # Necessary information to render the playlists after the addition of a song
         playlists = get_playlists()
         playlists = playlists['items']
         curr_user = display_current_user()['display_name']
 
-        if not playlist_id or not song_name:
+        if not playlist_id or not (song_name or song_names):
             flash("The song name is required in order to add it.", "error")  # Flash error message if required fields are missing
             return render_template('display_playlists.html', playlists=playlists, curr_user=curr_user)
 
+        if song_names:
+            if song_name:
+                song_names.insert(0, song_name)
+            if len(song_names) > BULK_MAX_SONGS:
+                flash(f"At most {BULK_MAX_SONGS} songs can be added at once, you pasted {len(song_names)}.", "error")
+                return render_template('display_playlists.html', playlists=playlists, curr_user=curr_user)
+            report = add_many_to_playlist(playlist_id, song_names)  # Add every song with the bulk helper function
+            return render_template('add_report.html', report=report,
+                                   added=sum(1 for line in report if line['added']))
+
         # Add song to playlist using the helper function
         result = add_to_playlist(playlist_id, song_name)
 
@@ -250,7 +320,7 @@ def setup_routes(app):
         """
         Function which allows the user to remove songs from his/her playlist, if the user is the owner of the playlist.
         :return: If the user did not specify the name of the song, an error message will inform the user about this.
-        Otherwise, it shows a confirmation message that the track was removed, and it also updates the values of the
+        Otherwise, it shows a confirmation message with the removed tracks, and it also updates the values of the
         playlist. This way the user can see that the song was in fact removed and can also check the tracks in the playlist.
         """
         playlist_id = request.form.get('playlist_id')  # Get playlist ID from the HTML form as a hidden value
@@ -268,8 +338,10 @@ def setup_routes(app):
         # Remove song to playlist using the helper function
         result = remove_from_all_playlists(playlist_id, song_name)
 
-        if result:
-            flash(f"The song '{song_name}' has been successfully removed.", "success")  # Flash success message
+        if result and result['matched_tracks']:
+            # Flash success message with what was removed
+            flash(f"The song '{song_name}' has been successfully removed: {result['matched_tracks']} track(s) "
+                  f"({', '.join(result['removed_tracks'])}) with {result['remove_calls']} call(s).", "success")
         else:
             # Flash error message if there was an unexpected error
             flash(f"Failed to remove the song '{song_name}' from playlists."
@@ -286,15 +358,8 @@ def setup_routes(app):
         :return: Gives the user an error message if the playlist was not found. This is not a scenario that will likely
         happen, I just included it as a 'What-if' case. Otherwise, the function renders the tracks in the playlist.
         """
-        playlists = get_playlists()  # Get the user's playlists
-        playlists = playlists['items']
-
         # Get the selected playlist based on ID
-        selected_playlist = None
-        for playlist in playlists:
-            if playlist['id'] == playlist_id:
-                selected_playlist = playlist
-                break
+        selected_playlist = find_playlist(get_playlists(), playlist_id)
 
         if not selected_playlist:
             flash("Playlist not found", "error")  # Flash error message if playlist is not found
@@ -347,8 +412,7 @@ def setup_routes(app):
             return redirect(url_for('display_playlists'))  # Redirect to playlists display
 
         # Check if there was a playlist selected, this is also for the "What-if" cases and unexpected error handling
-        playlists = get_playlists()['items']
-        selected_playlist = next((pl for pl in playlists if pl['id'] == playlist_id), None)
+        selected_playlist = find_playlist(get_playlists(), playlist_id)
 
         if not selected_playlist:
             flash("Playlist not found", "error")  # Flash error message if playlist is not found
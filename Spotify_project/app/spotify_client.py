@@ -0,0 +1,326 @@
+# Import necessary modules and functions
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import requests
+import spotipy
+from urllib3.util.retry import Retry
+
+from app.rate_limit import spotify_limiter, current_priority, priority
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimitedSession(requests.Session):
+    """
+    Session which asks the rate limiter before every request. If Spotify answers 429 (too many requests), the
+    limiter pauses every call for the Retry-After time and the request is repeated. This is the only place where a
+    429 is repeated (not in urllib3 and not in SpotifyCallPool), so one call makes at most retries + 1 requests.
+    """
+
+    def __init__(self, limiter, retries=3):
+        super().__init__()
+        self.limiter = limiter
+        self.retries = retries
+
+    def request(self, method, url, *args, **kwargs):
+        attempt = 0
+        while True:
+            self.limiter.acquire()
+            response = super().request(method, url, *args, **kwargs)
+            if response.status_code != 429 or attempt >= self.retries:
+                return response
+            delay = self.limiter.throttle(response.headers.get('Retry-After'), attempt)
+            logger.warning("Rate limited by Spotify, every call waits %.1f seconds", delay)
+            response.close()
+            attempt += 1
+
+
+class SharedSessionSpotify(spotipy.Spotify):
+    """
+    Spotify client which uses the session of the factory. spotipy closes the session of a client when the client is
+    garbage collected, but this session is shared by every client, so it is only closed by the factory.
+    """
+
+    def __del__(self):
+        pass
+
+
+class SpotifyClientFactory:
+    """
+    Class which hands out the Spotify clients. Every client of the application shares one requests.Session, so the
+    HTTP connections (and their TLS sessions) to the Spotify API are kept alive and reused by every request, instead
+    of every spotipy.Spotify object opening its own connection pool. The clients are cached by access token and when
+    a token is refreshed, the token of the existing client is swapped in place.
+    """
+
+    def __init__(self, pool_size=10, timeout=5, retries=3, max_clients=256, limiter=spotify_limiter):
+        """
+        :param pool_size: The maximum number of open connections to the Spotify API (per host)
+        :param timeout: The number of seconds a request to the Spotify API can take
+        :param retries: The number of retries of a failed request (connection errors, 5xx and 429 responses)
+        :param max_clients: The number of clients kept in memory, the least recently used one is dropped
+        :param limiter: The RateLimiter every request of the shared session goes through
+        """
+        self.limiter = limiter
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.retries = retries
+        self.max_clients = max_clients
+        self._clients = OrderedDict()  # access token -> client, in the order of the last use
+        self._lock = threading.Lock()
+        self._session = None
+        self.created = 0
+        self.reused = 0
+        self.swapped = 0
+
+    def configure(self, pool_size=None, timeout=None, retries=None):
+        """
+        Function to change the settings. The clients and the session are created again with the new settings.
+        :return: Returns nothing
+        """
+        if pool_size is not None:
+            self.pool_size = pool_size
+        if timeout is not None:
+            self.timeout = timeout
+        if retries is not None:
+            self.retries = retries
+        self.clear()
+
+    def _build_session(self):
+        """
+        Function to create the shared session, with the same retry policy as the own session of spotipy, except that
+        the 429 responses are repeated by the session itself, so every call waits for the Retry-After time
+        :return: Returns the session
+        """
+        session = RateLimitedSession(self.limiter, retries=self.retries)
+        # urllib3 would also repeat the 429 responses with a Retry-After header, this is left to the session
+        retry = Retry(total=self.retries, connect=None, read=False,
+                      allowed_methods=frozenset(['GET', 'POST', 'PUT', 'DELETE']), status=self.retries,
+                      backoff_factor=0.3, respect_retry_after_header=False,
+                      status_forcelist=[code for code in spotipy.Spotify.default_retry_codes if code != 429])
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=self.pool_size, max_retries=retry)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def get(self, access_token):
+        """
+        Function to get the client of an access token
+        :param access_token: The access token of the user
+        :return: Returns the cached client or a new one, which uses the shared session
+        """
+        with self._lock:
+            client = self._clients.get(access_token)
+            if client is not None:
+                self._clients.move_to_end(access_token)
+                self.reused += 1
+                return client
+
+            if self._session is None:
+                self._session = self._build_session()
+            client = SharedSessionSpotify(auth=access_token, requests_session=self._session,
+                                          requests_timeout=self.timeout)
+            self._clients[access_token] = client
+            self.created += 1
+            while len(self._clients) > self.max_clients:
+                # Only dropped from the cache, a request which still uses the client can finish its calls
+                self._clients.popitem(last=False)
+            return client
+
+    def swap_token(self, old_access_token, new_access_token):
+        """
+        Function to move the client of a refreshed token to the new token. The client (and its warm connections) is
+        kept, only its token is replaced.
+        :return: Returns nothing
+        """
+        with self._lock:
+            client = self._clients.pop(old_access_token, None)
+            if client is None:
+                return
+            client.set_auth(new_access_token)
+            self._clients[new_access_token] = client
+            self.swapped += 1
+
+    def clear(self):
+        """
+        Function to drop every client and close the connections of the shared session. The clients which are still in
+        use keep working, the session opens new connections for them.
+        :return: Returns nothing
+        """
+        with self._lock:
+            self._clients.clear()
+            session, self._session = self._session, None
+        if session is not None:
+            session.close()
+
+    def stats(self):
+        """
+        Function to get the counters of the factory
+        :return: Returns the number of cached, created and reused clients and the settings
+        """
+        with self._lock:
+            return {
+                "clients": len(self._clients),
+                "created": self.created,
+                "reused": self.reused,
+                "token_swaps": self.swapped,
+                "pool_size": self.pool_size,
+                "timeout": self.timeout,
+            }
+
+
+class SpotifyCallPool:
+    """
+    Class of the bounded thread pool which runs independent Spotify calls concurrently, e.g. the details of an artist.
+    The pool is shared by every request, so the number of parallel calls to Spotify is limited no matter how many
+    pages are loaded at the same time.
+    """
+
+    def __init__(self, max_workers=8, timeout=5.0, page_parallelism=4, limiter=spotify_limiter):
+        """
+        :param max_workers: The maximum number of Spotify calls running at the same time
+        :param timeout: The default number of seconds a call can take before its result is given up
+        :param page_parallelism: The maximum number of pages of one list fetched at the same time
+        :param limiter: The RateLimiter which holds the shared Retry-After pause
+        """
+        self.limiter = limiter
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.page_parallelism = page_parallelism
+        self._executor = None
+        self._lock = threading.Lock()
+        self.timeouts = 0
+        self.failures = 0
+        self.rate_limited = 0
+
+    def configure(self, max_workers=None, timeout=None, page_parallelism=None):
+        """
+        Function to change the settings. The running calls are finished by the old threads.
+        :return: Returns nothing
+        """
+        if timeout is not None:
+            self.timeout = timeout
+        if page_parallelism is not None:
+            self.page_parallelism = page_parallelism
+        if max_workers is not None and max_workers != self.max_workers:
+            self.max_workers = max_workers
+            self.shutdown()
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='spotify-call')
+            return self._executor
+
+    def submit(self, function, *args, **kwargs):
+        """
+        Function to start one call on the pool. The call keeps the priority (see rate_limit.priority) of the caller.
+        :return: Returns the future of the call
+        """
+        return self._get_executor().submit(self._run, current_priority(), function, *args, **kwargs)
+
+    @staticmethod
+    def _run(level, function, *args, **kwargs):
+        with priority(level):
+            return function(*args, **kwargs)
+
+    def fan_out(self, calls, timeout=None):
+        """
+        Function to run several calls concurrently and wait for them. A call which fails or does not finish in time
+        does not fail the others, its result is None (partial result), so the slowest call can not hold the whole
+        page back.
+        :param calls: Dictionary of name -> function without parameters
+        :param timeout: The number of seconds to wait for the calls (default: the timeout of the pool)
+        :return: Returns a dictionary of name -> result (None for the failed and timed out calls)
+        """
+        timeout = self.timeout if timeout is None else timeout
+        futures = {name: self.submit(function) for name, function in calls.items()}
+        wait(futures.values(), timeout=timeout)
+
+        results = {}
+        for name, future in futures.items():
+            if not future.done():
+                future.cancel()  # Only possible if it did not start yet, otherwise its result is ignored
+                self.timeouts += 1
+                logger.warning("Spotify call %s did not finish in %s seconds", name, timeout)
+                results[name] = None
+            elif future.exception() is not None:
+                self.failures += 1
+                logger.warning("Spotify call %s failed: %s", name, future.exception())
+                results[name] = None
+            else:
+                results[name] = future.result()
+        return results
+
+    def call_with_backoff(self, function, *args, **kwargs):
+        """
+        Function to make a Spotify call after the pause of a 429 (too many requests) response is over, so a call
+        started on the pool does not take a worker only to be rate limited again. The 429 responses themselves are
+        repeated by the session (see RateLimitedSession), a 429 which reaches this point is not repeated again.
+        :return: Returns the result of the call
+        """
+        delay = self.limiter.pause_remaining()
+        if delay > 0:
+            time.sleep(delay)
+        try:
+            return function(*args, **kwargs)
+        except spotipy.SpotifyException as e:
+            if e.http_status == 429:
+                self.rate_limited += 1  # The session gave up
+            raise
+
+    def iter_pages(self, fetch_page, limit=100):
+        """
+        Generator of the pages of an offset paginated list (e.g. the tracks of a playlist). The first page tells the
+        total number of items, so the offsets of the other pages are known and they are fetched concurrently (at most
+        page_parallelism at a time). The pages are yielded in the original order as soon as they are there, so the
+        caller can process a page while the next ones are downloaded.
+        :param fetch_page: Function which fetches one page, it receives the offset and the limit
+        :param limit: The number of items on one page (the maximum of the endpoint)
+        :return: Yields the pages as received from Spotify
+        """
+        first_page = self.call_with_backoff(fetch_page, 0, limit)
+        yield first_page
+        total = first_page.get('total')
+        limit = first_page.get('limit') or limit
+        if not isinstance(total, int) or total <= len(first_page['items']):
+            return
+
+        pending = deque()  # Futures of the pages being fetched, in order
+        for offset in range(limit, total, limit):
+            if len(pending) >= self.page_parallelism:
+                yield pending.popleft().result()
+            pending.append(self.submit(self.call_with_backoff, fetch_page, offset, limit))
+        while pending:
+            yield pending.popleft().result()
+
+    def fetch_all_pages(self, fetch_page, limit=100):
+        """
+        Function to fetch every item of an offset paginated list, the pages are fetched concurrently (see iter_pages)
+        :param fetch_page: Function which fetches one page, it receives the offset and the limit
+        :param limit: The number of items on one page (the maximum of the endpoint)
+        :return: Returns the list of every item
+        """
+        items = []
+        for page in self.iter_pages(fetch_page, limit):
+            items.extend(page['items'])
+        return items
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+    def stats(self):
+        return {"max_workers": self.max_workers, "timeout": self.timeout, "timeouts": self.timeouts,
+                "failures": self.failures, "rate_limited": self.rate_limited}
+
+
+# The client factory and the call pool of the application, configured by create_app
+spotify_clients = SpotifyClientFactory()
+spotify_calls = SpotifyCallPool()
@@ -0,0 +1,60 @@
+// Suggestions for the search fields while the user is typing. A field gets them with the attributes
+// data-typeahead="<search type>" data-url="<URL of /typeahead>" list="<ID of a datalist>", and optionally
+// data-type-select="<ID of the select of the search type>".
+// The request is sent only when the user stopped typing for a moment (debounce) and the answer of an older request is
+// dropped, so the suggestions always belong to the current text.
+(function () {
+    var DEBOUNCE_MS = 250;  // Waiting time after the last key press
+    var MIN_LENGTH = 2;  // Shorter texts get no suggestions
+
+    document.querySelectorAll('input[data-typeahead]').forEach(function (input) {
+        var list = document.getElementById(input.getAttribute('list'));
+        var typeSelect = input.dataset.typeSelect ? document.getElementById(input.dataset.typeSelect) : null;
+        var timer = null;
+        var controller = null;
+        var lastRequest = '';
+
+        function suggest() {
+            var query = input.value.trim();
+            var type = typeSelect ? typeSelect.value : input.dataset.typeahead;
+            var request = type + '|' + query.toLowerCase();
+            if (query.length < MIN_LENGTH || request === lastRequest) {
+                return;
+            }
+            lastRequest = request;
+            if (controller) {
+                controller.abort();  // The answer of the previous text is not needed anymore
+            }
+            controller = new AbortController();
+
+            var url = input.dataset.url + '?q=' + encodeURIComponent(query) + '&type=' + encodeURIComponent(type);
+            fetch(url, {signal: controller.signal, credentials: 'same-origin'})
+                .then(function (response) {
+                    return response.ok ? response.json() : {items: []};
+                })
+                .then(function (data) {
+                    list.innerHTML = '';
+                    data.items.forEach(function (item) {
+                        var option = document.createElement('option');
+                        option.value = item.name;
+                        option.label = item.subtitle ? item.name + ' - ' + item.subtitle : item.name;
+                        list.appendChild(option);
+                    });
+                })
+                .catch(function () {
+                    // Aborted or failed, the next key press tries again
+                });
+        }
+
+        input.addEventListener('input', function () {
+            clearTimeout(timer);
+            timer = setTimeout(suggest, DEBOUNCE_MS);
+        });
+        if (typeSelect) {
+            typeSelect.addEventListener('change', function () {
+                list.innerHTML = '';
+                suggest();
+            });
+        }
+    });
+})();
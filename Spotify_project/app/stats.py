@@ -0,0 +1,137 @@
+# Import necessary modules and functions
+
+# The materialized statistics of the user_logins table. Every row is one counter, e.g. ('country', 'US', 12) is the
+# number of users from the US and ('followers', 'sum', 3400) is the sum of the followers of every user. The triggers
+# below keep the counters up to date on every write, so the statistics page reads a handful of rows instead of
+# scanning the whole table.
+CREATE_STATS_TABLE = '''
+    CREATE TABLE IF NOT EXISTS user_stats_counters (
+        kind TEXT NOT NULL,
+        bucket TEXT NOT NULL,
+        value INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (kind, bucket)
+    ) WITHOUT ROWID
+'''
+
+# Index for finding the biggest counter of a kind (e.g. the most common country) without sorting
+CREATE_STATS_INDEX = '''
+    CREATE INDEX IF NOT EXISTS idx_user_stats_counters_value ON user_stats_counters (kind, value, bucket)
+'''
+
+# Adding (or subtracting) the values of one user_logins row to the counters
+_COUNTER_ROWS = '''
+        ('users', 'total', {sign}1),
+        ('sub_level', {row}.sub_level, {sign}1),
+        ('country', {row}.country, {sign}1),
+        ('followers', 'sum', {sign}{row}.followers),
+        ('week', strftime('%Y-%W', {row}.last_login_time, 'localtime'), {sign}1),
+        ('month', strftime('%Y-%m', {row}.last_login_time, 'localtime'), {sign}1)
+'''
+
+_UPSERT_COUNTERS = '''
+        INSERT INTO user_stats_counters (kind, bucket, value) VALUES {rows}
+        ON CONFLICT (kind, bucket) DO UPDATE SET value = value + excluded.value;
+'''
+
+CREATE_STATS_TRIGGERS = (
+    '''
+    CREATE TRIGGER IF NOT EXISTS user_logins_stats_insert AFTER INSERT ON user_logins BEGIN
+    ''' + _UPSERT_COUNTERS.format(rows=_COUNTER_ROWS.format(sign='', row='NEW')) + '''
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS user_logins_stats_delete AFTER DELETE ON user_logins BEGIN
+    ''' + _UPSERT_COUNTERS.format(rows=_COUNTER_ROWS.format(sign='-', row='OLD')) + '''
+    END
+    ''',
+    # An update is a removal of the old values and an addition of the new ones. The number of users does not change,
+    # the +1 and -1 of the 'users' counter cancel each other out
+    '''
+    CREATE TRIGGER IF NOT EXISTS user_logins_stats_update AFTER UPDATE ON user_logins BEGIN
+    ''' + _UPSERT_COUNTERS.format(rows=_COUNTER_ROWS.format(sign='-', row='OLD')) +
+    _UPSERT_COUNTERS.format(rows=_COUNTER_ROWS.format(sign='', row='NEW')) + '''
+    END
+    ''',
+)
+
+# Queries of the statistics page
+SELECT_COUNTER = "SELECT value FROM user_stats_counters WHERE kind=? AND bucket=?"
+SELECT_TOP_BUCKET = ("SELECT bucket FROM user_stats_counters WHERE kind=? AND value > 0 "
+                     "ORDER BY value DESC, bucket DESC LIMIT 1")
+SELECT_LATEST_BUCKET = ("SELECT value FROM user_stats_counters WHERE kind=? AND value > 0 "
+                        "ORDER BY bucket DESC LIMIT 1")
+
+# Recomputing every counter from the user_logins table
+REBUILD_STATEMENTS = (
+    "DELETE FROM user_stats_counters",
+    "INSERT INTO user_stats_counters (kind, bucket, value) SELECT 'users', 'total', COUNT(*) FROM user_logins",
+    "INSERT INTO user_stats_counters (kind, bucket, value) "
+    "SELECT 'followers', 'sum', COALESCE(SUM(followers), 0) FROM user_logins",
+    "INSERT INTO user_stats_counters (kind, bucket, value) "
+    "SELECT 'sub_level', sub_level, COUNT(*) FROM user_logins GROUP BY sub_level",
+    "INSERT INTO user_stats_counters (kind, bucket, value) "
+    "SELECT 'country', country, COUNT(*) FROM user_logins GROUP BY country",
+    "INSERT INTO user_stats_counters (kind, bucket, value) "
+    "SELECT 'week', strftime('%Y-%W', last_login_time, 'localtime') AS login_week, COUNT(*) FROM user_logins "
+    "GROUP BY login_week",
+    "INSERT INTO user_stats_counters (kind, bucket, value) "
+    "SELECT 'month', strftime('%Y-%m', last_login_time, 'localtime') AS login_month, COUNT(*) FROM user_logins "
+    "GROUP BY login_month",
+)
+
+
+def create_stats_store(conn):
+    """
+    Function to create the statistics table and the triggers which keep it up to date. If the table is new but there
+    are already users in the database (e.g. the database was created by an older version), the counters are computed.
+    :param conn: An open read-write connection
+    :return: Returns nothing
+    """
+    conn.execute(CREATE_STATS_TABLE)
+    conn.execute(CREATE_STATS_INDEX)
+    for trigger in CREATE_STATS_TRIGGERS:
+        conn.execute(trigger)
+
+    has_counters = conn.execute("SELECT EXISTS (SELECT 1 FROM user_stats_counters)").fetchone()[0]
+    has_users = conn.execute("SELECT EXISTS (SELECT 1 FROM user_logins)").fetchone()[0]
+    if has_users and not has_counters:
+        rebuild_stats(conn)
+
+
+def rebuild_stats(conn):
+    """
+    Function to recompute every counter from scratch, e.g. after a bulk import or if the counters got out of sync
+    :param conn: An open read-write connection, the caller commits the transaction
+    :return: Returns the number of users counted
+    """
+    for statement in REBUILD_STATEMENTS:
+        conn.execute(statement)
+    return read_counter(conn, 'users', 'total')
+
+
+def read_counter(conn, kind, bucket):
+    """
+    Function to read one counter
+    :return: Returns the value of the counter, 0 if it does not exist
+    """
+    row = conn.execute(SELECT_COUNTER, (kind, bucket)).fetchone()
+    return row[0] if row else 0
+
+
+def read_top_bucket(conn, kind):
+    """
+    Function to find the bucket with the biggest counter, e.g. the most common country. On a tie the bucket which is
+    later in alphabetical order wins.
+    :return: Returns the name of the bucket or None if there is no such counter
+    """
+    row = conn.execute(SELECT_TOP_BUCKET, (kind,)).fetchone()
+    return row[0] if row else None
+
+
+def read_latest_bucket(conn, kind):
+    """
+    Function to read the counter of the latest time bucket, e.g. the number of users who logged in this week
+    :return: Returns the value of the counter, 0 if there is no such counter
+    """
+    row = conn.execute(SELECT_LATEST_BUCKET, (kind,)).fetchone()
+    return row[0] if row else 0
@@ -0,0 +1 @@
+# Benchmark suite of the database layer (see benchmarks/run.py)
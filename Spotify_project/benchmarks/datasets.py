@@ -0,0 +1,162 @@
+# Import necessary modules and functions
+import os
+import random
+import shutil
+import sqlite3
+from datetime import datetime, timedelta
+
+from app import database, dbtool
+from app.models import initialize_database
+
+# Roughly the share of the biggest Spotify markets, every other country gets the rest
+COUNTRY_WEIGHTS = {
+    'US': 0.27, 'GB': 0.07, 'DE': 0.06, 'BR': 0.06, 'MX': 0.05, 'FR': 0.04, 'IN': 0.04, 'ES': 0.03, 'CA': 0.03,
+    'IT': 0.02, 'JP': 0.02, 'AU': 0.02, 'NL': 0.02, 'SE': 0.02, 'PL': 0.02, 'HU': 0.01,
+}
+OTHER_COUNTRIES = ['AR', 'AT', 'BE', 'CH', 'CL', 'CO', 'CZ', 'DK', 'FI', 'ID', 'IE', 'NO', 'NZ', 'PH', 'PT', 'RO',
+                   'TR', 'ZA']
+PREMIUM_SHARE = 0.42  # Share of the paying users
+
+DATASET_VERSION = 1  # Increased when the generator changes, so the cached datasets are generated again
+DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
+
+
+def _countries():
+    countries = list(COUNTRY_WEIGHTS) + OTHER_COUNTRIES
+    rest = (1 - sum(COUNTRY_WEIGHTS.values())) / len(OTHER_COUNTRIES)
+    return countries, list(COUNTRY_WEIGHTS.values()) + [rest] * len(OTHER_COUNTRIES)
+
+
+def generate_rows(count, seed=42, now=None):
+    """
+    Generator of synthetic user_logins rows with realistic distributions:
+    - the countries follow the size of the markets,
+    - about 42% of the users are premium,
+    - the number of followers has a heavy tail (most users have a few, some have thousands),
+    - the last logins are recent for most users (exponential age, one third older than 10 days) and follow a daily
+      rhythm (more logins in the evening than at night)
+    :param count: The number of rows
+    :param seed: The seed of the random generator, the same seed gives the same rows
+    :param now: The time of the latest possible login (default: now)
+    :return: Yields (user_id, last_login_time, sub_level, display_name, followers, country) tuples
+    """
+    rng = random.Random(seed)
+    now = now or datetime.utcnow().replace(microsecond=0)
+    countries, weights = _countries()
+    hour_weights = [1, 1, 1, 1, 1, 1, 2, 3, 4, 4, 4, 4, 5, 5, 4, 4, 5, 6, 7, 8, 8, 7, 5, 3]
+
+    for i in range(count):
+        age_days = min(rng.expovariate(1 / 10), 730)  # Mean age of the last login is 10 days, at most two years
+        day = now - timedelta(days=int(age_days))
+        login_time = day.replace(hour=rng.choices(range(24), hour_weights)[0], minute=rng.randrange(60),
+                                 second=rng.randrange(60))
+        if login_time > now:
+            login_time -= timedelta(days=1)
+        followers = int(rng.paretovariate(1.16)) - 1  # 0 for about half of the users
+        yield (f"user_{i}", login_time.strftime('%Y-%m-%d %H:%M:%S'),
+               'premium' if rng.random() < PREMIUM_SHARE else 'free', f"User {i}", followers,
+               rng.choices(countries, weights)[0])
+
+
+def profile(row):
+    """
+    Function to turn a generated row into the /v1/me response which log_user_login reads
+    """
+    user_id, _, sub_level, display_name, followers, country = row
+    return {'id': user_id, 'product': sub_level, 'display_name': display_name, 'followers': {'total': followers},
+            'country': country}
+
+
+class ProfileClient:
+    """
+    Class which answers current_user() with a fixed profile, so log_user_login can be timed without the Spotify API
+    """
+
+    def __init__(self, user_profile):
+        self.user_profile = user_profile
+
+    def current_user(self):
+        return self.user_profile
+
+
+def build_database(path, count, seed=42):
+    """
+    Function to create a database with `count` synthetic users. The rows are loaded with the bulk import of the
+    dbtool (indexes built after the load) and the query planner statistics are collected.
+    :param path: The path of the new database file, an existing file is replaced
+    :return: Returns the path
+    """
+    remove_database(path)
+    initialize_database(path)
+    dbtool.import_rows(generate_rows(count, seed), drop_indexes=True)
+    with database.connection() as conn:
+        conn.execute("ANALYZE")  # Giving the query planner the statistics a production database would have
+    database.close_all()
+    return path
+
+
+def prepare_database(path, count, seed=42, use_cache=True, data_dir=None):
+    """
+    Function to create a benchmark database at `path`. Generating one million rows takes a while, so the generated
+    databases are kept in benchmarks/data and copied for every run (the runs modify their copy).
+    :param data_dir: The directory of the cached datasets (default: DATA_DIR)
+    :return: Returns the path
+    """
+    if not use_cache:
+        return build_database(path, count, seed)
+
+    cached = cached_dataset(count, seed, data_dir)
+    remove_database(path)
+    shutil.copyfile(cached, path)
+    return path
+
+
+def cached_dataset(count, seed=42, data_dir=None):
+    """
+    Function to get the path of the cached dataset, generating it if it does not exist yet
+    :param data_dir: The directory of the cached datasets (default: DATA_DIR)
+    :return: Returns the path
+    """
+    data_dir = data_dir or DATA_DIR
+    cached = os.path.join(data_dir, f"user_logins_{count}_{seed}_v{DATASET_VERSION}.db")
+    if not os.path.exists(cached):
+        os.makedirs(data_dir, exist_ok=True)
+        build_database(cached, count, seed)
+    return cached
+
+
+def load_into_memory(count, name='benchmark', seed=42, data_dir=None):
+    """
+    Function to copy a (cached) dataset into a shared-cache in-memory database and point the connection manager to
+    it, so the benchmark measures the code and not the disk
+    :param data_dir: The directory of the cached datasets (default: DATA_DIR)
+    :return: Returns the URI of the in-memory database
+    """
+    cached = cached_dataset(count, seed, data_dir)
+    location = database.configure(name, backend='memory')
+    source = sqlite3.connect(cached)
+    try:
+        with database.connection() as conn:
+            source.backup(conn)
+    finally:
+        source.close()
+    initialize_database(location)
+    return location
+
+
+def remove_database(path):
+    """
+    Function to close the pooled connections and delete a database file with its WAL files
+    """
+    database.close_all()
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+
+def count_rows(path):
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute("SELECT COUNT(*) FROM user_logins").fetchone()[0]
+    finally:
+        conn.close()
@@ -0,0 +1,343 @@
+"""
+Benchmark of the database layer: log_user_login, get_user_logins and get_user_stats on synthetic datasets.
+
+    python -m benchmarks.run                                  # 10k, 100k and 1M users
+    python -m benchmarks.run --sizes 10000 --repeat 50
+    python -m benchmarks.run --compare benchmarks/results/old.json
+
+The results are written as JSON (one record per dataset size and scenario) together with the commit they belong to,
+so two runs can be compared with --compare. The exit code is 1 if a scenario got slower than the threshold allows.
+"""
+import argparse
+import json
+import os
+import platform
+import sqlite3
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime
+
+from flask import Flask
+
+from app import database, models
+from benchmarks import datasets
+
+DEFAULT_SIZES = (10000, 100000, 1000000)
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), 'results')
+WORK_DB = 'work.db'  # The copy of the dataset the scenarios modify, in the data directory
+WRITER_THREADS = (2, 4, 8)
+
+
+def summarize(durations, elapsed=None, errors=0):
+    """
+    Function to compute the statistics of the measured durations
+    :param durations: The duration of every operation in seconds
+    :param elapsed: The wall clock time of the whole scenario (for the throughput of the concurrent scenarios)
+    :param errors: The number of failed operations
+    :return: Returns the statistics in milliseconds and the operations per second
+    """
+    ordered = sorted(durations)
+    elapsed = elapsed if elapsed is not None else sum(ordered)
+    return {
+        "ops": len(ordered),
+        "errors": errors,
+        "min_ms": round(ordered[0] * 1000, 4),
+        "median_ms": round(statistics.median(ordered) * 1000, 4),
+        "p95_ms": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000, 4),
+        "max_ms": round(ordered[-1] * 1000, 4),
+        "mean_ms": round(statistics.fmean(ordered) * 1000, 4),
+        "ops_per_sec": round(len(ordered) / elapsed, 1) if elapsed > 0 else None,
+    }
+
+
+def measure(function, repeat, warmup=1):
+    for _ in range(warmup):
+        function()
+    durations = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - started)
+    return summarize(durations)
+
+
+class LoginSource:
+    """
+    Class which hands out the profiles of the logins: mostly returning users of the dataset, sometimes new users
+    """
+
+    def __init__(self, size, seed=7):
+        self.size = size
+        self.returning = list(datasets.generate_rows(min(size, 10000), seed=seed))
+        self.next_new = size
+        self.position = 0
+        self._lock = threading.Lock()
+
+    def next_client(self):
+        with self._lock:
+            self.position += 1
+            if self.position % 5 == 0:  # Every fifth login is a new user
+                self.next_new += 1
+                row = (f"user_{self.next_new}",) + self.returning[0][1:]
+            else:
+                row = self.returning[self.position % len(self.returning)]
+        return datasets.ProfileClient(datasets.profile(row))
+
+
+def read_scenarios(size, repeat):
+    """
+    Function to time the read functions. The query cache is invalidated before every call (except in the "cached"
+    scenario), so the database is measured and not the cache.
+    :return: Returns the results by scenario name
+    """
+    with database.read_connection() as conn:
+        middle = conn.execute("SELECT id, last_login_time FROM user_logins ORDER BY last_login_time DESC, id DESC "
+                              "LIMIT 1 OFFSET ?", (size // 2,)).fetchone()
+    deep_cursor = models.encode_cursor(*middle)
+
+    def cold(function):
+        def run():
+            models.query_cache.invalidate()
+            function()
+        return run
+
+    scenarios = {
+        'get_user_logins_first_page': cold(lambda: models.get_user_logins(limit=100, stream=True)),
+        'get_user_logins_deep_page': cold(lambda: models.get_user_logins(cursor=deep_cursor, limit=100, stream=True)),
+        'get_user_logins_by_country': cold(lambda: models.get_user_logins(limit=100, country='HU', stream=True)),
+        'get_user_logins_by_sub_level': cold(lambda: models.get_user_logins(limit=100, sub_level='premium',
+                                                                            stream=True)),
+        'get_user_stats': cold(models.get_user_stats),
+    }
+    results = {name: measure(function, repeat) for name, function in scenarios.items()}
+    results['get_user_stats_cached'] = measure(models.get_user_stats, repeat)
+    results['get_user_logins_first_page_cached'] = measure(lambda: models.get_user_logins(limit=100, stream=True),
+                                                           repeat)
+    # Reading every row is slow on the big datasets, a few runs are enough
+    results['get_user_logins_all_rows'] = measure(lambda: sum(1 for _ in models.get_user_logins(stream=True)),
+                                                  max(1, min(repeat, 3)), warmup=0)
+    return results
+
+
+def write_scenarios(size, writes):
+    """
+    Function to time log_user_login, both with the direct write and with the background writer
+    :return: Returns the results by scenario name
+    """
+    source = LoginSource(size)
+    results = {'log_user_login': measure(lambda: models.log_user_login(source.next_client()), writes)}
+
+    # Inside an application with the background writer the request only queues the record. The throughput includes
+    # the time until the queue is written to the database.
+    app = Flask(__name__)
+    app.config['LOGIN_WRITER_ENABLED'] = True
+    models.login_writer.start()
+    durations = []
+    with app.app_context():
+        started = time.perf_counter()
+        for _ in range(writes):
+            call_started = time.perf_counter()
+            models.log_user_login(source.next_client())
+            durations.append(time.perf_counter() - call_started)
+        models.login_writer.stop()
+        elapsed = time.perf_counter() - started
+    models.login_writer.start()  # stop() refuses new records until the writer is started again
+    results['log_user_login_background'] = summarize(durations, elapsed)
+    return results
+
+
+def run_threads(threads, target):
+    started = time.perf_counter()
+    workers = [threading.Thread(target=target) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return time.perf_counter() - started
+
+
+def concurrent_scenarios(size, writes, repeat):
+    """
+    Function to time concurrent writers (several threads calling log_user_login at the same time) and the read
+    functions while the writers are running
+    :return: Returns the results by scenario name
+    """
+    source = LoginSource(size, seed=11)
+    results = {}
+
+    for threads in WRITER_THREADS:
+        durations, errors = [], []
+        lock = threading.Lock()
+
+        def writer():
+            for _ in range(max(1, writes // threads)):
+                started = time.perf_counter()
+                try:
+                    models.log_user_login(source.next_client())
+                except sqlite3.OperationalError as e:  # E.g. "database is locked" after the busy timeout
+                    with lock:
+                        errors.append(e)
+                    continue
+                with lock:
+                    durations.append(time.perf_counter() - started)
+
+        elapsed = run_threads(threads, writer)
+        results[f'concurrent_writers_{threads}'] = summarize(durations or [0.0], elapsed, len(errors))
+
+    # Readers while 4 threads keep writing
+    stop = threading.Event()
+
+    def background_writer():
+        while not stop.is_set():
+            models.log_user_login(source.next_client())
+
+    writers = [threading.Thread(target=background_writer) for _ in range(4)]
+    for worker in writers:
+        worker.start()
+    try:
+        def stats_cold():
+            models.query_cache.invalidate()
+            models.get_user_stats()
+
+        results['get_user_stats_under_writes'] = measure(stats_cold, repeat)
+        def first_page_cold():
+            models.query_cache.invalidate()
+            models.get_user_logins(limit=100, stream=True)
+
+        results['get_user_logins_first_page_under_writes'] = measure(first_page_cold, repeat)
+    finally:
+        stop.set()
+        for worker in writers:
+            worker.join()
+    return results
+
+
+def run_size(size, repeat, writes, use_cache=True, backend='file', data_dir=None):
+    """
+    Function to run every scenario on a fresh copy of the dataset with `size` users
+    :param backend: 'file' for a database file (like in production) or 'memory' for an in-memory copy, where the
+    readers wait for the writers (the scenarios under writes are not realistic there)
+    :param data_dir: The directory of the datasets and the working copy (default: datasets.DATA_DIR)
+    :return: Returns the list of result records
+    """
+    data_dir = data_dir or datasets.DATA_DIR
+    work_db = os.path.join(data_dir, WORK_DB)
+    print(f"Preparing {size} users...", file=sys.stderr)
+    if backend == 'memory':
+        datasets.load_into_memory(size, data_dir=data_dir)
+    else:
+        os.makedirs(data_dir, exist_ok=True)
+        datasets.prepare_database(work_db, size, use_cache=use_cache, data_dir=data_dir)
+        models.initialize_database(work_db)
+    try:
+        results = {}
+        results.update(read_scenarios(size, repeat))
+        results.update(write_scenarios(size, writes))
+        results.update(concurrent_scenarios(size, writes, repeat))
+    finally:
+        models.login_writer.stop()
+        datasets.remove_database(work_db)
+
+    records = []
+    for scenario, result in results.items():
+        records.append({"dataset_rows": size, "backend": backend, "scenario": scenario, **result})
+        print(f"  {scenario:<42} median {result['median_ms']:>10.3f} ms  p95 {result['p95_ms']:>10.3f} ms  "
+              f"{result['ops_per_sec'] or 0:>10.1f} ops/s", file=sys.stderr)
+    return records
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(__file__)).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def environment():
+    return {
+        "commit": git_commit(),
+        "created": datetime.utcnow().replace(microsecond=0).isoformat() + 'Z',
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "platform": platform.platform(),
+    }
+
+
+def compare(results, baseline, threshold):
+    """
+    Function to compare the median of every scenario with a previous run
+    :param results: The result document of this run
+    :param baseline: The result document of the previous run
+    :param threshold: The allowed slowdown, e.g. 0.25 means 25% slower
+    :return: Returns the list of (dataset_rows, scenario, old_ms, new_ms) regressions
+    """
+    old = {(r['dataset_rows'], r.get('backend', 'file'), r['scenario']): r for r in baseline['results']}
+    regressions = []
+    print(f"Comparing with {baseline['environment'].get('commit')}:", file=sys.stderr)
+    for record in results['results']:
+        previous = old.get((record['dataset_rows'], record.get('backend', 'file'), record['scenario']))
+        if previous is None or not previous['median_ms']:
+            continue
+        ratio = record['median_ms'] / previous['median_ms']
+        marker = ''
+        if ratio > 1 + threshold:
+            regressions.append((record['dataset_rows'], record['scenario'], previous['median_ms'],
+                                record['median_ms']))
+            marker = '  <-- slower'
+        print(f"  {record['dataset_rows']:>8} {record['scenario']:<42} {previous['median_ms']:>10.3f} -> "
+              f"{record['median_ms']:>10.3f} ms ({ratio:.2f}x){marker}", file=sys.stderr)
+    return regressions
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.run', description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(DEFAULT_SIZES), help="number of users")
+    parser.add_argument('--repeat', type=int, default=20, help="runs of every read scenario")
+    parser.add_argument('--writes', type=int, default=400, help="logins of every write scenario")
+    parser.add_argument('--output', '-o', default=None,
+                        help="result file (default: benchmarks/results/<time>_<commit>.json)")
+    parser.add_argument('--compare', default=None, help="result file of a previous run")
+    parser.add_argument('--threshold', type=float, default=0.25, help="allowed slowdown for --compare")
+    parser.add_argument('--no-cache', action='store_true', help="generate the datasets again")
+    parser.add_argument('--backend', choices=('file', 'memory'), default='file',
+                        help="run on a database file or on an in-memory copy of the dataset")
+    parser.add_argument('--data-dir', default=None,
+                        help="directory of the generated datasets (default: benchmarks/data)")
+    return parser
+
+
+def main(argv=None):
+    """
+    Entry point of the benchmark
+    :return: Returns the exit code
+    """
+    args = build_parser().parse_args(argv)
+    results = {"environment": environment(),
+               "settings": {"repeat": args.repeat, "writes": args.writes, "backend": args.backend}, "results": []}
+    for size in args.sizes:
+        results["results"].extend(run_size(size, args.repeat, args.writes, use_cache=not args.no_cache,
+                                           backend=args.backend, data_dir=args.data_dir))
+
+    output = args.output
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        name = f"{datetime.now().strftime('%Y%m%d-%H%M%S')}_{results['environment']['commit'] or 'unknown'}.json"
+        output = os.path.join(RESULTS_DIR, name)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {output}", file=sys.stderr)
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -9,3 +9,61 @@ class Config:
     SPOTIPY_CLIENT_ID = os.getenv('SPOTIPY_CLIENT_ID')
     SPOTIPY_CLIENT_SECRET = os.getenv('SPOTIPY_CLIENT_SECRET')
     SPOTIPY_REDIRECT_URI = os.getenv('SPOTIPY_REDIRECT_URI')
+
+    # Shared keep-alive connection pool of the Spotify API clients
+    SPOTIFY_POOL_SIZE = int(os.getenv('SPOTIFY_POOL_SIZE', '10'))  # Maximum number of open connections
+    SPOTIFY_TIMEOUT = float(os.getenv('SPOTIFY_TIMEOUT', '5'))  # Seconds
+    SPOTIFY_CALL_WORKERS = int(os.getenv('SPOTIFY_CALL_WORKERS', '8'))  # Spotify calls running at the same time
+    SPOTIFY_CALL_TIMEOUT = float(os.getenv('SPOTIFY_CALL_TIMEOUT', '4'))  # Seconds a page waits for a parallel call
+    SPOTIFY_PAGE_PARALLELISM = int(os.getenv('SPOTIFY_PAGE_PARALLELISM', '4'))  # Pages of one list fetched at once
+    SPOTIFY_RATE_LIMIT = float(os.getenv('SPOTIFY_RATE_LIMIT', '20'))  # Spotify calls per second of the whole app (0: off)
+    SPOTIFY_RATE_BURST = int(os.getenv('SPOTIFY_RATE_BURST', '40'))  # Calls which can be made at once after a quiet period
+
+    # Background thread which refreshes the tokens of the active users before they expire (1: on)
+    SPOTIFY_TOKEN_REFRESHER = os.getenv('SPOTIFY_TOKEN_REFRESHER', '0') == '1'
+    SPOTIFY_TOKEN_REFRESH_MARGIN = int(os.getenv('SPOTIFY_TOKEN_REFRESH_MARGIN', '300'))  # Seconds before the expiry
+
+    # Storage of the database: 'file' (SQLite file, default path is instance/spotify.db) or 'memory' (shared-cache
+    # in-memory SQLite, the path is the name of the database)
+    DATABASE_BACKEND = os.getenv('DATABASE_BACKEND', 'file')
+    DATABASE_PATH = os.getenv('DATABASE_PATH', '')
+
+    # Background (write-behind) writer of the login records
+    LOGIN_WRITER_ENABLED = os.getenv('LOGIN_WRITER_ENABLED', '1') == '1'
+    LOGIN_WRITER_FLUSH_INTERVAL = float(os.getenv('LOGIN_WRITER_FLUSH_INTERVAL', '0.5'))  # Seconds
+    LOGIN_WRITER_BATCH_SIZE = int(os.getenv('LOGIN_WRITER_BATCH_SIZE', '100'))  # Distinct users per batch
+    LOGIN_WRITER_QUEUE_SIZE = int(os.getenv('LOGIN_WRITER_QUEUE_SIZE', '10000'))
+
+    # Retention policy of the login event log and its rollups (in days, empty means forever)
+    LOGIN_EVENTS_RETENTION_DAYS = os.getenv('LOGIN_EVENTS_RETENTION_DAYS', '30')
+    LOGIN_ROLLUP_HOURLY_RETENTION_DAYS = os.getenv('LOGIN_ROLLUP_HOURLY_RETENTION_DAYS', '14')
+    LOGIN_ROLLUP_DAILY_RETENTION_DAYS = os.getenv('LOGIN_ROLLUP_DAILY_RETENTION_DAYS', '400')
+    LOGIN_ROLLUP_WEEKLY_RETENTION_DAYS = os.getenv('LOGIN_ROLLUP_WEEKLY_RETENTION_DAYS', '')
+
+    # Number of seconds the results of the statistics and user logins pages are cached (0 turns the cache off)
+    QUERY_CACHE_TTL = float(os.getenv('QUERY_CACHE_TTL', '30'))
+
+    # Memory limit of the cached Spotify catalog responses (artists, albums, searches, playlists), 0 turns it off
+    CATALOG_CACHE_MAX_BYTES = int(os.getenv('CATALOG_CACHE_MAX_BYTES', str(32 * 1024 * 1024)))
+
+    # Seconds after which the followed artists of a user are downloaded again from Spotify (the follows and unfollows
+    # made in the application are applied to the cached list right away)
+    FOLLOWED_ARTISTS_RESYNC = float(os.getenv('FOLLOWED_ARTISTS_RESYNC', '600'))
+
+    # Background indexing of the playlists of the users who search their library (1: on). If it is off, nothing is
+    # indexed
+    LIBRARY_INDEX_BACKGROUND = os.getenv('LIBRARY_INDEX_BACKGROUND', '1') == '1'
+    # Days the index of a user is kept after their last library search (empty means forever) and the most tracks which
+    # are indexed for one user
+    LIBRARY_INDEX_RETENTION_DAYS = os.getenv('LIBRARY_INDEX_RETENTION_DAYS', '30')
+    LIBRARY_INDEX_MAX_TRACKS = int(os.getenv('LIBRARY_INDEX_MAX_TRACKS', '20000'))
+
+
+class TestConfig(Config):
+    """
+    Configuration of the tests: the database is kept in memory, so the tests do not touch the disk
+    """
+    TESTING = True
+    DATABASE_BACKEND = 'memory'
+    DATABASE_PATH = 'spotify_test'
+    LIBRARY_INDEX_BACKGROUND = False  # The tests run the indexing themselves
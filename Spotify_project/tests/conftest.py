@@ -0,0 +1,22 @@
+import pytest
+from app.spotify_client import spotify_clients
+from app.rate_limit import spotify_limiter
+from app.auth import token_manager
+from app.models import catalog_cache, followed_artists
+
+
+# The Spotify clients and the catalog responses are cached, but every test mocks spotipy.Spotify on its own, so the
+# clients and responses of the previous test must not be reused
+@pytest.fixture(autouse=True)
+def reset_spotify_clients():
+    spotify_clients.clear()
+    catalog_cache.clear()
+    followed_artists.clear()
+    spotify_limiter.reset()
+    token_manager.reset()
+    yield
+    spotify_clients.clear()
+    catalog_cache.clear()
+    followed_artists.clear()
+    spotify_limiter.reset()
+    token_manager.reset()
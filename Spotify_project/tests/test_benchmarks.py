@@ -0,0 +1,53 @@
+import json
+from collections import Counter
+
+from benchmarks import datasets, run
+
+
+def test_generated_rows_are_realistic_and_repeatable():
+    rows = list(datasets.generate_rows(5000, seed=1))
+
+    assert rows[:10] == list(datasets.generate_rows(10, seed=1))  # Same seed, same rows
+    assert len({row[0] for row in rows}) == 5000  # Unique user IDs
+
+    countries = Counter(row[5] for row in rows)
+    assert countries.most_common(1)[0][0] == 'US'
+    premium_share = sum(row[2] == 'premium' for row in rows) / len(rows)
+    assert 0.35 < premium_share < 0.5
+    followers = sorted(row[4] for row in rows)
+    assert followers[len(followers) // 2] < 10 < followers[-1]  # Heavy tail: small median, some big accounts
+
+
+def test_compare_reports_regressions():
+    baseline = {"environment": {"commit": "abc"}, "results": [
+        {"dataset_rows": 10, "scenario": "fast", "median_ms": 1.0},
+        {"dataset_rows": 10, "scenario": "slow", "median_ms": 1.0},
+    ]}
+    results = {"results": [
+        {"dataset_rows": 10, "scenario": "fast", "median_ms": 1.1},
+        {"dataset_rows": 10, "scenario": "slow", "median_ms": 2.0},
+        {"dataset_rows": 10, "scenario": "new", "median_ms": 5.0},
+    ]}
+
+    assert run.compare(results, baseline, threshold=0.25) == [(10, "slow", 1.0, 2.0)]
+
+
+def test_benchmark_run_writes_results(tmp_path):
+    output = tmp_path / 'results.json'
+
+    assert run.main(['--sizes', '300', '--repeat', '2', '--writes', '8', '--no-cache', '--output', str(output),
+                     '--data-dir', str(tmp_path / 'data')]) == 0
+
+    results = json.loads(output.read_text())
+    scenarios = {record['scenario'] for record in results['results']}
+    assert {'log_user_login', 'get_user_logins_first_page', 'get_user_stats', 'concurrent_writers_8'} <= scenarios
+    assert all(record['dataset_rows'] == 300 for record in results['results'])
+    assert results['environment']['sqlite']
+
+
+def test_benchmark_runs_on_the_memory_backend(tmp_path):
+    output = tmp_path / 'results.json'
+
+    assert run.main(['--sizes', '200', '--repeat', '1', '--writes', '4', '--backend', 'memory',
+                     '--output', str(output), '--data-dir', str(tmp_path / 'data')]) == 0
+    assert {record['backend'] for record in json.loads(output.read_text())['results']} == {'memory'}
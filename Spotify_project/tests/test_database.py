@@ -0,0 +1,111 @@
+import os
+import sqlite3
+
+import pytest
+from app import database
+from app.models import initialize_database
+
+
+@pytest.fixture
+def pooled_database():
+    # Setup a test database and point the connection manager to it
+    test_db_path = os.path.join(os.path.dirname(__file__), 'test_pool.db')
+    initialize_database(test_db_path)
+
+    yield test_db_path
+
+    # Teardown: Close the pooled connections and remove the database files
+    database.close_all()
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(test_db_path + suffix):
+            os.remove(test_db_path + suffix)
+
+def test_configure_resolves_path_once(pooled_database):
+    # The path given to initialize_database is the one used by every later call
+    assert database.get_db_path() == os.path.abspath(pooled_database)
+    assert database.DEFAULT_DB_PATH.endswith(os.path.join('instance', 'spotify.db'))
+
+def test_connection_uses_wal_and_tuned_pragmas(pooled_database):
+    with database.connection() as conn:
+        assert conn.execute("PRAGMA journal_mode").fetchone()[0] == 'wal'
+        assert conn.execute("PRAGMA synchronous").fetchone()[0] == 1  # NORMAL
+        assert conn.execute("PRAGMA busy_timeout").fetchone()[0] == 5000
+
+def test_connections_are_reused(pooled_database):
+    with database.connection() as first:
+        pass
+    with database.connection() as second:
+        pass
+
+    # The same connection (and with it the prepared statement cache) is handed out again
+    assert first is second
+
+def test_read_connection_is_read_only(pooled_database):
+    with database.read_connection() as conn:
+        with pytest.raises(sqlite3.OperationalError):
+            conn.execute("INSERT INTO user_logins (user_id, sub_level, display_name, followers, country) "
+                         "VALUES ('u', 'free', 'U', 1, 'US')")
+
+def test_connection_rolls_back_on_error(pooled_database):
+    with pytest.raises(RuntimeError):
+        with database.connection() as conn:
+            conn.execute("INSERT INTO user_logins (user_id, sub_level, display_name, followers, country) "
+                         "VALUES ('u', 'free', 'U', 1, 'US')")
+            raise RuntimeError("boom")
+
+    with database.read_connection() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM user_logins").fetchone()[0] == 0
+
+@pytest.fixture
+def memory_database():
+    # Setup a shared-cache in-memory database
+    initialize_database('test_memory', backend='memory')
+
+    yield database.get_db_path()
+
+    database.close_all()
+
+def test_memory_backend_is_shared_and_separate(memory_database):
+    assert isinstance(database.get_storage(), database.MemorySQLiteStorage)
+    with database.connection() as conn:
+        conn.execute("INSERT INTO user_logins (user_id, sub_level, display_name, followers, country) "
+                     "VALUES ('u', 'free', 'U', 1, 'US')")
+
+    # Every connection of the process sees the same database, without a file on the disk
+    other = sqlite3.connect(memory_database, uri=True)
+    assert other.execute("SELECT COUNT(*) FROM user_logins").fetchone()[0] == 1
+    other.close()
+    assert not os.path.exists(memory_database)
+
+    # A database with another name is empty
+    initialize_database('test_memory_other', backend='memory')
+    with database.read_connection() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM user_logins").fetchone()[0] == 0
+
+def test_memory_backend_is_deleted_on_close(memory_database):
+    with database.connection() as conn:
+        conn.execute("INSERT INTO user_logins (user_id, sub_level, display_name, followers, country) "
+                     "VALUES ('u', 'free', 'U', 1, 'US')")
+    database.close_all()
+
+    with database.read_connection() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()[0] == 0
+
+def test_memory_read_connection_is_read_only(memory_database):
+    with database.read_connection() as conn:
+        with pytest.raises(sqlite3.OperationalError):
+            conn.execute("DELETE FROM user_logins")
+
+def test_unknown_backend():
+    with pytest.raises(ValueError):
+        database.configure('x', backend='postgres')
+
+def test_app_factory_selects_the_backend_from_config():
+    from app import create_app
+
+    app = create_app('config.TestConfig')
+
+    assert app.config['TESTING']
+    assert database.get_storage().backend == 'memory'
+    assert database.get_db_path() == 'file:spotify_test?mode=memory&cache=shared'
+    database.close_all()
@@ -0,0 +1,92 @@
+import io
+import json
+
+import pytest
+from app import database, dbtool
+from app.models import get_user_stats, initialize_database, write_user_logins
+
+USERS = [
+    ('user_1', '2024-05-01 10:00:00', 'premium', 'User 1', 10, 'US'),
+    ('user_2', '2024-05-02 11:00:00', 'free', 'User, "Two"', 0, 'HU'),
+    ('user_3', '2024-05-03 12:00:00', 'premium', 'Űser 3', 25, 'US'),
+]
+
+
+# Fixture to setup an empty in-memory test database
+@pytest.fixture
+def test_database():
+    initialize_database('test_dbtool', backend='memory')
+
+    yield database.get_db_path()
+
+    database.close_all()
+
+
+def read_users():
+    with database.read_connection() as conn:
+        return conn.execute("SELECT user_id, last_login_time, sub_level, display_name, followers, country "
+                            "FROM user_logins ORDER BY user_id").fetchall()
+
+
+def index_names():
+    with database.read_connection() as conn:
+        return sorted(row[0] for row in conn.execute(
+            "SELECT name FROM sqlite_master WHERE tbl_name='user_logins' AND type IN ('index', 'trigger') "
+            "AND sql IS NOT NULL"))
+
+
+@pytest.mark.parametrize("fmt", ['csv', 'jsonl'])
+def test_export_and_import_round_trip(test_database, fmt):
+    write_user_logins(USERS)
+    structures = index_names()
+
+    output = io.StringIO()
+    assert dbtool.export_rows(output, fmt, chunk_size=2) == 3
+    if fmt == 'jsonl':
+        assert json.loads(output.getvalue().splitlines()[0])['user_id'] == 'user_1'
+
+    # Loading the export into the emptied table with the indexes dropped during the load
+    with database.connection() as conn:
+        conn.execute("DELETE FROM user_logins")
+    output.seek(0)
+    count = dbtool.import_rows(dbtool.read_rows(output, fmt), chunk_size=2, drop_indexes=True)
+
+    assert count == 3
+    assert read_users() == USERS
+    assert index_names() == structures  # The indexes and the statistics triggers are back
+    assert get_user_stats()['total_users'] == 3
+
+
+def test_import_updates_existing_users(test_database):
+    write_user_logins(USERS[:1])
+    source = io.StringIO("user_id,last_login_time,sub_level,display_name,followers,country\n"
+                         "user_1,2024-06-01 09:00:00,free,User 1,11,US\n")
+
+    assert dbtool.import_rows(dbtool.read_rows(source, 'csv')) == 1
+    assert read_users() == [('user_1', '2024-06-01 09:00:00', 'free', 'User 1', 11, 'US')]
+
+
+def test_failed_import_keeps_the_indexes(test_database):
+    structures = index_names()
+    source = io.StringIO('{"user_id": "user_1"}\n')  # Missing columns
+
+    with pytest.raises(KeyError):
+        dbtool.import_rows(dbtool.read_rows(source, 'jsonl'), drop_indexes=True)
+    assert index_names() == structures
+
+
+def test_cli(tmp_path, capsys):
+    source = str(tmp_path / 'source.db')
+    initialize_database(source)
+    write_user_logins(USERS)
+    export_path = str(tmp_path / 'users.jsonl')
+
+    assert dbtool.main(['--db', source, 'export', '--output', export_path]) == 0
+    assert 'exported 3 rows' in capsys.readouterr().err
+
+    target = str(tmp_path / 'copy.db')
+    assert dbtool.main(['--db', target, 'import', '--input', export_path]) == 0
+    assert 'imported 3 rows' in capsys.readouterr().err
+    initialize_database(target)
+    assert read_users() == USERS
+    database.close_all()
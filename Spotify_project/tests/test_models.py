@@ -1,14 +1,23 @@
 import logging
+import sqlite3
+import threading
+import time
 from unittest.mock import MagicMock, patch
 
 import pytest
 from app import create_app
 from app.models import *
+from app import database, login_events, library_index
+from app.login_writer import LoginWriter
+from app.cache import TTLCache, CatalogCache
+from app.library_index import LibraryIndexer
+from app.rate_limit import current_priority, BACKGROUND
+from flask import session
 
 
 @pytest.fixture
 def client():
-    app = create_app()
+    app = create_app('config.TestConfig')
     app.config['TESTING'] = True
 
     with app.test_client() as client:
@@ -17,15 +26,14 @@ def client():
 # Fixture to setup a test database
 @pytest.fixture
 def setup_test_database():
-    # Setup a test database
-    test_db_path = os.path.join(os.path.dirname(__file__), 'test.db')  # Absolute path to your test database
+    # Setup a test database (shared-cache in-memory database, so the tests do not touch the disk)
+    test_db_path = 'file:test_models?mode=memory&cache=shared'
     initialize_database(test_db_path)  # Initialize test database
 
-    yield test_db_path  # Provide the test database path to tests
+    yield test_db_path  # Provide the test database URI to tests
 
-    # Teardown: Clean up the test database after tests
-    if os.path.exists(test_db_path):
-        os.remove(test_db_path)
+    # Teardown: Close the pooled connections, which also deletes the in-memory database
+    database.close_all()
 
 
 # Configure logging --> this is needed to make sure that the tests for CRUD operations are performed correctly
@@ -40,7 +48,7 @@ def test_insert_user(setup_test_database):
                 'country': 'US'}
 
     # Insert new user into the test database
-    conn = sqlite3.connect(setup_test_database)
+    conn = sqlite3.connect(setup_test_database, uri=True)
     c = conn.cursor()
 
     try:
@@ -72,11 +80,11 @@ def test_delete_user(setup_test_database):
                 'country': 'US'}
 
     # Insert new user into the test database
-    conn_insert = sqlite3.connect(setup_test_database)
+    conn_insert = sqlite3.connect(setup_test_database, uri=True)
     c_insert = conn_insert.cursor()
 
     # Delete user from the test database
-    conn_delete = sqlite3.connect(setup_test_database)
+    conn_delete = sqlite3.connect(setup_test_database, uri=True)
     c_delete = conn_delete.cursor()
 
     try:
@@ -121,7 +129,7 @@ def test_read_user(setup_test_database):
                 'country': 'US'}
 
     # Insert new user into the test database
-    conn_insert = sqlite3.connect(setup_test_database)
+    conn_insert = sqlite3.connect(setup_test_database, uri=True)
     c_insert = conn_insert.cursor()
 
     try:
@@ -134,7 +142,7 @@ def test_read_user(setup_test_database):
         conn_insert.commit()
 
         # Reading the user
-        conn_read = sqlite3.connect(setup_test_database)
+        conn_read = sqlite3.connect(setup_test_database, uri=True)
         c_read = conn_read.cursor()
 
         logging.debug(f"Reading inserted user: {new_user['user_id']}")
@@ -156,7 +164,7 @@ def test_modify_user(setup_test_database):
                 'country': 'US'}
 
     # Insert new user into the test database
-    conn_insert = sqlite3.connect(setup_test_database)
+    conn_insert = sqlite3.connect(setup_test_database, uri=True)
     c_insert = conn_insert.cursor()
 
     try:
@@ -169,7 +177,7 @@ def test_modify_user(setup_test_database):
         conn_insert.commit()
 
         # Modifying user details
-        conn_modify = sqlite3.connect(setup_test_database)
+        conn_modify = sqlite3.connect(setup_test_database, uri=True)
         c_modify = conn_modify.cursor()
 
         updated_display_name = 'Modified User'
@@ -201,13 +209,11 @@ def test_log_user_login_new_user(setup_test_database):
 
     logging.debug("Logging in new user with data: %s", mock_spotify.current_user.return_value)
 
-    # Patch the sqlite3.connect method to use the test database
-    with patch('sqlite3.connect', return_value=sqlite3.connect(setup_test_database)):
-        # Log the user login
-        log_user_login(mock_spotify)
+    # Log the user login
+    log_user_login(mock_spotify)
 
     # Verify insertion
-    conn = sqlite3.connect(setup_test_database)
+    conn = sqlite3.connect(setup_test_database, uri=True)
     c = conn.cursor()
     c.execute("SELECT * FROM user_logins WHERE user_id=?", ('test_user',))
     result = c.fetchone()
@@ -225,7 +231,7 @@ def test_log_user_login_new_user(setup_test_database):
 
 def test_log_user_login_existing_user(setup_test_database):
     # Insert a user into the test database
-    conn_insert = sqlite3.connect(setup_test_database)
+    conn_insert = sqlite3.connect(setup_test_database, uri=True)
     c_insert = conn_insert.cursor()
     c_insert.execute(
         "INSERT INTO user_logins (user_id, sub_level, display_name, followers, country) VALUES (?, ?, ?, ?, ?)",
@@ -244,13 +250,11 @@ def test_log_user_login_existing_user(setup_test_database):
 
     logging.debug("Logging in existing user with updated data: %s", mock_spotify.current_user.return_value)
 
-    # Patch the sqlite3.connect method to use the test database
-    with patch('sqlite3.connect', return_value=sqlite3.connect(setup_test_database)):
-        # Log the user login
-        log_user_login(mock_spotify)
+    # Log the user login
+    log_user_login(mock_spotify)
 
     # Verify update
-    conn = sqlite3.connect(setup_test_database)
+    conn = sqlite3.connect(setup_test_database, uri=True)
     c = conn.cursor()
     c.execute("SELECT * FROM user_logins WHERE user_id=?", ('test_user',))
     result = c.fetchone()
@@ -266,6 +270,146 @@ def test_log_user_login_existing_user(setup_test_database):
 
     conn.close()
 
+def test_write_user_logins_upserts_batch(setup_test_database):
+    # One new user and one returning user are written with the same executemany batch
+    write_user_logins([('user_1', '2024-06-20 10:00:00', 'free', 'User One', 10, 'US')])
+    written = write_user_logins([('user_1', '2024-06-21 10:00:00', 'premium', 'User One', 20, 'US'),
+                                 ('user_2', '2024-06-21 11:00:00', 'free', 'User Two', 5, 'CA')])
+    assert written == 2
+
+    conn = sqlite3.connect(setup_test_database, uri=True)
+    rows = conn.execute("SELECT user_id, last_login_time, sub_level, followers FROM user_logins ORDER BY user_id").fetchall()
+    conn.close()
+    assert rows == [('user_1', '2024-06-21 10:00:00', 'premium', 20), ('user_2', '2024-06-21 11:00:00', 'free', 5)]
+
+def test_login_events_are_rolled_up(setup_test_database):
+    # user_1 logs in three times, user_2 once, the last logins are updated and every login is an event
+    write_user_logins([('user_1', '2024-06-20 10:30:00', 'free', 'User One', 10, 'US'),
+                       ('user_2', '2024-06-20 11:00:00', 'free', 'User Two', 5, 'CA')],
+                      events=[('user_1', '2024-06-20 10:00:00', 'free', 'User One', 10, 'US'),
+                              ('user_1', '2024-06-20 10:10:00', 'free', 'User One', 10, 'US'),
+                              ('user_2', '2024-06-20 11:00:00', 'free', 'User Two', 5, 'CA'),
+                              ('user_1', '2024-06-20 10:30:00', 'free', 'User One', 10, 'US')])
+    write_user_logins([('user_2', '2024-06-21 09:00:00', 'free', 'User Two', 5, 'CA')])
+
+    conn = sqlite3.connect(setup_test_database, uri=True)
+    assert conn.execute("SELECT COUNT(*) FROM login_events").fetchone()[0] == 5
+    assert conn.execute("SELECT COUNT(*) FROM user_logins").fetchone()[0] == 2
+    assert conn.execute("SELECT SUM(logins) FROM login_rollups_hourly").fetchone()[0] == 5
+    assert conn.execute("SELECT COUNT(*) FROM login_rollups_daily").fetchone()[0] == 2
+    conn.close()
+
+    # The repeated logins are counted as well, while the number of users stays 2
+    user_stats = get_user_stats()
+    assert user_stats["weekly_logins"] == 2
+    assert user_stats["weekly_login_events"] == 5
+    assert user_stats["monthly_login_events"] == 5
+
+def test_login_events_retention(setup_test_database):
+    write_user_logins([('user_1', '2020-01-01 10:00:00', 'free', 'User One', 10, 'US')])
+    write_user_logins([('user_1', datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S'), 'free', 'User One', 10, 'US')])
+
+    old_retention = dict(login_events.retention_days)
+    try:
+        login_events.configure_retention(events=30, hourly=14, daily=None, weekly=None)
+        deleted = rollup_login_events()
+    finally:
+        login_events.configure_retention(**old_retention)
+
+    conn = sqlite3.connect(setup_test_database, uri=True)
+    # The old raw event and its hourly rollup are gone, but the daily rollup still counts it
+    assert deleted == 1
+    assert conn.execute("SELECT COUNT(*) FROM login_events").fetchone()[0] == 1
+    assert conn.execute("SELECT COUNT(*) FROM login_rollups_hourly WHERE bucket LIKE '2020%'").fetchone()[0] == 0
+    assert conn.execute("SELECT SUM(logins) FROM login_rollups_daily").fetchone()[0] == 2
+    conn.close()
+
+    with pytest.raises(ValueError):
+        login_events.configure_retention(monthly=3)
+
+def test_login_writer_coalesces_and_flushes_on_stop():
+    # Collecting the batches instead of writing them to a database
+    batches = []
+    writer = LoginWriter(lambda records, events: batches.append((records, events)), flush_interval=60, batch_size=100)
+
+    assert writer.submit(('user_1', '2024-06-20 10:00:00'))
+    assert writer.submit(('user_2', '2024-06-20 10:00:01'))
+    assert writer.submit(('user_1', '2024-06-20 10:00:02'))  # Repeated login of the same user
+    writer.stop()
+
+    # Everything arrived in one batch and only the latest login of user_1 was kept, but every login is an event
+    records, events = batches[0]
+    assert len(batches) == 1
+    assert records == [('user_1', '2024-06-20 10:00:02'), ('user_2', '2024-06-20 10:00:01')]
+    assert events == [('user_1', '2024-06-20 10:00:00'), ('user_2', '2024-06-20 10:00:01'),
+                      ('user_1', '2024-06-20 10:00:02')]
+    assert not writer.submit(('user_3', '2024-06-20 10:00:03'))  # The writer refuses records after stopping
+
+def test_login_writer_flushes_on_batch_size():
+    batches = []
+    writer = LoginWriter(lambda records, events: batches.append(records), flush_interval=60, batch_size=2)
+    writer.submit(('user_1', 1))
+    writer.submit(('user_2', 2))
+
+    # The batch is written without waiting for the flush interval
+    for _ in range(100):
+        if batches:
+            break
+        time.sleep(0.01)
+    writer.stop()
+    assert batches[0] == [('user_1', 1), ('user_2', 2)]
+
+def test_login_writer_stop_does_not_flush_next_to_a_busy_worker():
+    writing, release = threading.Event(), threading.Event()
+    batches, active, overlaps = [], [], []
+
+    def write_batch(records, events):
+        if active:
+            overlaps.append(records)  # Another thread is writing at the same time
+        active.append(1)
+        writing.set()
+        release.wait(5)
+        batches.append(records)
+        active.pop()
+
+    writer = LoginWriter(write_batch, flush_interval=60, batch_size=1)
+    writer.submit(('user_1', 1))
+    assert writing.wait(5)  # The worker is in the middle of a slow write
+    writer._queue.put_nowait(('user_2', 2))
+
+    writer.stop(timeout=0.05)  # Returns before the worker finished, without writing anything itself
+    assert batches == [] and overlaps == []
+
+    release.set()
+    writer._thread.join(5)
+    assert batches == [[('user_1', 1)], [('user_2', 2)]]  # The worker wrote the rest
+    assert overlaps == []
+
+def test_login_writer_full_queue_refuses_record():
+    writer = LoginWriter(lambda records, events: None, max_queue_size=1)
+    writer._stopping.clear()
+    writer._queue.put_nowait(('user_1', 1))  # Filling the queue without starting the thread
+
+    with patch.object(writer, 'start'):
+        assert writer.submit(('user_2', 2)) is False
+
+def test_log_user_login_uses_background_writer_in_app(setup_test_database):
+    mock_spotify = MagicMock()
+    mock_spotify.current_user.return_value = {
+        'id': 'test_user', 'product': 'premium', 'display_name': 'Test User', 'followers': {'total': 100},
+        'country': 'US'}
+
+    app = create_app('config.TestConfig')
+    initialize_database(setup_test_database)  # create_app pointed the connection manager to its own database
+    with app.app_context():
+        with patch.object(login_writer, 'submit', return_value=True) as mock_submit:
+            with patch('app.models.write_user_logins') as mock_write:
+                log_user_login(mock_spotify)
+
+    # The record was queued and nothing was written on the request thread
+    assert mock_submit.call_args[0][0][0] == 'test_user'
+    mock_write.assert_not_called()
+
 def test_get_user_logins(setup_test_database):
     # Insert mock user data into the test database
     mock_users = [
@@ -274,7 +418,7 @@ def test_get_user_logins(setup_test_database):
         ('user_3', 'premium', 'User Three', 200, 'GB', '2023-06-22 08:45:00')
     ]
 
-    conn_insert = sqlite3.connect(setup_test_database)
+    conn_insert = sqlite3.connect(setup_test_database, uri=True)
     c_insert = conn_insert.cursor()
     for user in mock_users:
         c_insert.execute(
@@ -285,10 +429,8 @@ def test_get_user_logins(setup_test_database):
 
     logging.debug("Inserted mock users")
 
-    # Patch the sqlite3.connect method to use the test database
-    with patch('sqlite3.connect', return_value=sqlite3.connect(setup_test_database)):
-        # Fetch user login details
-        user_logins = get_user_logins()
+    # Fetch user login details
+    user_logins = get_user_logins()
 
     logging.debug("Fetched user logins: %s", user_logins)
 
@@ -302,6 +444,45 @@ def test_get_user_logins(setup_test_database):
 
     assert user_logins == expected_user_logins, f"Expected {expected_user_logins}, got {user_logins}"
 
+def test_get_user_logins_keyset_pages(setup_test_database):
+    # Two users with the same login time, so the id has to decide the order between them
+    mock_users = [
+        ('user_1', 'premium', 'User One', 150, 'US', '2023-06-20 10:00:00'),
+        ('user_2', 'free', 'User Two', 75, 'CA', '2023-06-21 15:30:00'),
+        ('user_3', 'premium', 'User Three', 200, 'GB', '2023-06-21 15:30:00'),
+        ('user_4', 'free', 'User Four', 10, 'US', '2023-06-22 08:45:00'),
+        ('user_5', 'premium', 'User Five', 20, 'US', '2023-06-23 08:45:00')
+    ]
+    conn_insert = sqlite3.connect(setup_test_database, uri=True)
+    conn_insert.executemany(
+        "INSERT INTO user_logins (user_id, sub_level, display_name, followers, country, last_login_time) VALUES (?, ?, ?, ?, ?, ?)",
+        mock_users)
+    conn_insert.commit()
+    conn_insert.close()
+
+    # Walking through every page of 2 rows
+    pages, cursor = [], None
+    while True:
+        page = get_user_logins(cursor=cursor, limit=2, stream=True)
+        pages.append([row[0] for row in page])
+        cursor = page.next_cursor
+        if cursor is None:
+            break
+
+    assert pages == [['user_5', 'user_4'], ['user_3', 'user_2'], ['user_1']]
+
+    # The pages together are the same as the whole list
+    assert [user for page in pages for user in page] == [row[0] for row in get_user_logins()]
+
+    # Filters
+    assert [row[0] for row in get_user_logins(country='US')] == ['user_5', 'user_4', 'user_1']
+    assert [row[0] for row in get_user_logins(country='US', sub_level='premium', limit=1)] == ['user_5']
+
+def test_decode_cursor_rejects_invalid_cursor():
+    assert decode_cursor(encode_cursor(7, '2023-06-21 15:30:00')) == (7, '2023-06-21 15:30:00')
+    with pytest.raises(ValueError):
+        decode_cursor('not-a-cursor')
+
 def test_get_user_stats(setup_test_database):
     # Insert mock user data into the test database
     mock_users = [
@@ -313,7 +494,7 @@ def test_get_user_stats(setup_test_database):
         ('user_6', 'premium', 'User Six', 90, 'GB', '2024-06-20 08:45:00')
     ]
 
-    conn_insert = sqlite3.connect(setup_test_database)
+    conn_insert = sqlite3.connect(setup_test_database, uri=True)
     c_insert = conn_insert.cursor()
     for user in mock_users:
         c_insert.execute(
@@ -324,10 +505,8 @@ def test_get_user_stats(setup_test_database):
 
     logging.debug("Inserted mock users for stats")
 
-    # Patch the sqlite3.connect method to use the test database
-    with patch('sqlite3.connect', return_value=sqlite3.connect(setup_test_database)):
-        # Fetch user statistics
-        user_stats = get_user_stats()
+    # Fetch user statistics
+    user_stats = get_user_stats()
 
     logging.debug("Fetched user stats: %s", user_stats)
 
@@ -340,6 +519,102 @@ def test_get_user_stats(setup_test_database):
     for key, expected_value in expected_stats.items():
         assert user_stats[key] == expected_value, f"Expected {expected_value} for {key}, got {user_stats[key]}"
 
+def test_user_stats_counters_follow_writes(setup_test_database):
+    # Inserting, updating and deleting users with plain SQL, the triggers have to keep the counters up to date
+    conn = sqlite3.connect(setup_test_database, uri=True)
+    conn.executemany(
+        "INSERT INTO user_logins (user_id, sub_level, display_name, followers, country, last_login_time) VALUES (?, ?, ?, ?, ?, ?)",
+        [('user_1', 'premium', 'User One', 100, 'US', '2024-06-20 10:00:00'),
+         ('user_2', 'free', 'User Two', 50, 'CA', '2024-06-21 10:00:00'),
+         ('user_3', 'free', 'User Three', 30, 'CA', '2024-05-21 10:00:00')])
+    conn.execute("UPDATE user_logins SET sub_level='premium', followers=70, country='US' WHERE user_id='user_2'")
+    conn.execute("DELETE FROM user_logins WHERE user_id='user_3'")
+    conn.commit()
+
+    counters = dict(((kind, bucket), value) for kind, bucket, value in
+                    conn.execute("SELECT kind, bucket, value FROM user_stats_counters WHERE value != 0"))
+    conn.close()
+
+    assert counters[('users', 'total')] == 2
+    assert counters[('sub_level', 'premium')] == 2
+    assert ('sub_level', 'free') not in counters
+    assert counters[('country', 'US')] == 2
+    assert counters[('followers', 'sum')] == 170
+
+    # The rebuilt counters are the same as the incrementally maintained ones
+    assert rebuild_user_stats() == 2
+    conn = sqlite3.connect(setup_test_database, uri=True)
+    rebuilt = dict(((kind, bucket), value) for kind, bucket, value in
+                   conn.execute("SELECT kind, bucket, value FROM user_stats_counters WHERE value != 0"))
+    conn.close()
+    assert rebuilt == counters
+
+def test_get_user_stats_empty_database(setup_test_database):
+    user_stats = get_user_stats()
+
+    assert user_stats["total_users"] == 0
+    assert user_stats["avg_followers"] == "0.000"
+    assert user_stats["most_common_country"] is None
+    assert user_stats["weekly_logins"] == 0
+
+def test_rebuild_stats_command(setup_test_database):
+    app = create_app('config.TestConfig')
+    initialize_database(setup_test_database)  # create_app pointed the connection manager to its own database
+
+    conn = sqlite3.connect(setup_test_database, uri=True)
+    conn.execute("INSERT INTO user_logins (user_id, sub_level, display_name, followers, country) VALUES ('u', 'free', 'U', 1, 'US')")
+    conn.execute("DELETE FROM user_stats_counters")  # Simulating counters which got out of sync
+    conn.commit()
+    conn.close()
+
+    result = app.test_cli_runner().invoke(args=['rebuild-stats'])
+
+    assert "Statistics rebuilt for 1 users." in result.output
+    assert get_user_stats()["total_users"] == 1
+
+def test_query_cache_hits_and_write_invalidation(setup_test_database):
+    query_cache.reset()
+    write_user_logins([('user_1', '2024-06-20 10:00:00', 'free', 'User One', 10, 'US')])
+
+    first = get_user_stats()
+    second = get_user_stats()
+    assert second is first  # The second call was answered from the cache
+    assert get_query_cache_stats()["hits"] == 1
+    assert get_query_cache_stats()["misses"] == 1
+
+    # A new login invalidates the cached statistics and pages
+    get_user_logins(limit=10)
+    write_user_logins([('user_2', '2024-06-20 11:00:00', 'premium', 'User Two', 20, 'CA')])
+    assert get_user_stats()["total_users"] == 2
+    assert len(get_user_logins(limit=10)) == 2
+    assert get_query_cache_stats()["invalidations"] >= 1
+
+    # A page with a limit is cached also when it is streamed, a stream of every row is never cached
+    assert get_user_logins(limit=10, stream=True) is get_user_logins(limit=10)
+    assert not isinstance(get_user_logins(stream=True), list)
+
+def test_ttl_cache_expiry_and_lru():
+    cache = TTLCache(ttl=0.05, max_entries=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)  # 'b' is the least recently used entry, it is dropped
+
+    assert cache.get('b') == (False, None)
+    assert cache.get('a') == (True, 1)
+    time.sleep(0.06)
+    assert cache.get('a') == (False, None)  # Expired
+
+def test_ttl_cache_does_not_store_values_computed_before_invalidation():
+    cache = TTLCache(ttl=60)
+
+    def compute():
+        cache.invalidate()  # A write happens while the value is computed
+        return 'stale'
+
+    assert cache.get_or_compute('key', compute) == 'stale'
+    assert cache.get('key') == (False, None)
+
 # Fixture for mocking Spotify API responses --> used to test if an empty list is returned for different search types
 @pytest.fixture
 def mock_spotify_empty():
@@ -358,43 +633,43 @@ def mock_get_token():
     }
 
 def test_search_artist_empty(mock_spotify_empty):
-    with patch('app.models.spotipy.Spotify', return_value=mock_spotify_empty):
+    with patch('app.spotify_client.SharedSessionSpotify', return_value=mock_spotify_empty):
         with patch('app.models.get_token', side_effect=mock_get_token):
             results = search_spotify('artist_name', 'artist')
             assert results == [], "Expected empty list for artist search"
 
 def test_search_track_empty(mock_spotify_empty):
-    with patch('app.models.spotipy.Spotify', return_value=mock_spotify_empty):
+    with patch('app.spotify_client.SharedSessionSpotify', return_value=mock_spotify_empty):
         with patch('app.models.get_token', side_effect=mock_get_token):
             results = search_spotify('track_name', 'track')
             assert results == [], "Expected empty list for track search"
 
 def test_search_album_empty(mock_spotify_empty):
-    with patch('app.models.spotipy.Spotify', return_value=mock_spotify_empty):
+    with patch('app.spotify_client.SharedSessionSpotify', return_value=mock_spotify_empty):
         with patch('app.models.get_token', side_effect=mock_get_token):
             results = search_spotify('album_name', 'album')
             assert results == [], "Expected empty list for album search"
 
 def test_search_playlist_empty(mock_spotify_empty):
-    with patch('app.models.spotipy.Spotify', return_value=mock_spotify_empty):
+    with patch('app.spotify_client.SharedSessionSpotify', return_value=mock_spotify_empty):
         with patch('app.models.get_token', side_effect=mock_get_token):
             results = search_spotify('playlist_name', 'playlist')
             assert results == [], "Expected empty list for playlist search"
 
 def test_search_show_empty(mock_spotify_empty):
-    with patch('app.models.spotipy.Spotify', return_value=mock_spotify_empty):
+    with patch('app.spotify_client.SharedSessionSpotify', return_value=mock_spotify_empty):
         with patch('app.models.get_token', side_effect=mock_get_token):
             results = search_spotify('show_name', 'show')
             assert results == [], "Expected empty list for show search"
 
 def test_search_episode_empty(mock_spotify_empty):
-    with patch('app.models.spotipy.Spotify', return_value=mock_spotify_empty):
+    with patch('app.spotify_client.SharedSessionSpotify', return_value=mock_spotify_empty):
         with patch('app.models.get_token', side_effect=mock_get_token):
             results = search_spotify('episode_name', 'episode')
             assert results == [], "Expected empty list for episode search"
 
 def test_invalid_search_type_empty(mock_spotify_empty):
-    with patch('app.models.spotipy.Spotify', return_value=mock_spotify_empty):
+    with patch('app.spotify_client.SharedSessionSpotify', return_value=mock_spotify_empty):
         with patch('app.models.get_token', side_effect=mock_get_token):
             results = search_spotify('invalid_query', 'invalid_type')
             assert results == [], "Expected empty list for invalid search type"
@@ -482,7 +757,7 @@ def mock_spotify_nonempty():
                           ("show", "Example", 1),
                           ("episode", "Random", 1)])
 def test_search_functions(mock_spotify_nonempty, search_type, query, expected_count):
-    with patch('app.models.spotipy.Spotify', return_value=mock_spotify_nonempty):
+    with patch('app.spotify_client.SharedSessionSpotify', return_value=mock_spotify_nonempty):
         with patch('app.models.get_token', side_effect=mock_get_token):
             results = search_spotify(query, search_type)
             print(results)
@@ -513,7 +788,7 @@ def mock_spotify_current_user():
     return mock_spotify_instance
 
 def test_display_current_user(mock_get_token_, mock_spotify_current_user):
-    with patch('app.models.spotipy.Spotify', return_value=mock_spotify_current_user):
+    with patch('app.spotify_client.SharedSessionSpotify', return_value=mock_spotify_current_user):
         user_data = display_current_user()
 
     expected_user_data = mock_user_info
@@ -551,7 +826,7 @@ def mock_spotify_top_items():
 
 def test_get_top_items(mock_get_token_, mock_spotify_top_items):
     with patch('app.models.get_token', return_value=mock_get_token()):
-        with patch('app.models.spotipy.Spotify', return_value=mock_spotify_top_items):
+        with patch('app.spotify_client.SharedSessionSpotify', return_value=mock_spotify_top_items):
             top_items = get_top_items()
 
     assert len(top_items["tracks"]) == 2
@@ -638,7 +913,7 @@ def test_get_specific_artist(mock_spotify_artist_data, mock_get_token_fix):
 
     with patch('app.models.search_spotify', mock_search_spotify):
         with patch('app.models.get_token', mock_get_token_fix):
-            with patch('app.models.spotipy.Spotify', return_value=mock_spotify_instance):
+            with patch('app.spotify_client.SharedSessionSpotify', return_value=mock_spotify_instance):
                 artist_details, artist_albums, artist_top_tracks, artist_related_artists = get_specific_artist(
                     artist_name)
 
@@ -702,7 +977,7 @@ def test_get_who_curr_user_follows(mock_spotify_followed_artists, mock_get_token
     }
 
     with patch('app.models.get_token', mock_get_token_fix):
-        with patch('app.models.spotipy.Spotify', return_value=mock_spotify_instance):
+        with patch('app.spotify_client.SharedSessionSpotify', return_value=mock_spotify_instance):
             followed_artists = get_who_curr_user_follows()
 
     # Assert the length and contents of followed_artists
@@ -711,6 +986,34 @@ def test_get_who_curr_user_follows(mock_spotify_followed_artists, mock_get_token
         assert expected_artist['id'] == actual_artist['id']
         assert expected_artist['name'] == actual_artist['name']
 
+def test_followed_artists_are_updated_in_place(mock_spotify_followed_artists, mock_get_token_fix):
+    mock_spotify_instance = MagicMock()
+    mock_spotify_instance.current_user_followed_artists.return_value = {
+        'artists': {'items': mock_spotify_followed_artists}
+    }
+    mock_spotify_instance.artist.return_value = {'id': 'artist7_id', 'name': 'Artist 7'}
+    app = create_app('config.TestConfig')
+
+    with patch('app.models.get_token', mock_get_token_fix):
+        with patch('app.spotify_client.SharedSessionSpotify', return_value=mock_spotify_instance):
+            with app.test_request_context():
+                session['user_id'] = 'user_1'
+                assert is_following_artist('artist1_id') is True
+                assert is_following_artist('artist7_id') is False
+
+                follow_artist('artist7_id')
+                unfollow_artist('artist1_id')
+                assert is_following_artist('artist7_id') is True
+                assert is_following_artist('artist1_id') is False
+                assert [artist['id'] for artist in get_who_curr_user_follows()][-1] == 'artist7_id'
+
+                # The list was downloaded only once
+                assert mock_spotify_instance.current_user_followed_artists.call_count == 1
+
+                with patch.object(followed_artists, 'resync_interval', 0):  # The list is downloaded again when it is too old
+                    get_who_curr_user_follows()
+                assert mock_spotify_instance.current_user_followed_artists.call_count == 2
+
 def test_unfollow_artist(mock_get_token_fix):
     artist_id = 'artist123'  # Example artist ID to unfollow
 
@@ -718,7 +1021,7 @@ def test_unfollow_artist(mock_get_token_fix):
     mock_spotify_instance = MagicMock()
 
     with patch('app.models.get_token', mock_get_token_fix):
-        with patch('app.models.spotipy.Spotify', return_value=mock_spotify_instance):
+        with patch('app.spotify_client.SharedSessionSpotify', return_value=mock_spotify_instance):
             result = unfollow_artist(artist_id)
 
     # Assert that the function returns the artist_id after unfollowing
@@ -735,7 +1038,7 @@ def test_follow_artist(mock_get_token_fix):
     mock_spotify_instance = MagicMock()
 
     with patch('app.models.get_token', mock_get_token_fix):
-        with patch('app.models.spotipy.Spotify', return_value=mock_spotify_instance):
+        with patch('app.spotify_client.SharedSessionSpotify', return_value=mock_spotify_instance):
             result = follow_artist(artist_id)
 
     # Assert that the function returns the artist_id after following
@@ -759,11 +1062,12 @@ def test_get_playlists(mock_get_token_fix):
     mock_spotify_instance.current_user_playlists.return_value = mock_playlists_data
 
     with patch('app.models.get_token', mock_get_token_fix):
-        with patch('app.models.spotipy.Spotify', return_value=mock_spotify_instance):
+        with patch('app.spotify_client.SharedSessionSpotify', return_value=mock_spotify_instance):
             playlists = get_playlists()
 
     # Assert the returned playlists match the mock data
-    assert playlists == mock_playlists_data
+    assert playlists['items'] == mock_playlists_data['items']
+    assert find_playlist(playlists, 'playlist2_id') == {'id': 'playlist2_id', 'name': 'Playlist 2'}
 
     # Assert that current_user_playlists method was called once
     mock_spotify_instance.current_user_playlists.assert_called_once()
@@ -790,7 +1094,7 @@ def test_get_playlist(mock_get_token_fix):
     mock_spotify_instance.playlist.return_value = mock_playlist_data
 
     with patch('app.models.get_token', mock_get_token_fix):
-        with patch('app.models.spotipy.Spotify', return_value=mock_spotify_instance):
+        with patch('app.spotify_client.SharedSessionSpotify', return_value=mock_spotify_instance):
             playlist = get_playlist(playlist_id)
 
     # Assert the returned playlist matches the mock data
@@ -814,7 +1118,7 @@ def test_add_to_playlist(mock_get_token_fix):
     }
 
     with patch('app.models.get_token', mock_get_token_fix):
-        with patch('app.models.spotipy.Spotify', return_value=mock_spotify_instance):
+        with patch('app.spotify_client.SharedSessionSpotify', return_value=mock_spotify_instance):
             result = add_to_playlist(playlist_id, song_name)
 
     # Assert that the function returns True indicating successful addition
@@ -826,6 +1130,59 @@ def test_add_to_playlist(mock_get_token_fix):
     # Assert that playlist_add_items method was called once with correct parameters
     mock_spotify_instance.playlist_add_items.assert_called_once_with(playlist_id, [mock_song_id])
 
+def test_add_many_to_playlist(mock_get_token_fix):
+    song_names = [f'Song {i}' for i in range(150)] + ['Song 0', 'Unknown Song']
+
+    def search(q, type, limit):
+        if q == 'Unknown Song':
+            return {'tracks': {'items': []}}
+        return {'tracks': {'items': [{'id': q.replace('Song ', 'id_'), 'name': q, 'artists': [{'name': 'Artist'}]}]}}
+
+    mock_spotify_instance = MagicMock()
+    mock_spotify_instance.search.side_effect = search
+
+    with patch('app.models.get_token', mock_get_token_fix):
+        with patch('app.spotify_client.SharedSessionSpotify', return_value=mock_spotify_instance):
+            report = add_many_to_playlist('playlist123', song_names)
+
+    # Every different name is searched only once and the tracks are added 100 at a time
+    assert mock_spotify_instance.search.call_count == 151
+    calls = mock_spotify_instance.playlist_add_items.call_args_list
+    assert [len(call.args[1]) for call in calls] == [100, 51]
+    assert calls[1].args[1][-1] == 'id_0'  # The repeated name is added again, in the order of the list
+
+    assert len(report) == 152
+    assert report[0] == {'name': 'Song 0', 'track': {'id': 'id_0', 'name': 'Song 0', 'artists': ['Artist']},
+                         'added': True}
+    assert report[-1] == {'name': 'Unknown Song', 'track': None, 'added': False}
+
+def test_add_many_to_playlist_limits_its_searches(mock_get_token_fix):
+    running, most_running, priorities = [], [], []
+    lock = threading.Lock()
+
+    def search(q, type, limit):
+        with lock:
+            running.append(q)
+            most_running.append(len(running))
+            priorities.append(current_priority())
+        time.sleep(0.005)
+        with lock:
+            running.remove(q)
+        return {'tracks': {'items': [{'id': q, 'name': q, 'artists': []}]}}
+
+    mock_spotify_instance = MagicMock()
+    mock_spotify_instance.search.side_effect = search
+
+    with patch('app.models.get_token', mock_get_token_fix):
+        with patch('app.spotify_client.SharedSessionSpotify', return_value=mock_spotify_instance):
+            report = add_many_to_playlist('playlist123', [f'Song {i}' for i in range(20)])
+            with pytest.raises(ValueError):
+                add_many_to_playlist('playlist123', ['Song'] * (BULK_MAX_SONGS + 1))
+
+    assert all(line['added'] for line in report)
+    assert max(most_running) <= BULK_SEARCH_PARALLELISM  # The rest of the pool is left to the other users
+    assert set(priorities) == {BACKGROUND}
+
 def test_add_to_playlist_song_not_found(mock_get_token_fix):
     playlist_id = 'playlist123'
     song_name = 'Non-existent Song'
@@ -839,7 +1196,7 @@ def test_add_to_playlist_song_not_found(mock_get_token_fix):
     }
 
     with patch('app.models.get_token', mock_get_token_fix):
-        with patch('app.models.spotipy.Spotify', return_value=mock_spotify_instance):
+        with patch('app.spotify_client.SharedSessionSpotify', return_value=mock_spotify_instance):
             result = add_to_playlist(playlist_id, song_name)
 
     # Assert that the function returns False indicating song not found
@@ -866,7 +1223,7 @@ def test_create_spot_playlist(mock_get_token_fix):
 
     # Mocking spotipy.Spotify class
     with patch('app.models.get_token', mock_get_token_fix):
-        with patch('app.models.spotipy.Spotify', return_value=mock_spotify_instance):
+        with patch('app.spotify_client.SharedSessionSpotify', return_value=mock_spotify_instance):
             playlist = create_spot_playlist(playlist_name, playlist_description, is_public)
 
     # Assert the result of create_spot_playlist function
@@ -896,7 +1253,7 @@ def test_edit_playlist_details(mock_get_token_fix):
 
     # Mocking spotipy.Spotify class
     with patch('app.models.get_token', mock_get_token_fix):
-        with patch('app.models.spotipy.Spotify', return_value=mock_spotify_instance):
+        with patch('app.spotify_client.SharedSessionSpotify', return_value=mock_spotify_instance):
             updated_playlist = edit_playlist_details(playlist_id, new_name=new_name, new_description=new_description,
                                                      new_public=new_public)
 
@@ -920,7 +1277,7 @@ def test_follow_playlist(mock_get_token_fix):
 
     # Mocking spotipy.Spotify class
     with patch('app.models.get_token', mock_get_token_fix):
-        with patch('app.models.spotipy.Spotify', return_value=mock_spotify_instance):
+        with patch('app.spotify_client.SharedSessionSpotify', return_value=mock_spotify_instance):
             result = follow_playlist(playlist_id)
 
     # Assert the result of follow_playlist function
@@ -928,3 +1285,406 @@ def test_follow_playlist(mock_get_token_fix):
 
     # Assert that current_user_follow_playlist method was called once with the correct arguments
     mock_spotify_instance.current_user_follow_playlist.assert_called_once_with(playlist_id)
+
+def test_catalog_cache_ttls_and_byte_limit():
+    cache = CatalogCache(ttls={'artist': 60, 'search': 0}, max_bytes=70)  # Room for two entries
+    cache.set(cache.key('artist', ('a',)), {'name': 'A' * 20})
+    cache.set(cache.key('artist', ('b',)), {'name': 'B' * 20})
+    assert cache.stats()["bytes"] == 62
+    cache.get(cache.key('artist', ('a',)))
+    cache.set(cache.key('artist', ('c',)), {'name': 'C' * 20})  # 'b' is the least recently used entry
+
+    assert cache.get(cache.key('artist', ('b',))) == (False, None)
+    assert cache.get(cache.key('artist', ('a',))) == (True, {'name': 'A' * 20})
+    assert cache.stats()["evictions"] == 1
+    assert not cache.set(cache.key('search', ('q',)), {'items': []})  # TTL 0: not cached
+
+    # Every hit is a new copy, so a caller can not change the cached response
+    found, value = cache.get(cache.key('artist', ('a',)))
+    value['name'] = 'changed'
+    assert cache.get(cache.key('artist', ('a',)))[1]['name'] == 'A' * 20
+
+def test_catalog_cache_does_not_store_a_fetch_which_overlapped_an_invalidation():
+    cache = CatalogCache()
+
+    def fetch():
+        cache.invalidate('current_user_playlists', user_id='user')  # E.g. the user edited a playlist meanwhile
+        return {'items': ['before the edit']}
+
+    assert cache.get_or_fetch('current_user_playlists', (), fetch, user_id='user') == {'items': ['before the edit']}
+    assert cache.get(cache.key('current_user_playlists', (), 'user')) == (False, None)  # Not stored
+
+    fetched = cache.get_or_fetch('current_user_playlists', (), lambda: {'items': ['after the edit']}, user_id='user')
+    assert cache.get_or_fetch('current_user_playlists', (), fetch, user_id='user') == fetched  # Stored now
+
+def test_specific_artist_details_are_cached(mock_get_token_fix):
+    mock_spotify_instance = MagicMock()
+    mock_spotify_instance.search.return_value = {'artists': {'items': [{'id': 'artist_id', 'name': 'Artist'}]}}
+    mock_spotify_instance.artist.return_value = {'id': 'artist_id', 'name': 'Artist'}
+    mock_spotify_instance.artist_albums.return_value = {'items': []}
+    mock_spotify_instance.artist_top_tracks.return_value = {'tracks': []}
+    mock_spotify_instance.artist_related_artists.return_value = {'artists': []}
+
+    with patch('app.models.get_token', mock_get_token_fix):
+        with patch('app.spotify_client.SharedSessionSpotify', return_value=mock_spotify_instance):
+            first = get_specific_artist('Artist')
+            second = get_specific_artist('Artist')
+
+    assert first == second
+    mock_spotify_instance.search.assert_called_once()
+    mock_spotify_instance.artist.assert_called_once()
+    mock_spotify_instance.artist_related_artists.assert_called_once()
+    assert catalog_cache.stats()["hits"] == 5
+
+def test_private_playlists_are_cached_per_user(mock_get_token_fix):
+    mock_spotify_instance = MagicMock()
+    mock_spotify_instance.playlist.side_effect = lambda playlist_id: {'id': playlist_id, 'public': False}
+    app = create_app('config.TestConfig')
+
+    with patch('app.models.get_token', mock_get_token_fix):
+        with patch('app.spotify_client.SharedSessionSpotify', return_value=mock_spotify_instance):
+            for user_id in ('user_1', 'user_1', 'user_2'):
+                with app.test_request_context():
+                    session['user_id'] = user_id
+                    get_playlist('private_playlist')
+
+            # The second user did not get the first user's copy
+            assert mock_spotify_instance.playlist.call_count == 2
+            assert catalog_cache.stats()["shared_entries"] == 0
+
+            edit_playlist_details('private_playlist', new_name='New name')
+            assert catalog_cache.stats()["entries"] == 0  # Every copy of the edited playlist is dropped
+
+def test_get_playlists_fetches_every_page_and_is_cached(mock_get_token_fix):
+    playlists = [{'id': f'playlist_{i}', 'name': f'Playlist {i}'} for i in range(120)]
+    mock_spotify_instance = MagicMock()
+    mock_spotify_instance.current_user_playlists.side_effect = lambda limit, offset: {
+        'items': playlists[offset:offset + limit], 'total': len(playlists), 'limit': limit, 'offset': offset}
+    app = create_app('config.TestConfig')
+
+    with patch('app.models.get_token', mock_get_token_fix):
+        with patch('app.spotify_client.SharedSessionSpotify', return_value=mock_spotify_instance):
+            with app.test_request_context():
+                session['user_id'] = 'user_1'
+                result = get_playlists()
+                assert len(result['items']) == 120  # Not only the first page of 50
+                assert find_playlist(result, 'playlist_110') == {'id': 'playlist_110', 'name': 'Playlist 110'}
+                assert find_playlist(result, 'unknown') is None
+                assert mock_spotify_instance.current_user_playlists.call_count == 3
+
+                get_playlists()
+                assert mock_spotify_instance.current_user_playlists.call_count == 3  # From the cache
+
+                follow_playlist('playlist_new')
+                get_playlists()
+                assert mock_spotify_instance.current_user_playlists.call_count == 6  # Fetched again after the change
+
+def test_remove_from_all_playlists_removes_every_match_in_chunks(mock_get_token_fix):
+    # 150 different matching tracks (every one twice) and 100 other tracks
+    items = [{'track': {'id': f'love_{i % 150}', 'name': f'Love Song {i % 150}'}} for i in range(300)]
+    items += [{'track': {'id': f'other_{i}', 'name': f'Other {i}'}} for i in range(100)] + [{'track': None}]
+    mock_spotify_instance = MagicMock()
+    mock_spotify_instance.playlist.return_value = {'snapshot_id': 'snapshot_1'}
+    mock_spotify_instance.playlist_items.side_effect = lambda playlist_id, fields, offset, limit: {
+        'items': items[offset:offset + limit], 'total': len(items), 'limit': limit}
+    mock_spotify_instance.playlist_remove_all_occurrences_of_items.side_effect = [
+        {'snapshot_id': 'snapshot_2'}, {'snapshot_id': 'snapshot_3'}]
+
+    with patch('app.models.get_token', mock_get_token_fix):
+        with patch('app.spotify_client.SharedSessionSpotify', return_value=mock_spotify_instance):
+            report = remove_from_all_playlists('playlist_id', 'love')
+            assert remove_from_all_playlists('playlist_id', 'not in the playlist') is False
+
+    assert report['scanned_items'] == 401
+    assert report['matched_tracks'] == 150
+    assert report['remove_calls'] == 2
+    assert report['snapshot_id'] == 'snapshot_3'
+
+    calls = mock_spotify_instance.playlist_remove_all_occurrences_of_items.call_args_list
+    assert calls[0].args == ('playlist_id', [f'love_{i}' for i in range(100)])
+    assert calls[0].kwargs == {'snapshot_id': 'snapshot_1'}  # Pinned to the scanned version
+    assert calls[1].args == ('playlist_id', [f'love_{i}' for i in range(100, 150)])
+    assert calls[1].kwargs == {'snapshot_id': 'snapshot_2'}
+
+def test_typeahead_reuses_cached_prefixes(mock_get_token_fix):
+    tracks = [{'id': 'id_1', 'name': 'Beat It', 'artists': [{'name': 'Michael Jackson'}], 'album': {'images': []}},
+              {'id': 'id_2', 'name': 'Beautiful Day', 'artists': [{'name': 'U2'}], 'album': {'images': []}}]
+    mock_spotify_instance = MagicMock()
+    mock_spotify_instance.search.return_value = {'tracks': {'items': tracks, 'total': 2}}
+
+    with patch('app.models.get_token', mock_get_token_fix):
+        with patch('app.spotify_client.SharedSessionSpotify', return_value=mock_spotify_instance):
+            first = typeahead('  BEA ', 'track')
+            assert first['source'] == 'spotify' and first['query'] == 'bea'
+            assert [item['name'] for item in first['items']] == ['Beat It', 'Beautiful Day']
+            assert first['items'][0]['subtitle'] == 'Michael Jackson'
+
+            assert typeahead('bea', 'track')['source'] == 'cache'
+
+            # Every result of 'bea' is known, so the longer queries are filtered locally
+            longer = typeahead('beat', 'track')
+            assert longer['source'] == 'prefix'
+            assert [item['name'] for item in longer['items']] == ['Beat It']
+            assert typeahead('beautiful u', 'track')['items'][0]['id'] == 'id_2'
+
+    mock_spotify_instance.search.assert_called_once_with(q='bea', type='track', limit=20)
+
+def test_catalog_results_are_shared_only_within_a_market(mock_get_token_fix):
+    mock_spotify_instance = MagicMock()
+    mock_spotify_instance.search.side_effect = lambda **params: {
+        'artists': {'items': [{'id': f"artist_{params.get('market')}", 'name': 'Artist'}]}}
+    app = create_app('config.TestConfig')
+    results = {}
+
+    with patch('app.models.get_token', mock_get_token_fix):
+        with patch('app.spotify_client.SharedSessionSpotify', return_value=mock_spotify_instance):
+            for user_id, country in (('user_hu', 'HU'), ('user_us', 'US'), ('other_user_hu', 'HU')):
+                mock_spotify_instance.current_user.return_value = {'id': user_id, 'country': country}
+                with app.test_request_context():
+                    session['user_id'] = user_id
+                    results[user_id] = search_spotify('Artist', 'artist')
+                    typeahead('artist', 'artist')
+
+    # The US user did not get the results of the Hungarian user, the second Hungarian user got the cached ones
+    assert results['user_hu'][0]['id'] == 'artist_HU' and results['other_user_hu'][0]['id'] == 'artist_HU'
+    assert results['user_us'][0]['id'] == 'artist_US'
+    markets = [call.kwargs['market'] for call in mock_spotify_instance.search.call_args_list]
+    assert sorted(markets) == ['HU', 'HU', 'US', 'US']  # One search and one typeahead call per market
+
+def test_typeahead_coalesces_identical_queries(mock_get_token_fix):
+    mock_spotify_instance = MagicMock()
+    mock_spotify_instance.search.side_effect = lambda **params: time.sleep(0.1) or {
+        'artists': {'items': [{'id': 'id_1', 'name': 'Queen', 'images': []}], 'total': 1}}
+    results = []
+
+    with patch('app.models.get_token', mock_get_token_fix):
+        with patch('app.spotify_client.SharedSessionSpotify', return_value=mock_spotify_instance):
+            threads = [threading.Thread(target=lambda: results.append(typeahead('queen', 'artist')))
+                       for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+    assert mock_spotify_instance.search.call_count == 1
+    assert [result['items'][0]['name'] for result in results] == ['Queen'] * 4
+
+def test_track_search_fills_the_results_from_more_pages(mock_get_token_fix):
+    # Only every 20th result contains the query, the first page has 3 of them
+    def track(i):
+        name = f'Café Song {i}' if i % 20 == 0 else f'Other {i}'
+        return {'id': f'id_{i}', 'name': name, 'popularity': i % 100, 'artists': [{'name': 'Artist'}]}
+
+    tracks = [track(i) for i in range(1000)]
+    tracks[41] = {'id': 'duplicate', 'name': 'CAFE SONG 0', 'popularity': 0, 'artists': [{'name': 'Artist'}]}
+    mock_spotify_instance = MagicMock()
+    mock_spotify_instance.search.side_effect = lambda q, type, limit, offset=0: {
+        'tracks': {'items': tracks[offset:offset + limit], 'total': len(tracks), 'limit': limit, 'offset': offset}}
+
+    with patch('app.models.get_token', mock_get_token_fix):
+        with patch('app.spotify_client.SharedSessionSpotify', return_value=mock_spotify_instance):
+            results = search_spotify('cafe song', 'track')
+
+    assert len(results) == 10
+    assert 'duplicate' not in [item['id'] for item in results]  # Same name and artist, regardless of case and accents
+    assert mock_spotify_instance.search.call_count == 4  # The first page and one concurrent round of 3 more
+    offsets = sorted(call.kwargs.get('offset', 0) for call in mock_spotify_instance.search.call_args_list)
+    assert offsets == [0, 50, 100, 150]
+
+def test_search_stops_at_the_call_limit(mock_get_token_fix):
+    tracks = [{'id': f'id_{i}', 'name': f'Other {i}', 'popularity': 0, 'artists': []} for i in range(1000)]
+    mock_spotify_instance = MagicMock()
+    mock_spotify_instance.search.side_effect = lambda q, type, limit, offset=0: {
+        'tracks': {'items': tracks[offset:offset + limit], 'total': len(tracks)}}
+
+    with patch('app.models.get_token', mock_get_token_fix):
+        with patch('app.spotify_client.SharedSessionSpotify', return_value=mock_spotify_instance):
+            assert search_spotify('nothing matches', 'track') == []
+
+    assert mock_spotify_instance.search.call_count == SEARCH_MAX_CALLS
+
+def test_specific_artist_returns_partial_results(mock_get_token_fix):
+    mock_spotify_instance = MagicMock()
+    mock_spotify_instance.search.return_value = {'artists': {'items': [{'id': 'artist_id', 'name': 'Artist'}]}}
+    mock_spotify_instance.artist.side_effect = RuntimeError("Spotify is down")
+    mock_spotify_instance.artist_albums.return_value = {'items': [{'name': 'Album'}]}
+    mock_spotify_instance.artist_top_tracks.return_value = {'tracks': []}
+    mock_spotify_instance.artist_related_artists.side_effect = RuntimeError("Spotify is down")
+
+    with patch('app.models.get_token', mock_get_token_fix):
+        with patch('app.spotify_client.SharedSessionSpotify', return_value=mock_spotify_instance):
+            details, albums, top_tracks, related = get_specific_artist('Artist')
+
+    assert details == {'id': 'artist_id', 'name': 'Artist'}  # The search result is used instead of the details
+    assert albums == {'items': [{'name': 'Album'}]}
+    assert top_tracks == {'tracks': []}
+    assert related is None
+
+def test_get_playlist_tracks_fetches_every_page(mock_get_token_fix):
+    tracks = [{'track': {'id': f'id_{i}', 'name': f'Track {i}', 'artists': [{'name': 'Artist'}],
+                         'album': {'name': 'Album'}, 'duration_ms': 1000}} for i in range(250)]
+    mock_spotify_instance = MagicMock()
+    mock_spotify_instance.playlist_items.side_effect = lambda playlist_id, offset, limit: {
+        'items': tracks[offset:offset + limit], 'total': len(tracks), 'limit': limit, 'offset': offset}
+
+    with patch('app.models.get_token', mock_get_token_fix):
+        with patch('app.spotify_client.SharedSessionSpotify', return_value=mock_spotify_instance):
+            tracks_info = get_playlist_tracks('playlist_id')
+
+    assert [track['id'] for track in tracks_info] == [f'id_{i}' for i in range(250)]
+    assert sorted(call.kwargs['offset'] for call in mock_spotify_instance.playlist_items.call_args_list) == [0, 100, 200]
+
+def library_track(track_id, name, artist, album):
+    return {'track': {'id': track_id, 'name': name, 'artists': [{'name': artist}], 'album': {'name': album},
+                      'duration_ms': 1000}}
+
+def test_library_index_answers_searches_and_removals_locally(mock_get_token_fix):
+    playlists = [{'id': 'mix', 'name': 'Mix', 'snapshot_id': 'mix_1'},
+                 {'id': 'party', 'name': 'Party', 'snapshot_id': 'party_1'}]
+    items = {
+        'mix': [library_track('love_1', 'Lovely Day', 'Bill Withers', 'Menagerie'),
+                library_track('halo', 'Halo', 'Beyoncé', 'I Am... Sasha Fierce'),
+                library_track('love_1', 'Lovely Day', 'Bill Withers', 'Menagerie'),
+                library_track('song', 'Song of Love', 'Adele', '25')],
+        'party': [library_track('halo', 'Halo', 'Beyoncé', 'I Am... Sasha Fierce')],
+    }
+    mock_spotify_instance = MagicMock()
+    mock_spotify_instance.current_user_playlists.return_value = {'items': playlists, 'total': 2, 'limit': 50}
+    mock_spotify_instance.playlist_items.side_effect = lambda playlist_id, offset, limit: {
+        'items': items[playlist_id][offset:offset + limit], 'total': len(items[playlist_id]), 'limit': limit}
+    mock_spotify_instance.playlist_remove_all_occurrences_of_items.return_value = {'snapshot_id': 'mix_2'}
+    app = create_app('config.TestConfig')
+
+    with patch('app.models.get_token', mock_get_token_fix):
+        with patch('app.spotify_client.SharedSessionSpotify', return_value=mock_spotify_instance):
+            with app.test_request_context():
+                session['user_id'] = 'library_user'
+                report = refresh_library(get_spotify_client(), 'library_user', get_playlists()['items'])
+                assert report == {'indexed': 2, 'removed': 0, 'skipped': 0, 'tracks': 5}
+                assert refresh_library(get_spotify_client(), 'library_user', playlists)['indexed'] == 0  # Up to date
+                read_calls = mock_spotify_instance.playlist_items.call_count
+
+                result = search_library('beyonce')  # The accents are ignored
+                assert [track['playlist_id'] for track in result['tracks']] == ['mix', 'party']
+                assert result['playlists'] == [{'id': 'mix', 'name': 'Mix', 'matches': 1},
+                                               {'id': 'party', 'name': 'Party', 'matches': 1}]
+                assert result['indexed_playlists'] == 2
+                assert [track['id'] for track in get_playlist_tracks('mix')] == ['love_1', 'halo', 'love_1', 'song']
+
+                report = remove_from_all_playlists('mix', 'lovely')
+                assert report['source'] == 'index'
+                assert report['read_calls'] == 0 and report['matched_tracks'] == 1
+                assert report['removed_tracks'] == ['Lovely Day']
+                playlists[0]['snapshot_id'] = 'mix_2'  # Spotify reports the snapshot of the removal from now on
+                assert remove_from_all_playlists('mix', 'not in the playlist') is False
+
+                # Only the removal was sent to Spotify, pinned to the indexed snapshot
+                assert mock_spotify_instance.playlist_items.call_count == read_calls
+                mock_spotify_instance.playlist.assert_not_called()
+                mock_spotify_instance.playlist_remove_all_occurrences_of_items.assert_called_once_with(
+                    'mix', ['love_1'], snapshot_id='mix_1')
+
+                # The index follows the removal
+                assert search_library('lovely')['tracks'] == []
+                assert [playlist['id'] for playlist in search_library('love')['playlists']] == ['mix']
+
+                # A changed playlist is indexed again, a playlist the user no longer has is removed
+                playlists = [{'id': 'mix', 'name': 'Mix', 'snapshot_id': 'mix_3'}]
+                assert refresh_library(get_spotify_client(), 'library_user', playlists) == {
+                    'indexed': 1, 'removed': 1, 'skipped': 0, 'tracks': 4}
+                assert search_library('halo')['playlists'] == [{'id': 'mix', 'name': 'Mix', 'matches': 1}]
+
+def test_removal_matches_the_same_tracks_in_the_index_and_on_spotify(mock_get_token_fix):
+    # The same playlist twice: 'indexed' is answered from the index, 'scanned' is downloaded from Spotify
+    playlists = [{'id': 'indexed', 'name': 'Indexed', 'snapshot_id': 'snap'},
+                 {'id': 'scanned', 'name': 'Scanned', 'snapshot_id': None}]
+    tracks = [library_track('lovely', 'Lovely Day', 'Bill Withers', 'Menagerie'),
+              library_track('glove', 'Glove', 'Band', 'Album'),
+              library_track('cafe', 'Café del Mar', 'Energy 52', 'Album'),
+              library_track('other', 'Other', 'Band', 'Album')]
+    mock_spotify_instance = MagicMock()
+    mock_spotify_instance.current_user_playlists.return_value = {'items': playlists, 'total': 2, 'limit': 50}
+    mock_spotify_instance.playlist_items.side_effect = lambda playlist_id, offset, limit, fields=None: {
+        'items': tracks[offset:offset + limit], 'total': len(tracks), 'limit': limit}
+    mock_spotify_instance.playlist.return_value = {'snapshot_id': 'snap'}
+    mock_spotify_instance.playlist_remove_all_occurrences_of_items.return_value = {'snapshot_id': 'snap'}
+    app = create_app('config.TestConfig')
+
+    with patch('app.models.get_token', mock_get_token_fix):
+        with patch('app.spotify_client.SharedSessionSpotify', return_value=mock_spotify_instance):
+            with app.test_request_context():
+                session['user_id'] = 'matching_user'
+                refresh_library(get_spotify_client(), 'matching_user', playlists)
+                # 'ove' starts in the middle of a word, 'CAFE' differs in case and accent
+                for song_name in ('ove', 'CAFE'):
+                    mock_spotify_instance.playlist_remove_all_occurrences_of_items.reset_mock()
+                    assert remove_from_all_playlists('indexed', song_name)['source'] == 'index'
+                    assert remove_from_all_playlists('scanned', song_name)['source'] == 'spotify'
+                    indexed_call, scanned_call = \
+                        mock_spotify_instance.playlist_remove_all_occurrences_of_items.call_args_list
+                    assert indexed_call.args[1] == scanned_call.args[1]
+                    assert indexed_call.args[1] == {'ove': ['lovely', 'glove'], 'CAFE': ['cafe']}[song_name]
+
+def test_library_index_keeps_only_what_the_policy_allows(mock_get_token_fix):
+    playlists = [{'id': 'small', 'name': 'Small', 'snapshot_id': 's1', 'tracks': {'total': 2}},
+                 {'id': 'large', 'name': 'Large', 'snapshot_id': 'l1', 'tracks': {'total': 3}}]
+    items = {'small': [library_track('a', 'A', 'Band', 'Album'), library_track('b', 'B', 'Band', 'Album')],
+             'large': [library_track(name, name.upper(), 'Band', 'Album') for name in ('c', 'd', 'e')]}
+    mock_spotify_instance = MagicMock()
+    mock_spotify_instance.current_user_playlists.return_value = {'items': playlists, 'total': 2, 'limit': 50}
+    mock_spotify_instance.playlist_items.side_effect = lambda playlist_id, offset, limit: {
+        'items': items[playlist_id][offset:offset + limit], 'total': len(items[playlist_id]), 'limit': limit}
+    app = create_app('config.TestConfig')
+    library_index.configure_retention(days=30, tracks=4)
+
+    try:
+        with patch('app.models.get_token', mock_get_token_fix):
+            with patch('app.spotify_client.SharedSessionSpotify', return_value=mock_spotify_instance):
+                with app.test_request_context():
+                    session['user_id'] = 'policy_user'
+                    get_playlists()  # Opening the playlists does not index them
+                    with database.read_connection() as conn:
+                        assert library_index.indexed_snapshots(conn, 'policy_user') == {}
+
+                    # The search records the use and schedules the indexing of the user
+                    with patch.object(library_indexer, 'enabled', True), \
+                            patch.object(library_indexer, 'schedule') as mock_schedule:
+                        search_library('a')
+                    assert mock_schedule.call_args.args[0] == 'policy_user'
+
+                    # The large playlist does not fit next to the small one
+                    report = refresh_library(get_spotify_client(), 'policy_user', playlists)
+                    assert report == {'indexed': 1, 'removed': 0, 'skipped': 1, 'tracks': 2}
+
+                    with database.connection() as conn:  # The last search was 31 days ago
+                        conn.execute("UPDATE library_users SET used_at = datetime('now', '-31 days') "
+                                     "WHERE user_id = 'policy_user'")
+                    assert prune_library() == 1
+                    assert search_library('a')['indexed_playlists'] == 0
+
+                    refresh_library(get_spotify_client(), 'policy_user', playlists)
+                    assert forget_library('policy_user') == 1
+                    with database.read_connection() as conn:
+                        assert library_index.playlist_track_names(conn, 'policy_user', 'small') == []
+    finally:
+        library_index.configure_retention()
+
+def test_library_indexer_runs_one_job_per_user():
+    started, release = threading.Event(), threading.Event()
+    indexer = LibraryIndexer()
+
+    def job():
+        started.set()
+        release.wait(5)
+        return current_priority()
+
+    first = indexer.schedule('user_1', job)
+    started.wait(5)
+    assert indexer.schedule('user_1', job) is None  # The user already has a job
+    release.set()
+    assert first.result(5) == BACKGROUND
+    assert indexer.schedule('user_1', lambda: None) is not None  # The next one can be scheduled after it
+    indexer.shutdown()
+
+    indexer.enabled = False
+    assert indexer.schedule('user_2', job) is None
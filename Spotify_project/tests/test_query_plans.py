@@ -0,0 +1,108 @@
+import os
+import sqlite3
+import time
+
+import pytest
+from app import database, login_events, stats
+from app.models import COUNT_INACTIVE_USERS, get_user_stats, query_cache, user_logins_query
+from benchmarks import datasets
+
+# The query plans are checked on a small database on every test run. The latency budgets need a big database, so they
+# only run when SPOTIFY_BENCHMARK=1 is set (e.g. SPOTIFY_BENCHMARK=1 python -m pytest tests/test_query_plans.py)
+RUN_BENCHMARK = os.getenv('SPOTIFY_BENCHMARK') == '1'
+BENCHMARK_ROWS = int(os.getenv('SPOTIFY_BENCHMARK_ROWS', '1000000'))
+PLAN_ROWS = 2000
+
+def make_database(path, count):
+    return datasets.build_database(path, count)  # Synthetic users with the distributions of the benchmark suite
+
+
+def remove_database(path):
+    datasets.remove_database(path)
+
+
+# Every query of the database layer with example parameters
+QUERIES = {
+    'user_logins': user_logins_query(),
+    'user_logins_page': user_logins_query(cursor='500:2024-06-01 00:00:00', limit=100),
+    'user_logins_by_country': user_logins_query(cursor='500:2024-06-01 00:00:00', limit=100, country='HU'),
+    'user_logins_by_sub_level': user_logins_query(limit=100, sub_level='premium'),
+    'inactive_users': (COUNT_INACTIVE_USERS, ('2024-06-01',)),
+    'stats_counter': (stats.SELECT_COUNTER, ('sub_level', 'premium')),
+    'stats_top_bucket': (stats.SELECT_TOP_BUCKET, ('country',)),
+    'stats_latest_bucket': (stats.SELECT_LATEST_BUCKET, ('week',)),
+    'rollup_login_events': ("SELECT" + login_events.ROLLUP_EVENTS.format(name='daily', fmt='%Y-%m-%d')
+                            .split('SELECT', 1)[1].split('ON CONFLICT')[0], (0, 100)),
+    'upsert_user_login': ("SELECT id FROM user_logins WHERE user_id=?", ('user_1',)),  # Conflict target lookup
+}
+
+# Statements of the statistics rebuild, which must not scan the table itself
+REBUILD_QUERIES = {f"rebuild_{i}": ("SELECT " + statement.split(' SELECT ', 1)[1], ())
+                   for i, statement in enumerate(stats.REBUILD_STATEMENTS) if ' SELECT ' in statement}
+
+
+@pytest.fixture(scope='module')
+def plan_database(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp('plans') / 'test_plans.db')  # Outside of the source tree
+    yield make_database(path, PLAN_ROWS)
+    remove_database(path)
+
+
+def query_plan(db_path, sql, params):
+    conn = sqlite3.connect(db_path)
+    plan = [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params)]
+    conn.close()
+    return plan
+
+
+@pytest.mark.parametrize("name", sorted(QUERIES) + sorted(REBUILD_QUERIES))
+def test_query_uses_index(plan_database, name):
+    sql, params = QUERIES.get(name) or REBUILD_QUERIES[name]
+    plan = query_plan(plan_database, sql, params)
+
+    # A plain "SCAN user_logins" (without an index) would read every row of the table
+    full_scans = [step for step in plan if step.startswith('SCAN') and 'INDEX' not in step]
+    assert not full_scans, f"{name} reads the whole table: {plan}"
+    assert any('INDEX' in step or 'PRIMARY KEY' in step for step in plan), f"{name} does not use an index: {plan}"
+
+
+@pytest.fixture(scope='module')
+def benchmark_database(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp('benchmark') / 'test_benchmark.db')
+    yield make_database(path, BENCHMARK_ROWS)
+    remove_database(path)
+
+
+def timed(function, repeat=5):
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+@pytest.mark.skipif(not RUN_BENCHMARK, reason="set SPOTIFY_BENCHMARK=1 to run the latency benchmark")
+@pytest.mark.parametrize("name, budget", [
+    ('first_page_of_user_logins', 0.05),
+    ('inactive_users', 0.5),
+    ('get_user_stats', 0.5),
+])
+def test_latency_budget(benchmark_database, name, budget):
+    def first_page():
+        with database.read_connection() as conn:
+            conn.execute(*user_logins_query(limit=100)).fetchall()
+
+    def inactive_users():
+        with database.read_connection() as conn:
+            conn.execute(COUNT_INACTIVE_USERS, ('2024-06-01',)).fetchone()
+
+    def user_stats():
+        query_cache.invalidate()  # Measuring the queries, not a lookup in the cache of the results
+        get_user_stats()
+
+    functions = {'first_page_of_user_logins': first_page, 'inactive_users': inactive_users,
+                 'get_user_stats': user_stats}
+
+    elapsed = timed(functions[name])
+    assert elapsed < budget, f"{name} took {elapsed * 1000:.1f} ms on {BENCHMARK_ROWS} rows (budget {budget * 1000:.0f} ms)"
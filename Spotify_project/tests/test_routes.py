@@ -3,11 +3,12 @@ from unittest.mock import patch, call, MagicMock
 import pytest
 from flask import session, url_for
 from app import create_app
+from app.models import BULK_MAX_SONGS, get_current_user_profile, write_user_logins
 
 
 @pytest.fixture
 def client():
-    app = create_app()
+    app = create_app('config.TestConfig')
     app.config['TESTING'] = True
 
     with app.test_client() as client:
@@ -30,6 +31,18 @@ def test_login_redirects_to_spotify(client, mocker):
     assert response.status_code == 302
     assert response.location.startswith('https://accounts.spotify.com/authorize')
 
+def test_login_forgets_the_library_of_the_previous_user(client, mocker):
+    mocker.patch('app.routes.create_spotify_oauth')
+    mock_forget_library = mocker.patch('app.routes.forget_library')
+    with client.session_transaction() as sess:
+        sess['user_id'] = 'previous_user'
+
+    client.get('/')
+    mock_forget_library.assert_called_once_with('previous_user')
+
+    client.get('/')  # Nobody was logged in
+    mock_forget_library.assert_called_once()
+
 def test_home_page(client):
     response = client.get('/home')
     assert response.status_code == 302
@@ -104,6 +117,40 @@ def test_user_logins(mock_get_user_logins, client):
     # Verify that the get_user_logins function was called once
     mock_get_user_logins.assert_called_once()
 
+@patch('app.routes.get_user_logins')
+def test_user_logins_pagination_and_filters(mock_get_user_logins, client):
+    # A page which reports that there is a next page after it was rendered
+    class MockPage(list):
+        next_cursor = '5:2024-06-18 12:02:02'
+
+    mock_get_user_logins.return_value = MockPage([('user1', '2024-06-19 11:01:01', "free", 'User 1', 2, "US")])
+
+    response = client.get('/user_logins?country=US&sub_level=free&limit=1')
+
+    assert response.status_code == 200
+    assert response.is_streamed
+    assert b'user1' in response.data
+    assert b'Next page' in response.data
+    assert b'cursor=5:2024-06-18+12:02:02' in response.data or b'cursor=5%3A2024-06-18' in response.data
+
+    # The filters and the page size are passed to the database layer
+    mock_get_user_logins.assert_called_once_with(cursor=None, limit=1, country='US', sub_level='free', stream=True)
+
+def test_user_logins_page_is_read_from_the_cache_the_second_time(client):
+    write_user_logins([('cached_user', '2024-06-19 11:01:01', 'free', 'Cached User', 2, 'US')])
+    first = client.get('/user_logins').get_data()  # Read now, the streamed page ends its request when it is read
+
+    with patch('app.models.database.read_connection') as mock_read_connection:
+        second = client.get('/user_logins').get_data()
+
+    mock_read_connection.assert_not_called()
+    assert b'Cached User' in first
+    assert second == first
+
+def test_user_logins_invalid_cursor(client):
+    response = client.get('/user_logins?cursor=invalid')
+    assert response.status_code == 400
+
 @patch('app.routes.get_user_stats')
 def test_user_stats(mock_get_user_stats, client):
     # Mock the get_user_stats function
@@ -126,6 +173,13 @@ def test_user_stats(mock_get_user_stats, client):
     # Verify that the get_user_stats function was called once
     mock_get_user_stats.assert_called_once()
 
+def test_metrics(client):
+    response = client.get('/metrics')
+
+    assert response.status_code == 200
+    assert set(response.json["query_cache"]) >= {"hits", "misses", "hit_rate", "invalidations"}
+    assert "queue_depth" in response.json["login_writer"]
+
 def test_search_get(client):
     # Simulate a GET request to /search
     response = client.get('/search')
@@ -421,14 +475,11 @@ def test_follow_artist_post(client, monkeypatch):
 
     monkeypatch.setattr('app.routes.search_spotify', mock_search_spotify)
 
-    # Mocking the get_who_curr_user_follows function to return test data
-    def mock_get_who_curr_user_follows():
-        return [
-            {'id': '1', 'name': 'Artist 1', 'genres': ['Pop', 'Rock'], 'followers': {'total': 5000},
-             'images': [{'url': 'https://example.com/artist1.jpg'}]},
-        ]
+    # Mocking the is_following_artist function, the user follows only the first artist
+    def mock_is_following_artist(artist_id):
+        return artist_id == '1'
 
-    monkeypatch.setattr('app.routes.get_who_curr_user_follows', mock_get_who_curr_user_follows)
+    monkeypatch.setattr('app.routes.is_following_artist', mock_is_following_artist)
 
     # Simulate a POST request to /follow with form data
     form_data = {'name': 'Artist 1'}
@@ -518,8 +569,8 @@ def test_display_playlists_get(mock_display_current_user, mock_get_playlists, cl
     # Patch get_token to return mock token
     mock_token = mock_get_token()
     with patch('app.routes.get_token', lambda: mock_token):
-        # Patch spotipy.Spotify to mock its behavior
-        with patch('spotipy.Spotify') as mock_spotify:
+        # Patch the Spotify client class to mock its behavior
+        with patch('app.spotify_client.SharedSessionSpotify') as mock_spotify:
             mock_spotify_instance = mock_spotify.return_value
             mock_spotify_instance.current_user_playlists.return_value = mock_current_user_playlists()
 
@@ -615,6 +666,58 @@ def test_add_item_to_playlist_success(client, monkeypatch):
         flash_messages = dict(session['_flashes'])
         assert flash_messages['success'] == "Track 'Test Song' has been successfully added."
 
+def test_add_item_to_playlist_bulk_report(client, monkeypatch):
+    monkeypatch.setattr('app.routes.get_playlists', mock_get_playlists)
+    monkeypatch.setattr('app.routes.display_current_user', mock_display_current_user)
+
+    report = [{'name': 'Song One', 'track': {'id': 'id_1', 'name': 'Song One', 'artists': ['Artist']}, 'added': True},
+              {'name': 'Unknown Song', 'track': None, 'added': False}]
+    with patch('app.routes.add_many_to_playlist', return_value=report) as mock_add_many_to_playlist:
+        response = client.post('/add_item_to_playlist', data={
+            'playlist_id': 'playlist1_id',
+            'song_names': 'Song One\r\n\r\n  Unknown Song  \r\n'
+        })
+
+    mock_add_many_to_playlist.assert_called_once_with('playlist1_id', ['Song One', 'Unknown Song'])
+    assert response.status_code == 200
+    assert b'1 of 2 songs were added' in response.data
+    assert b'Song One - Artist' in response.data
+    assert b'No track was found' in response.data
+
+def test_typeahead_returns_json(client):
+    suggestions = {'query': 'queen', 'items': [{'id': '1', 'name': 'Queen', 'subtitle': '', 'image': None}],
+                   'source': 'spotify'}
+    with patch('app.routes.typeahead', return_value=suggestions) as mock_typeahead:
+        response = client.get('/typeahead?q=Queen&type=artist')
+
+    mock_typeahead.assert_called_once_with('Queen', 'artist')
+    assert response.status_code == 200
+    assert response.get_json() == suggestions
+
+def test_library_search_returns_json(client):
+    result = {'query': 'halo', 'tracks': [], 'playlists': [{'id': 'playlist1_id', 'name': 'Playlist 1', 'matches': 1}],
+              'indexed_playlists': 2}
+    with patch('app.routes.search_library', return_value=result) as mock_search_library:
+        response = client.get('/library_search?q=halo')
+
+    mock_search_library.assert_called_once_with('halo')
+    assert response.status_code == 200
+    assert response.get_json() == result
+
+def test_add_item_to_playlist_refuses_too_many_songs(client, monkeypatch):
+    monkeypatch.setattr('app.routes.get_playlists', mock_get_playlists)
+    monkeypatch.setattr('app.routes.display_current_user', mock_display_current_user)
+
+    with patch('app.routes.add_many_to_playlist') as mock_add_many_to_playlist:
+        response = client.post('/add_item_to_playlist', data={
+            'playlist_id': 'playlist1_id',
+            'song_names': '\n'.join(f'Song {i}' for i in range(BULK_MAX_SONGS + 1))
+        })
+
+    mock_add_many_to_playlist.assert_not_called()
+    assert response.status_code == 200
+    assert f'At most {BULK_MAX_SONGS} songs can be added at once'.encode() in response.data
+
 def test_add_item_to_playlist_missing_song_name(client, monkeypatch):
     # Mock get_playlists to return mock playlists
     monkeypatch.setattr('app.routes.get_playlists', mock_get_playlists)
@@ -655,7 +758,8 @@ def test_remove_item_to_playlist_success(client, monkeypatch):
 
     # Mock add_to_playlist to simulate successful addition
     with patch('app.routes.remove_from_all_playlists') as mock_remove_from_playlist:
-        mock_remove_from_playlist.return_value = True  # Simulate success
+        mock_remove_from_playlist.return_value = {'matched_tracks': 2, 'removed_tracks': ['Test Song', 'Test Song 2'],
+                                                  'remove_calls': 1}  # Simulate success
 
         # Simulate a POST request to /add_item_to_playlist
         response = client.post('/remove_item_from_playlists', data={
@@ -671,7 +775,8 @@ def test_remove_item_to_playlist_success(client, monkeypatch):
     # Check if success message is flashed
     with client.session_transaction() as session:
         flash_messages = dict(session['_flashes'])
-        assert flash_messages['success'] == "The song 'Test Song' has been successfully removed."
+        assert flash_messages['success'] == ("The song 'Test Song' has been successfully removed: 2 track(s) "
+                                             "(Test Song, Test Song 2) with 1 call(s).")
 
 def test_remove_item_to_playlist_missing_song_name(client, monkeypatch):
     # Mock get_playlists to return mock playlists
@@ -1018,3 +1123,24 @@ def test_follow_public_playlist(mock_follow_playlist, client, monkeypatch):
 
     # Ensure follow_playlist was called twice (once successfully, once with error)
     assert mock_follow_playlist.call_count == 2
+
+def test_redirect_page_fetches_the_profile_once(client, mocker):
+    mock_oauth = mocker.Mock()
+    mock_oauth.get_access_token.return_value = {'access_token': 'memo_token', 'refresh_token': 'mock_refresh_token',
+                                                'expires_at': 9999999999}
+    mocker.patch('app.routes.create_spotify_oauth', return_value=mock_oauth)
+    mocker.patch('app.routes.log_user_login', side_effect=lambda spotify: get_current_user_profile(spotify))
+    mock_spotify = MagicMock()
+    mock_spotify.current_user.return_value = {
+        'id': 'test_user_id', 'display_name': 'Test User', 'email': 'test@example.com', 'followers': {'total': 1},
+        'product': 'free', 'country': 'US', 'images': []}
+    mocker.patch('app.spotify_client.SharedSessionSpotify', return_value=mock_spotify)
+    client.application.debug = True  # The saved calls are only reported in debug mode
+
+    response = client.get('/redirect?code=test_code')
+
+    # display_current_user and log_user_login both need the profile, but /v1/me is called only once
+    assert response.status_code == 302
+    mock_spotify.current_user.assert_called_once()
+    assert int(response.headers['X-Saved-Calls']) >= 1
+    assert client.get('/metrics').get_json()['request_memo']['saved_calls']['current_user'] >= 1
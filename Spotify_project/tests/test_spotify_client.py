@@ -0,0 +1,338 @@
+import asyncio
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from unittest.mock import MagicMock, patch
+
+import pytest
+from flask import session
+from spotipy import SpotifyException
+from app import create_app
+from app.auth import TokenManager, get_token, token_manager
+from app.async_spotify import AsyncSpotify, run
+from app.rate_limit import BACKGROUND, INTERACTIVE, RateLimiter, current_priority, priority
+from app.spotify_client import RateLimitedSession, SpotifyCallPool, SpotifyClientFactory, spotify_clients
+
+
+def test_clients_are_reused_per_token_and_share_one_session():
+    factory = SpotifyClientFactory(pool_size=3, timeout=2)
+
+    first = factory.get('token_a')
+    assert factory.get('token_a') is first
+    second = factory.get('token_b')
+
+    assert second is not first
+    assert first._session is second._session  # One connection pool for every client
+    assert first.requests_timeout == 2
+    assert first._session.get_adapter('https://api.spotify.com')._pool_maxsize == 3
+    assert factory.stats()["created"] == 2 and factory.stats()["reused"] == 1
+
+def test_token_is_swapped_in_place():
+    factory = SpotifyClientFactory()
+    client = factory.get('old_token')
+
+    factory.swap_token('old_token', 'new_token')
+
+    assert factory.get('new_token') is client
+    assert client._auth_headers() == {"Authorization": "Bearer new_token"}
+    assert factory.stats()["token_swaps"] == 1
+
+def test_dropped_clients_do_not_close_the_shared_session():
+    factory = SpotifyClientFactory(max_clients=1)
+    first = factory.get('token_a')
+    session = first._session
+
+    factory.get('token_b')  # token_a is the least recently used client, it is dropped
+    del first
+
+    assert factory.stats()["clients"] == 1
+    with patch.object(session, 'close') as mock_close:
+        factory.get('token_c')
+    mock_close.assert_not_called()
+
+def test_dropped_clients_can_finish_their_requests():
+    factory = SpotifyClientFactory(max_clients=1)
+    in_use = factory.get('token_a')  # E.g. memoized on g or running on a call pool thread
+    session = in_use._session
+
+    factory.get('token_b')  # token_a is dropped from the cache
+    assert in_use._session is session
+    factory.clear()  # configure() clears the factory as well
+    assert in_use._session is session
+
+    with patch.object(session, 'request', return_value=MagicMock(status_code=200, text='{"id": "me"}',
+                                                                 json=lambda: {'id': 'me'})) as mock_request:
+        assert in_use.me() == {'id': 'me'}
+    mock_request.assert_called_once()
+
+def test_refreshed_token_keeps_the_client():
+    app = create_app('config.TestConfig')
+    client = spotify_clients.get('old_token')
+    mock_oauth = MagicMock()
+    mock_oauth.refresh_access_token.return_value = {'access_token': 'new_token', 'refresh_token': 'refresh',
+                                                    'expires_at': int(time.time()) + 3600}
+
+    with app.test_request_context('/home'):
+        session['user_id'] = 'user'
+        session['token_info'] = {'access_token': 'old_token', 'refresh_token': 'refresh',
+                                 'expires_at': int(time.time())}
+        with patch('app.auth.create_spotify_oauth', return_value=mock_oauth):
+            assert get_token()['access_token'] == 'new_token'
+
+    assert spotify_clients.get('new_token') is client
+
+def test_fan_out_runs_calls_concurrently_with_partial_results():
+    pool = SpotifyCallPool(max_workers=4, timeout=0.5)
+
+    def slow(value, seconds):
+        return lambda: time.sleep(seconds) or value
+
+    def failing():
+        raise RuntimeError("boom")
+
+    started = time.perf_counter()
+    results = pool.fan_out({'a': slow('a', 0.2), 'b': slow('b', 0.2), 'c': slow('c', 0.2), 'slow': slow('x', 2),
+                            'failing': failing})
+    elapsed = time.perf_counter() - started
+
+    assert results == {'a': 'a', 'b': 'b', 'c': 'c', 'slow': None, 'failing': None}
+    assert elapsed < 1  # The slow call did not hold back the others and the calls did not run one after the other
+    assert pool.stats()["timeouts"] == 1 and pool.stats()["failures"] == 1
+    pool.shutdown()
+
+def test_fetch_all_pages_in_order_with_bounded_parallelism():
+    pool = SpotifyCallPool(page_parallelism=3)
+    items = list(range(1050))
+    running, max_running = [0], [0]
+    lock = threading.Lock()
+
+    def fetch_page(offset, limit):
+        with lock:
+            running[0] += 1
+            max_running[0] = max(max_running[0], running[0])
+        time.sleep(0.01)
+        with lock:
+            running[0] -= 1
+        return {'items': items[offset:offset + limit], 'total': len(items), 'limit': limit, 'offset': offset}
+
+    assert pool.fetch_all_pages(fetch_page, limit=100) == items
+    assert 1 < max_running[0] <= 3
+    pool.shutdown()
+
+def test_rate_limited_calls_wait_for_retry_after():
+    limiter = RateLimiter()
+    pool = SpotifyCallPool(limiter=limiter)
+    limiter.throttle('7')  # Another call was rate limited
+    call = MagicMock(return_value={'items': []})
+
+    with patch('app.spotify_client.time.sleep') as mock_sleep:
+        assert pool.call_with_backoff(call) == {'items': []}
+        assert 6 < mock_sleep.call_args[0][0] <= 7.7  # Waited for the Retry-After time (and the jitter) before the call
+    limiter.reset()
+
+    # The session already repeated the 429 responses, the pool does not repeat them again
+    call = MagicMock(side_effect=SpotifyException(429, -1, "Too many requests", headers={'Retry-After': '7'}))
+    with pytest.raises(SpotifyException):
+        pool.call_with_backoff(call)
+    assert call.call_count == 1
+    assert pool.stats()["rate_limited"] == 1
+
+    # Other errors are not counted
+    with pytest.raises(SpotifyException):
+        pool.call_with_backoff(MagicMock(side_effect=SpotifyException(404, -1, "Not found")))
+    assert pool.stats()["rate_limited"] == 1
+
+def test_rate_limited_call_makes_at_most_retries_plus_one_requests():
+    requests_made = []
+
+    class TooManyRequests(BaseHTTPRequestHandler):
+        def do_GET(self):
+            requests_made.append(self.path)
+            body = b'{"error": {"status": 429, "message": "API rate limit exceeded"}}'
+            self.send_response(429)
+            self.send_header('Retry-After', '1')
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(('127.0.0.1', 0), TooManyRequests)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    limiter = RateLimiter(max_wait=0.01)
+    factory = SpotifyClientFactory(retries=3, limiter=limiter)
+    pool = SpotifyCallPool(limiter=limiter)
+    client = factory.get('token')
+    client.prefix = f"http://127.0.0.1:{server.server_port}/v1/"
+
+    try:
+        with pytest.raises(SpotifyException) as error:
+            pool.call_with_backoff(client.current_user)
+    finally:
+        server.shutdown()
+        server.server_close()
+        factory.clear()
+
+    assert error.value.http_status == 429
+    assert len(requests_made) == 4  # The first request and the 3 retries of the session, nothing else repeats it
+    assert limiter.stats()["throttled"] == 3
+
+def test_rate_limiter_spaces_out_the_calls():
+    limiter = RateLimiter(rate=100, burst=2)
+
+    started = time.monotonic()
+    for _ in range(5):
+        limiter.acquire()
+    assert time.monotonic() - started >= 0.025  # 2 calls from the bucket, 3 waited for new tokens
+    assert limiter.stats()["acquired"] == 5 and limiter.stats()["delayed"] >= 2
+
+def test_interactive_calls_are_served_before_background_calls():
+    limiter = RateLimiter(rate=20, burst=1)
+    limiter.acquire()  # The bucket is empty now
+    order = []
+
+    def call(level):
+        limiter.acquire(level)
+        order.append(level)
+
+    background = threading.Thread(target=call, args=(BACKGROUND,))
+    background.start()
+    time.sleep(0.01)
+    interactive = threading.Thread(target=call, args=(INTERACTIVE,))
+    interactive.start()
+    time.sleep(0.01)
+    assert limiter.stats()["queue_depth"] == {"interactive": 1, "background": 1}
+    background.join()
+    interactive.join()
+
+    assert order == [INTERACTIVE, BACKGROUND]
+
+def test_session_repeats_rate_limited_requests():
+    limiter = RateLimiter(max_wait=0.05)
+    session = RateLimitedSession(limiter, retries=2)
+    rate_limited = MagicMock(status_code=429, headers={'Retry-After': '5'})
+    ok = MagicMock(status_code=200, headers={})
+
+    with patch('requests.Session.request', side_effect=[rate_limited, ok]) as mock_request:
+        started = time.monotonic()
+        assert session.request('GET', 'https://api.spotify.com/v1/me') is ok
+    assert mock_request.call_count == 2
+    assert time.monotonic() - started >= 0.05  # Every call waited for the (shortened) Retry-After time
+    assert limiter.stats()["throttled"] == 1
+
+def test_pool_calls_keep_the_priority_of_the_caller():
+    pool = SpotifyCallPool(max_workers=2)
+    with priority(BACKGROUND):
+        assert pool.submit(current_priority).result() == BACKGROUND
+    assert pool.submit(current_priority).result() == INTERACTIVE
+    pool.shutdown()
+
+def test_async_client_awaits_calls_together():
+    client = MagicMock()
+    client.current_user_top_tracks.side_effect = lambda limit: time.sleep(0.1) or {'items': ['track']}
+    client.current_user_top_artists.side_effect = lambda limit: time.sleep(0.1) or {'items': ['artist']}
+    pool = SpotifyCallPool(max_workers=4)
+    spotify = AsyncSpotify(client, pool)
+
+    async def load():
+        return await asyncio.gather(spotify.current_user_top_tracks(limit=10),
+                                    spotify.current_user_top_artists(limit=10))
+
+    started = time.monotonic()
+    assert run(load()) == [{'items': ['track']}, {'items': ['artist']}]
+    assert time.monotonic() - started < 0.18  # The two calls overlapped
+    pool.shutdown()
+
+def test_concurrent_refreshes_of_a_token_make_one_call():
+    mock_oauth = MagicMock()
+
+    def refresh_access_token(refresh_token):
+        time.sleep(0.1)
+        return {'access_token': 'new_token', 'refresh_token': refresh_token, 'expires_at': int(time.time()) + 3600}
+
+    mock_oauth.refresh_access_token.side_effect = refresh_access_token
+    expired = {'access_token': 'old_token', 'refresh_token': 'refresh', 'expires_at': int(time.time())}
+    results = []
+
+    with patch('app.auth.create_spotify_oauth', return_value=mock_oauth):
+        threads = [threading.Thread(target=lambda: results.append(token_manager.refresh(expired))) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    assert mock_oauth.refresh_access_token.call_count == 1
+    assert [token_info['access_token'] for token_info in results] == ['new_token'] * 5
+    assert token_manager.stats()["shared_refreshes"] == 4
+
+def test_background_refresh_works_without_a_request():
+    new_token = {'access_token': 'new_token', 'refresh_token': 'refresh', 'expires_at': int(time.time()) + 3600}
+    token_manager.newest({'access_token': 'old_token', 'refresh_token': 'refresh', 'expires_at': int(time.time()) + 120})
+    results = []
+
+    with patch.object(token_manager, 'redirect_uri', 'https://example.com/redirect'):
+        with patch.dict('os.environ', {'SPOTIPY_CLIENT_ID': 'id', 'SPOTIPY_CLIENT_SECRET': 'secret'}):
+            with patch('app.auth.SpotifyOAuth.refresh_access_token', return_value=new_token):
+                # The background thread has neither a request nor an application context
+                thread = threading.Thread(
+                    target=lambda: results.append((token_manager.refresh_due(), token_manager.oauth())))
+                thread.start()
+                thread.join(5)
+
+    refreshed, oauth = results[0]
+    assert refreshed == 1
+    assert oauth.redirect_uri == 'https://example.com/redirect'  # From the configuration, not from a request
+
+def test_redirect_uri_follows_the_request_if_it_is_not_configured():
+    app = create_app('config.TestConfig')
+    manager = TokenManager()
+
+    with patch.dict('os.environ', {'SPOTIPY_CLIENT_ID': 'id', 'SPOTIPY_CLIENT_SECRET': 'secret'}):
+        with app.test_request_context('/', base_url='http://first.example.com'):
+            assert manager.oauth().redirect_uri == 'http://first.example.com/redirect'
+        with app.test_request_context('/', base_url='http://second.example.com'):
+            assert manager.oauth().redirect_uri == 'http://second.example.com/redirect'  # Not frozen to the first host
+        with pytest.raises(RuntimeError):
+            manager.oauth()  # Outside of a request the redirect URI is not known
+
+def test_idle_tokens_are_forgotten_without_the_background_refresher():
+    manager = TokenManager(check_interval=30, idle_after=3600)
+    now = time.monotonic()
+
+    def token(name):
+        return {'access_token': name, 'refresh_token': name, 'expires_at': int(time.time()) + 3600}
+
+    with patch('app.auth.time.monotonic', return_value=now):
+        manager.newest(token('first'))
+        manager.newest(token('second'))
+    assert manager.stats()['tracked_tokens'] == 2
+
+    with patch('app.auth.time.monotonic', return_value=now + 3601):  # Both users were idle for an hour
+        manager.newest(token('third'))
+    assert manager.stats()['tracked_tokens'] == 1
+    assert not manager.is_running()
+
+def test_request_with_an_old_session_gets_the_refreshed_token():
+    app = create_app('config.TestConfig')
+    mock_oauth = MagicMock()
+    mock_oauth.refresh_access_token.return_value = {'access_token': 'new_token', 'refresh_token': 'refresh',
+                                                    'expires_at': int(time.time()) + 3600}
+    expiring = {'access_token': 'old_token', 'refresh_token': 'refresh', 'expires_at': int(time.time()) + 120}
+
+    with patch('app.auth.create_spotify_oauth', return_value=mock_oauth):
+        with app.test_request_context('/home'):
+            session['user_id'] = 'user'
+            session['token_info'] = expiring
+            assert get_token()['access_token'] == 'old_token'  # Still valid, the request does not refresh it
+
+        assert token_manager.refresh_due() == 1  # Refreshed in the background before it expires
+
+        with app.test_request_context('/home'):
+            session['user_id'] = 'user'
+            session['token_info'] = expiring  # E.g. another tab, which has the old cookie
+            assert get_token()['access_token'] == 'new_token'
+            assert session['token_info']['access_token'] == 'new_token'
+
+    assert mock_oauth.refresh_access_token.call_count == 1